@@ -1,7 +1,7 @@
 import csv
 import os
+import sys
 import json
-import os
 import OpenSSL.crypto
 import time
 from datetime import datetime
@@ -9,6 +9,9 @@ from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_collection'))
+from record_store import open_scrape
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def load_trademarks(csv_path):
@@ -22,40 +25,37 @@ def load_trademarks(csv_path):
             trademarks[row['Trademark']] = row['Domain']
     return trademarks
 
-def load_files(directory):
+def load_files(scrape, trademark, domain):
+    """
+    Load the DNS, WHOIS and certificate data scraped for a domain, from a scrape directory or record store.
+    """
     data = {'dns': None, 'whois': None, 'certificate': None, 'certificate_verified': None}
     try:
-        for file in os.listdir(directory):
-            file_path = os.path.join(directory, file)
-            if file.endswith('.dns.json'):
-                with open(file_path, 'r') as f:
-                    data['dns'] = json.load(f)
-            elif file.endswith('.whois.json'):
-                with open(file_path, 'r') as f:
-                    data['whois'] = json.load(f)
-            elif file.endswith('.certificate-verified') or file.endswith('.certificate-unverified'):
-                data['certificate'], data['certificate_verified'] = load_certificate(file_path)
+        for name, content in scrape.load(trademark, domain).items():
+            if name == 'dns.json':
+                data['dns'] = json.loads(content)
+            elif name == 'whois.json':
+                data['whois'] = json.loads(content)
+            elif name in ('certificate-verified', 'certificate-unverified'):
+                data['certificate'], data['certificate_verified'] = load_certificate(content, name == 'certificate-verified', domain)
     except Exception as e:
-        logging.error(f"Error loading files in {directory}: {e}")
+        logging.error(f"Error loading files for {domain}: {e}")
     return data
 
-def load_certificate(file_path):
+def load_certificate(pem_data, certificate_verified, domain):
     try:
-        with open(file_path, 'rb') as f:
-            pem_data = f.read()
-            certificate = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, pem_data)
-            certificate_data = {
-                'subject': extract_x509_name(certificate.get_subject()),
-                'issuer': extract_x509_name(certificate.get_issuer()),
-                'serial_number': certificate.get_serial_number(),
-                'valid_from': certificate.get_notBefore().decode(),
-                'valid_until': certificate.get_notAfter().decode(),
-                'subject_alternative_names': get_san(certificate)
-            }
-            certificate_verified = file_path.endswith('.certificate-verified')
+        certificate = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, pem_data)
+        certificate_data = {
+            'subject': extract_x509_name(certificate.get_subject()),
+            'issuer': extract_x509_name(certificate.get_issuer()),
+            'serial_number': certificate.get_serial_number(),
+            'valid_from': certificate.get_notBefore().decode(),
+            'valid_until': certificate.get_notAfter().decode(),
+            'subject_alternative_names': get_san(certificate)
+        }
         return certificate_data, certificate_verified
     except Exception as e:
-        logging.error(f"Error loading certificate from {file_path}: {e}")
+        logging.error(f"Error loading certificate for {domain}: {e}")
         return None, None
 
 
@@ -97,9 +97,9 @@ def parse_certificate_date(date_str):
     """
     return datetime.strptime(date_str, '%Y%m%d%H%M%SZ')
 
-def process_candidate_domain(candidate_domain_dir, trademark_data, candidate_domain, trademark_domain):
+def process_candidate_domain(scrape, trademark, trademark_data, candidate_domain, trademark_domain):
     """
-    Process each candidate domain directory.
+    Process each candidate domain of a trademark.
     """
     local_comparisons = {
         'share_cert_serial_number': [],
@@ -113,7 +113,7 @@ def process_candidate_domain(candidate_domain_dir, trademark_data, candidate_dom
     }
 
     try:
-        candidate_data = load_files(candidate_domain_dir)
+        candidate_data = load_files(scrape, trademark, candidate_domain)
 
         if candidate_data['certificate'] and trademark_data['certificate']:
             if candidate_data['certificate']['serial_number'] == trademark_data['certificate']['serial_number']:
@@ -190,7 +190,7 @@ def write_to_csv(data, file_path, comparison_type):
             writer.writerow(item)
 
 def process_trademark(args):
-    trademark_dir, domain, trademark_data = args
+    scrape, trademark, domain, trademark_data = args
     combined_results = {
         'share_cert_serial_number': [],
         'share_cert_subject_CN': [],
@@ -202,15 +202,14 @@ def process_trademark(args):
         'shared_whois_address': []
     }
     try:
-        for candidate_domain in os.listdir(trademark_dir):
-            candidate_domain_dir = os.path.join(trademark_dir, candidate_domain)
-            if os.path.isdir(candidate_domain_dir) and candidate_domain != domain:
-                result = process_candidate_domain(candidate_domain_dir, trademark_data, candidate_domain, domain)
+        for candidate_domain in scrape.candidate_domains(trademark):
+            if candidate_domain != domain:
+                result = process_candidate_domain(scrape, trademark, trademark_data, candidate_domain, domain)
                 for key in combined_results:
                     combined_results[key].extend(result[key])
 
     except Exception as e:
-        logging.error(f"Error processing trademark {domain} in directory {trademark_dir}: {e}")
+        logging.error(f"Error processing trademark {domain} ({trademark}): {e}")
     return combined_results
 
 
@@ -218,6 +217,7 @@ def main():
     csv_path = 'data/raw/combined_trademarks_list_full.csv'
     trademarks = load_trademarks(csv_path)
     base_dir = 'data/simple_scrape'
+    scrape = open_scrape(base_dir)
     output_dir = 'data/simple_scrape_preprocess'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -226,17 +226,15 @@ def main():
 
     tasks = []
     for trademark, domain in trademarks.items():
-        trademark_dir = os.path.join(base_dir, trademark)
-        if os.path.isdir(trademark_dir):
-            trademark_domain_dir = os.path.join(trademark_dir, domain)
-            if os.path.isdir(trademark_domain_dir):
-                trademark_data = load_files(trademark_domain_dir)
-                tasks.append((trademark_dir, domain, trademark_data))
+        if scrape.has_domain(trademark, domain):
+            trademark_data = load_files(scrape, trademark, domain)
+            tasks.append((scrape, trademark, domain, trademark_data))
     
     print(f"Total number of tasks: {len(tasks)}")
 
     with ThreadPoolExecutor(max_workers=200) as executor:
         results = list(tqdm(executor.map(process_trademark, tasks), total=len(tasks)))
+    scrape.close()
 
     combined_comparisons = {
         'share_cert_serial_number': [],
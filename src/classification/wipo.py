@@ -1,5 +1,9 @@
 import csv
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_collection'))
+from record_store import open_scrape
 
 def load_wipo_data(csv_path):
     wipo_data = {}
@@ -29,6 +33,7 @@ def write_to_csv(data, file_path):
 def main():
     wipo_csv_path = 'src/udrp_collection/wipo_data.csv'
     base_dir = 'data/simple_scrape'
+    scrape = open_scrape(base_dir)
     trademarks = load_trademarks('data/raw/combined_trademarks_list_full.csv')
 
     wipo_data, decisions = load_wipo_data(wipo_csv_path)
@@ -38,15 +43,14 @@ def main():
     wipo_not_shared = []
 
     for trademark, domain in trademarks.items():
-        trademark_dir = os.path.join(base_dir, trademark)
-        if os.path.isdir(trademark_dir):
-            for candidate_domain in os.listdir(trademark_dir):
-                decision = wipo_data.get(candidate_domain)
-                if decision:
-                    if decision == 'Transfer':
-                        wipo_shared.append((domain, candidate_domain, decision))
-                    else:
-                        wipo_not_shared.append((domain, candidate_domain, decision))
+        for candidate_domain in scrape.candidate_domains(trademark):
+            decision = wipo_data.get(candidate_domain)
+            if decision:
+                if decision == 'Transfer':
+                    wipo_shared.append((domain, candidate_domain, decision))
+                else:
+                    wipo_not_shared.append((domain, candidate_domain, decision))
+    scrape.close()
 
     write_to_csv(wipo_shared, 'wipo_shared.csv')
     write_to_csv(wipo_not_shared, 'wipo_not_shared.csv')
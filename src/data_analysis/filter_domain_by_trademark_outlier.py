@@ -1,33 +1,82 @@
 import json
+import os
+import sys
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_collection'))
+from candidate_io import iter_candidates, CandidateWriter, CandidateTable
+
 # Load the outliers.csv file
 outliers_csv_file = 'data/raw/outliers.csv'
 outliers_df = pd.read_csv(outliers_csv_file)
 
 # Extract the list of outliers trademarks
 outliers_list = outliers_df['Trademark'].tolist()
+outliers_set = set(outliers_list)
 
-# Load the candidate_domains_all.json file
+# Candidate files can be the columnar candidate_domains_all.parquet, a streamed candidate_domains_all.jsonl,
+# or the older candidate_domains_all.json
 json_file = 'data/raw/candidate_domains_all.json'
-with open(json_file, 'r') as f:
-    candidate_domains = json.load(f)
+jsonl_file = 'data/raw/candidate_domains_all.jsonl'
+parquet_file = 'data/raw/candidate_domains_all.parquet'
+
+if os.path.exists(parquet_file):
+    # Counts come from reading only the trademark column, and the filter is pushed down to the reader
+    candidates = CandidateTable(parquet_file)
+    counts_by_trademark = candidates.counts_by_trademark()
+    kept_trademarks = [trademark for trademark in counts_by_trademark if trademark not in outliers_set]
+
+    num_trademarks_all = len(counts_by_trademark)
+    num_domains_all = candidates.count()
+
+    filtered_parquet_file = 'data/raw/candidate_domains_filtered.parquet'
+    with CandidateWriter(filtered_parquet_file) as writer:
+        for batch in candidates.iter_batches(trademarks=kept_trademarks):
+            writer.write_batch(batch)
+
+    num_trademarks_filtered = len(kept_trademarks)
+    num_domains_filtered = CandidateTable(filtered_parquet_file).count()
+elif os.path.exists(jsonl_file):
+    # Filter one match at a time into candidate_domains_filtered.jsonl without loading the candidate set
+    trademarks_all = set()
+    trademarks_filtered = set()
+    num_domains_all = 0
+    num_domains_filtered = 0
+
+    filtered_jsonl_file = 'data/raw/candidate_domains_filtered.jsonl'
+    with CandidateWriter(filtered_jsonl_file) as writer:
+        for candidate in iter_candidates(jsonl_file):
+            trademark = candidate['trademark']
+            trademarks_all.add(trademark)
+            num_domains_all += 1
+            if trademark not in outliers_set:
+                trademarks_filtered.add(trademark)
+                num_domains_filtered += 1
+                writer.write(trademark, candidate['domain'], candidate['match_type'])
+
+    # JSON Lines only lists trademarks with at least one candidate domain
+    num_trademarks_all = len(trademarks_all)
+    num_trademarks_filtered = len(trademarks_filtered)
+else:
+    # Load the candidate_domains_all.json file
+    with open(json_file, 'r') as f:
+        candidate_domains = json.load(f)
 
-# Get the number of trademarks and domains in the original JSON
-num_trademarks_all = len(candidate_domains)
-num_domains_all = sum(len(domains) for domains in candidate_domains.values())
+    # Get the number of trademarks and domains in the original JSON
+    num_trademarks_all = len(candidate_domains)
+    num_domains_all = sum(len(domains) for domains in candidate_domains.values())
 
-# Filter the candidate_domains dictionary to remove trademarks in outliers
-filtered_candidate_domains = {trademark: domains for trademark, domains in candidate_domains.items() if trademark not in outliers_list}
+    # Filter the candidate_domains dictionary to remove trademarks in outliers
+    filtered_candidate_domains = {trademark: domains for trademark, domains in candidate_domains.items() if trademark not in outliers_set}
 
-# Save the filtered candidate domains to candidate_domains_filtered.json
-filtered_json_file = 'data/raw/candidate_domains_filtered.json'
-with open(filtered_json_file, 'w') as f:
-    json.dump(filtered_candidate_domains, f, indent=4)
+    # Save the filtered candidate domains to candidate_domains_filtered.json
+    filtered_json_file = 'data/raw/candidate_domains_filtered.json'
+    with open(filtered_json_file, 'w') as f:
+        json.dump(filtered_candidate_domains, f, indent=4)
 
-# Get the number of trademarks and domains in the filtered JSON
-num_trademarks_filtered = len(filtered_candidate_domains)
-num_domains_filtered = sum(len(domains) for domains in filtered_candidate_domains.values())
+    # Get the number of trademarks and domains in the filtered JSON
+    num_trademarks_filtered = len(filtered_candidate_domains)
+    num_domains_filtered = sum(len(domains) for domains in filtered_candidate_domains.values())
 
 # Calculate the reduction percentages
 reduction_percentage_trademarks = ((num_trademarks_all - num_trademarks_filtered) / num_trademarks_all) * 100
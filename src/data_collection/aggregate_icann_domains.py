@@ -1,32 +1,319 @@
 import os
+import json
+import mmap
+import gzip
+import hashlib
+import lzma
+import heapq
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-# Function to extract domain addresses from a file
-def extract_domains_from_file(filename):
-    domains = set()
-    print(f"Extracting domains from {filename}...")
-    with open(filename, 'r') as file:
+USE_PARALLEL_PARSER = True
+USE_EXTERNAL_SORT = True
+USE_ZONE_DIFF = False  # Compare against the previous unique_domains.txt and write only the added/removed domains; needs USE_EXTERNAL_SORT
+NUM_WORKERS = os.cpu_count() or 1
+CHUNKS_PER_WORKER = 4  # More ranges than workers so slow ranges don't hold up the pool
+MAX_MEMORY_MB = 4096  # Ceiling for domains held in memory across all workers before spilling to disk
+BYTES_PER_DOMAIN = 100  # Rough size of one short str in a set, used to turn MAX_MEMORY_MB into a count
+MAX_MERGE_FAN_IN = 256  # Runs merged at once, kept well below the open file limit
+COMPRESSED_EXTENSIONS = ('.gz', '.xz')
+
+def open_zone_file(filename, mode='rt'):
+    """Open a zone file, decompressing gzip or xz files on the fly."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    if filename.endswith('.xz'):
+        return lzma.open(filename, mode)
+    return open(filename, mode)
+
+def resolve_zone_file(input_directory, filename):
+    """Return the path of a zone file, falling back to a compressed copy if the plain one is missing."""
+    full_path = os.path.join(input_directory, filename)
+    if os.path.exists(full_path):
+        return full_path
+    for extension in COMPRESSED_EXTENSIONS:
+        if os.path.exists(full_path + extension):
+            return full_path + extension
+    return full_path
+
+def iter_domains_from_file(filename):
+    """Yield second-level domains from a (possibly compressed) zone file, one per owner line."""
+    with open_zone_file(filename) as file:
         for line in file:
             parts = line.strip().split()
             if len(parts) >= 1:
                 domain = parts[0].rstrip('.')  # Remove periods from the end
                 if domain.count('.') == 1:  # Check if it's not a subdomain
-                    domains.add(domain)
+                    yield domain
+
+# Function to extract domain addresses from a file
+def extract_domains_from_file(filename):
+    print(f"Extracting domains from {filename}...")
+    return set(iter_domains_from_file(filename))
+
+def max_domains_in_memory(max_memory_mb=MAX_MEMORY_MB, num_workers=1):
+    """Number of domains one worker may hold before its run has to be spilled."""
+    return max(1, max_memory_mb * 1024 * 1024 // (BYTES_PER_DOMAIN * num_workers))
+
+def spill_run(domains, run_directory):
+    """Write a set of domains to disk as one sorted run and return its path."""
+    fd, run_path = tempfile.mkstemp(suffix='.run', dir=run_directory)
+    with os.fdopen(fd, 'w') as run_file:
+        for domain in sorted(domains):
+            run_file.write(f"{domain}\n")
+    return run_path
+
+def write_sorted_runs(domains, run_directory, max_domains=None):
+    """Spill a stream of domains into sorted, deduplicated runs of at most max_domains each."""
+    if max_domains is None:
+        max_domains = max_domains_in_memory()
+
+    run_paths = []
+    buffer = set()
+    for domain in domains:
+        buffer.add(domain)
+        if len(buffer) >= max_domains:
+            run_paths.append(spill_run(buffer, run_directory))
+            buffer = set()
+    if buffer:
+        run_paths.append(spill_run(buffer, run_directory))
+    return run_paths
+
+def file_fingerprint(filename):
+    """SHA-256 of a file's contents, used to tell domain snapshots apart."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def iter_merged_runs(files):
+    """K-way merge sorted run files, yielding each distinct line once."""
+    previous = None
+    for line in heapq.merge(*files):
+        if line != previous:
+            yield line
+            previous = line
+
+def merge_run_files(run_paths, output_path):
+    """K-way merge sorted run files into one sorted file, dropping duplicates."""
+    files = [open(run_path, 'r') for run_path in run_paths]
+    try:
+        with open(output_path, 'w') as output_file:
+            for line in iter_merged_runs(files):
+                output_file.write(line)
+    finally:
+        for file in files:
+            file.close()
+
+def reduce_runs(run_paths, run_directory, fan_in=MAX_MERGE_FAN_IN):
+    """Merge runs in groups until there are few enough left to open at once."""
+    run_paths = list(run_paths)
+    while len(run_paths) > fan_in:
+        merged_paths = []
+        for i in range(0, len(run_paths), fan_in):
+            group = run_paths[i:i + fan_in]
+            fd, merged_path = tempfile.mkstemp(suffix='.run', dir=run_directory)
+            os.close(fd)
+            merge_run_files(group, merged_path)
+            for run_path in group:
+                os.remove(run_path)
+            merged_paths.append(merged_path)
+        run_paths = merged_paths
+    return run_paths
+
+def merge_sorted_runs(run_paths, output_path, run_directory, fan_in=MAX_MERGE_FAN_IN):
+    """Merge any number of sorted runs into output_path, in several passes if there are too many to open at once."""
+    merge_run_files(reduce_runs(run_paths, run_directory, fan_in), output_path)
+
+def diff_sorted_domains(new_domains, old_domains):
+    """Compare two sorted, deduplicated domain streams and yield ('added' | 'removed', domain) pairs."""
+    new_iter, old_iter = iter(new_domains), iter(old_domains)
+    new = next(new_iter, None)
+    old = next(old_iter, None)
+    previous_old = None
+    while new is not None or old is not None:
+        if old is not None and previous_old is not None and old < previous_old:
+            raise ValueError(f"Previous snapshot is not sorted ('{old}' after '{previous_old}'); rebuild it with USE_EXTERNAL_SORT")
+        if old is None or (new is not None and new < old):
+            yield 'added', new
+            new = next(new_iter, None)
+        elif new is None or old < new:
+            yield 'removed', old
+            previous_old = old
+            old = next(old_iter, None)
+        else:
+            previous_old = old
+            new = next(new_iter, None)
+            old = next(old_iter, None)
+
+def merge_sorted_runs_with_diff(run_paths, output_path, run_directory, added_path, removed_path, fan_in=MAX_MERGE_FAN_IN):
+    """Merge sorted runs into a new snapshot and, in the same pass, diff it against the snapshot already at output_path."""
+    run_paths = reduce_runs(run_paths, run_directory, fan_in)
+    fd, new_snapshot_path = tempfile.mkstemp(suffix='.txt', dir=os.path.dirname(output_path) or '.')
+    os.close(fd)
+
+    if not os.path.exists(output_path):
+        print(f"No previous snapshot at {output_path}, every domain will be reported as added")
+
+    counts = {'added': 0, 'removed': 0}
+    files = [open(run_path, 'r') for run_path in run_paths]
+    try:
+        with open(new_snapshot_path, 'w') as snapshot_file, \
+             open(output_path if os.path.exists(output_path) else os.devnull, 'r') as old_file, \
+             open(added_path, 'w') as added_file, \
+             open(removed_path, 'w') as removed_file:
+
+            def write_snapshot(lines):
+                for line in lines:
+                    snapshot_file.write(line)
+                    yield line.rstrip('\n')
+
+            new_domains = write_snapshot(iter_merged_runs(files))
+            old_domains = (line.rstrip('\n') for line in old_file)
+            outputs = {'added': added_file, 'removed': removed_file}
+            for change, domain in diff_sorted_domains(new_domains, old_domains):
+                outputs[change].write(f"{domain}\n")
+                counts[change] += 1
+    except BaseException:
+        os.remove(new_snapshot_path)
+        raise
+    finally:
+        for file in files:
+            file.close()
+
+    # Only replace the previous snapshot once the diff has been written in full
+    os.replace(new_snapshot_path, output_path)
+    return counts
+
+def find_chunk_boundaries(filename, num_chunks):
+    """Split a file into (start, end) byte ranges that begin and end on line boundaries."""
+    file_size = os.path.getsize(filename)
+    if file_size == 0:
+        return []
+
+    chunk_size = max(1, file_size // num_chunks)
+    boundaries = [0]
+    with open(filename, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            position = chunk_size
+            while position < file_size:
+                newline = mm.find(b'\n', position)
+                if newline == -1 or newline + 1 >= file_size:
+                    break
+                boundaries.append(newline + 1)
+                position = newline + 1 + chunk_size
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def extract_domains_from_range(filename, start, end, run_directory=None):
+    """Extract second-level domains from one byte range of a memory-mapped zone file.
+
+    If run_directory is given, the domains are spilled there as a sorted run and its path is returned instead.
+    """
+    domains = set()
+    previous_owner = None
+    with open(filename, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Walk the range a line at a time rather than copying all of it out of the map
+            position = start
+            while position < end:
+                newline = mm.find(b'\n', position, end)
+                if newline == -1:
+                    newline = end
+                line_start, position = position, newline + 1
+                # Blank and continuation lines start with whitespace and reuse the previous owner
+                if line_start == newline or mm[line_start] in b' \t\r':
+                    continue
+                owner = mm[line_start:newline].split(None, 1)[0]
+                # Most records are NS/DS lines repeating the owner of the line before
+                if owner == previous_owner:
+                    continue
+                previous_owner = owner
+                domain = owner.rstrip(b'.')  # Remove periods from the end
+                if domain.count(b'.') == 1:  # Check if it's not a subdomain
+                    domains.add(domain.decode())
+    if run_directory is not None:
+        return spill_run(domains, run_directory)
+    return domains
+
+def extract_domains_from_file_parallel(filename, num_workers=NUM_WORKERS):
+    """Extract domains from a zone file by parsing line-aligned byte ranges in a process pool."""
+    print(f"Extracting domains from {filename} with {num_workers} workers...")
+    ranges = find_chunk_boundaries(filename, num_workers * CHUNKS_PER_WORKER)
+
+    domains = set()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(extract_domains_from_range, filename, start, end) for start, end in ranges]
+        for future in futures:
+            domains.update(future.result())
     return domains
 
+def extract_sorted_runs_from_file(filename, run_directory, num_workers=NUM_WORKERS, max_memory_mb=MAX_MEMORY_MB):
+    """Extract domains from a zone file into sorted runs on disk, keeping memory under max_memory_mb."""
+    print(f"Extracting domains from {filename} into sorted runs...")
+    if filename.endswith(COMPRESSED_EXTENSIONS) or not USE_PARALLEL_PARSER:
+        # Compressed streams can't be memory-mapped or split, so they are parsed sequentially
+        return write_sorted_runs(iter_domains_from_file(filename), run_directory,
+                                 max_domains_in_memory(max_memory_mb))
+
+    # Size ranges so that all workers' sets together stay under the memory ceiling; a zone line
+    # takes about as many bytes on disk as its domain does in memory once repeated owners are dropped
+    max_range_bytes = max(1, max_memory_mb * 1024 * 1024 // num_workers)
+    num_chunks = max(num_workers * CHUNKS_PER_WORKER, -(-os.path.getsize(filename) // max_range_bytes))
+    ranges = find_chunk_boundaries(filename, num_chunks)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(extract_domains_from_range, filename, start, end, run_directory) for start, end in ranges]
+        return [future.result() for future in futures]
+
 def main():
     input_directory = 'data/icann_zone_requests/'
     input_files = ['com.txt', 'info.txt', 'net.txt', 'org.txt']
 
+    output_directory = 'data/raw/'
+    output_filename = 'unique_domains.txt'
+
+    if USE_ZONE_DIFF and not USE_EXTERNAL_SORT:
+        # The diff is taken while merging the sorted runs, which only the external sort produces
+        raise ValueError("USE_ZONE_DIFF needs USE_EXTERNAL_SORT; enable both to write the added and removed domains")
+
+    if USE_EXTERNAL_SORT:
+        # Spill sorted runs next to the output and merge them into a sorted unique_domains.txt
+        with tempfile.TemporaryDirectory(dir=output_directory) as run_directory:
+            run_paths = []
+            for filename in input_files:
+                full_path = resolve_zone_file(input_directory, filename)
+                run_paths.extend(extract_sorted_runs_from_file(full_path, run_directory))
+            print(f"Merging {len(run_paths)} sorted runs...")
+            if USE_ZONE_DIFF:
+                output_path = os.path.join(output_directory, output_filename)
+                added_path = os.path.join(output_directory, 'domains_added.txt')
+                removed_path = os.path.join(output_directory, 'domains_removed.txt')
+                previous_snapshot = file_fingerprint(output_path) if os.path.exists(output_path) else None
+                counts = merge_sorted_runs_with_diff(run_paths, output_path, run_directory, added_path, removed_path)
+                print(f"{counts['added']} added domains saved to '{added_path}'")
+                print(f"{counts['removed']} removed domains saved to '{removed_path}'")
+
+                # Record which snapshots the delta sits between so candidate_store.py only applies it once
+                with open(os.path.join(output_directory, 'domains_diff.json'), 'w') as diff_file:
+                    json.dump({'previous_snapshot': previous_snapshot, 'snapshot': file_fingerprint(output_path),
+                               'added': added_path, 'removed': removed_path}, diff_file, indent=4)
+            else:
+                merge_sorted_runs(run_paths, os.path.join(output_directory, output_filename), run_directory)
+        print(f"Unique domain addresses have been saved to '{os.path.join(output_directory, output_filename)}'")
+        return
+
     unique_domains = set()
 
     for filename in input_files:
-        full_path = os.path.join(input_directory, filename)
-        domains = extract_domains_from_file(full_path)
+        full_path = resolve_zone_file(input_directory, filename)
+        if USE_PARALLEL_PARSER and not full_path.endswith(COMPRESSED_EXTENSIONS):
+            domains = extract_domains_from_file_parallel(full_path)
+        else:
+            domains = extract_domains_from_file(full_path)
         unique_domains.update(domains)
 
-    output_directory = 'data/raw/'
-    output_filename = 'unique_domains.txt'
-
     with open(os.path.join(output_directory, output_filename), 'w') as output_file:
         for domain in unique_domains:
             output_file.write(f"{domain}\n")
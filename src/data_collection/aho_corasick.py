@@ -0,0 +1,57 @@
+from collections import deque
+
+class AhoCorasick:
+    """Multi-pattern substring matcher that finds every pattern contained in a text in one scan."""
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        self.matches_empty = '' in self.patterns
+
+        for index, pattern in enumerate(self.patterns):
+            if pattern:
+                self._add_pattern(index, pattern)
+        self._build_failure_links()
+
+    def _add_pattern(self, index, pattern):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+                self.goto[state][char] = next_state
+            state = next_state
+        self.output[state] += (index,)
+
+    def _build_failure_links(self):
+        """Breadth-first pass that sets each state's failure link and merges in the outputs it inherits."""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def find_all(self, text):
+        """Return the set of pattern indices that occur in text."""
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        if self.matches_empty:
+            found.update(index for index, pattern in enumerate(self.patterns) if not pattern)
+        return found
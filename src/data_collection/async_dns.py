@@ -0,0 +1,234 @@
+import os
+import random
+import socket
+import asyncio
+import dns.asyncquery
+import dns.exception
+import dns.flags
+import dns.inet
+import dns.message
+import dns.rcode
+import dns.resolver
+
+from dns_cache import dns_cache, negative_ttl, NEGATIVE_TTL
+from record_store import make_domain_folder
+from scrape_metrics import metrics, status_outcome, StageError
+from webscraper_helper import RECORD_TYPES, DNS_ERRORS, save_dns_and_ip_info
+from ip_enrichment import EnrichmentBatcher, record_addresses
+
+MAX_IN_FLIGHT = 2000  # DNS queries outstanding at once across all domains
+NUM_SOCKETS = 16  # Long-lived UDP sockets the queries are multiplexed over
+DNS_TIMEOUT = 5
+DNS_LIFETIME = 15
+DNS_PORT = 53
+
+class DnsSocket(asyncio.DatagramProtocol):
+    """One UDP socket shared by many outstanding queries, matched to their responses by query id."""
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        try:
+            response = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return
+        pending = self.pending.get(response.id)
+        if pending is None:
+            return
+        request, nameserver, future = pending
+        # Ignore late answers to earlier attempts and anything not from the server we asked
+        if address[0] == nameserver and request.is_response(response) and not future.done():
+            future.set_result(response)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        for _, _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("DNS socket closed"))
+
+    def new_query_id(self):
+        while True:
+            query_id = random.randint(0, 65535)
+            if query_id not in self.pending:
+                return query_id
+
+class AsyncDnsClient:
+    """Stub resolver that keeps thousands of queries in flight over a handful of reused UDP sockets.
+
+    Truncated answers are retried over TCP, timeouts move on to the next nameserver until the
+    lifetime runs out, and answers follow CNAME chains the same way dns.resolver does.
+    """
+
+    def __init__(self, nameservers=None, num_sockets=NUM_SOCKETS, max_in_flight=MAX_IN_FLIGHT,
+                 timeout=DNS_TIMEOUT, lifetime=DNS_LIFETIME, port=DNS_PORT, cache=dns_cache):
+        self.nameservers = list(nameservers or dns.resolver.Resolver().nameservers)
+        self.port = port
+        self.cache = cache
+        self.num_sockets = num_sockets
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.sockets = {}
+        self.next_socket = 0
+        self.next_nameserver = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for family in {dns.inet.af_for_address(nameserver) for nameserver in self.nameservers}:
+            local_address = ('0.0.0.0', 0) if family == socket.AF_INET else ('::', 0)
+            self.sockets[family] = []
+            for _ in range(self.num_sockets):
+                _, protocol = await loop.create_datagram_endpoint(DnsSocket, local_addr=local_address, family=family)
+                self.sockets[family].append(protocol)
+
+    def close(self):
+        for protocols in self.sockets.values():
+            for protocol in protocols:
+                protocol.transport.close()
+        self.sockets = {}
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def _udp_exchange(self, request, nameserver, timeout):
+        protocols = self.sockets[dns.inet.af_for_address(nameserver)]
+        protocol = protocols[self.next_socket % len(protocols)]
+        self.next_socket += 1
+
+        request.id = protocol.new_query_id()
+        future = asyncio.get_running_loop().create_future()
+        protocol.pending[request.id] = (request, nameserver, future)
+        try:
+            protocol.transport.sendto(request.to_wire(), (nameserver, self.port))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            protocol.pending.pop(request.id, None)
+
+    async def query(self, name, record_type):
+        """Resolve one record type and return (status, records), status being 'ok' or a DNS_ERRORS key."""
+        if self.cache is not None:
+            cached = self.cache.get(name, record_type)
+            if cached is not None:
+                return cached
+        status, records, ttl = await self._resolve(name, record_type)
+        if self.cache is not None:
+            self.cache.put(name, record_type, status, records, ttl)
+        return status, records
+
+    @metrics.timed('dns', status_outcome)
+    async def _resolve(self, name, record_type):
+        """Ask the nameservers and return (status, records, ttl)."""
+        async with self.in_flight:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.lifetime
+            request = dns.message.make_query(name, record_type)
+            # Spread queries over the nameservers and move on to the next one after each failure
+            self.next_nameserver += 1
+            attempt = self.next_nameserver
+            failed_nameservers = set()
+
+            while loop.time() < deadline:
+                remaining = deadline - loop.time()
+                nameserver = self.nameservers[attempt % len(self.nameservers)]
+                attempt += 1
+                if nameserver in failed_nameservers:
+                    continue
+                try:
+                    response = await self._udp_exchange(request, nameserver, min(self.timeout, remaining))
+                    if response.flags & dns.flags.TC:
+                        response = await dns.asyncquery.tcp(request, nameserver, timeout=min(self.timeout, remaining), port=self.port)
+                except (asyncio.TimeoutError, dns.exception.DNSException, OSError):
+                    continue
+
+                rcode = response.rcode()
+                if rcode == dns.rcode.NXDOMAIN:
+                    # Records of a CNAME chain whose target does not exist, which the cache keeps per record type
+                    chain = [str(rdata) for rrset in response.answer for rdata in rrset]
+                    return 'nxdomain', chain or None, negative_ttl(response)
+                if rcode != dns.rcode.NOERROR:
+                    # SERVFAIL, REFUSED and friends: this server can't help, like dns.resolver's NoNameservers
+                    failed_nameservers.add(nameserver)
+                    if len(failed_nameservers) == len(set(self.nameservers)):
+                        return 'no_nameservers', None, NEGATIVE_TTL
+                    continue
+
+                # minimum_ttl covers the CNAME chain, or the SOA minimum for an empty answer
+                chain = response.resolve_chaining()
+                if chain.answer is None:
+                    return 'no_answer', None, chain.minimum_ttl
+                return 'ok', [str(rdata) for rdata in chain.answer], chain.minimum_ttl
+            return 'timeout', None, 0
+
+async def resolve_dns_records(client, domain):
+    """Query every record type for a domain and return them in the .dns.json layout.
+
+    A is asked on its own first; an NXDOMAIN then answers the other types from the cache.
+    """
+    first = await client.query(domain, RECORD_TYPES[0])
+    results = [first] + await asyncio.gather(*(client.query(domain, record_type) for record_type in RECORD_TYPES[1:]))
+    dns_records = {}
+    for record_type, (status, records) in zip(RECORD_TYPES, results):
+        dns_records[record_type] = records if status == 'ok' else DNS_ERRORS[status]
+    return dns_records
+
+async def gather_and_save_dns_and_ip_info_async(client, domain, domain_folder, enrichment=None):
+    """Async counterpart of gather_and_save_dns_and_ip_info, writing the same .dns.json file.
+
+    With an EnrichmentBatcher, the addresses are enriched together with those of other domains resolved at the same time.
+    """
+    dns_records = await resolve_dns_records(client, domain)
+    ip_info = await enrichment.enrich(dns_records) if enrichment and record_addresses(dns_records) else None
+    return save_dns_and_ip_info(domain, domain_folder, dns_records, ip_info)
+
+async def run_bounded(coroutine_function, items, concurrency):
+    """Await coroutine_function(item) for every item with at most concurrency running, pulling items lazily."""
+    iterator = iter(items)
+
+    async def worker():
+        for item in iterator:
+            await coroutine_function(item)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+async def collect_dns(domains, base_dir, on_result=None, max_in_flight=MAX_IN_FLIGHT, finished_result=None,
+                      controller=None):
+    """Resolve and save DNS records for (trademark, domain) pairs, calling on_result(trademark, domain, ip_address, error_message, verdict).
+
+    finished_result(trademark, domain) may return (ip_address, error_message, verdict) from an earlier run to skip the lookup.
+    With a ConcurrencyController, it decides how many domains are resolved at once.
+    """
+    enrichment = EnrichmentBatcher()
+    async with AsyncDnsClient(max_in_flight=max_in_flight) as client:
+        async def handle(candidate):
+            trademark, domain = candidate
+            domain_folder = os.path.join(base_dir, trademark, domain)
+            make_domain_folder(domain_folder)
+            result = finished_result(trademark, domain) if finished_result else None
+            try:
+                if result is None and controller:
+                    result = await controller.call_async('dns', gather_and_save_dns_and_ip_info_async,
+                                                         client, domain, domain_folder, enrichment)
+                elif result is None:
+                    result = await gather_and_save_dns_and_ip_info_async(client, domain, domain_folder, enrichment)
+                ip_address, error_message, verdict = result
+            except Exception as e:
+                ip_address, error_message, verdict = None, StageError.from_exception(f"DNS collection failed for {domain}: {e}\n", e), None
+            if on_result:
+                await on_result(trademark, domain, ip_address, error_message, verdict)
+
+        # Enough domains in flight to keep every query slot busy, or to reach the controller's highest limit
+        concurrency = max(1, 2 * max_in_flight // len(RECORD_TYPES))
+        if controller:
+            concurrency = max(concurrency, controller.stages['dns'].maximum)
+        await run_bounded(handle, domains, concurrency)
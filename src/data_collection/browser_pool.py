@@ -0,0 +1,177 @@
+import os
+import time
+import queue
+import threading
+from urllib.parse import urlsplit
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException, InvalidSessionIdException
+
+NUM_BROWSERS = os.cpu_count() or 1
+MAX_PAGES_PER_BROWSER = 200  # Restart a browser after this many pages...
+MAX_BROWSER_MEMORY_MB = 1500  # ...or once Chrome and its renderers use more memory than this
+PAGE_LOAD_TIMEOUT = 30
+QUEUE_SIZE_PER_BROWSER = 4
+
+def process_tree_rss_mb(pid):
+    """Resident memory of a process and all its descendants in MB, from /proc; None where there is no /proc."""
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    rss_pages = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as stat_file:
+                # The command name may contain spaces, so split after its closing parenthesis
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        rss_pages[int(entry)] = int(fields[21])
+
+    total_pages = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total_pages += rss_pages.get(current, 0)
+        stack.extend(children.get(current, []))
+    return total_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+def url_origin(url):
+    """scheme://host[:port] of an http(s) URL, or None for pages such as about:blank."""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        return None
+    return f"{parts.scheme}://{parts.netloc}"
+
+def browser_options():
+    options = Options()
+    options.add_argument('--headless=new')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+    return options
+
+class PooledBrowser:
+    """One long-lived headless Chrome that is restarted after too many pages or too much memory."""
+
+    def __init__(self, max_pages=MAX_PAGES_PER_BROWSER, max_memory_mb=MAX_BROWSER_MEMORY_MB,
+                 page_load_timeout=PAGE_LOAD_TIMEOUT):
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self.page_load_timeout = page_load_timeout
+        self.driver = None
+        self.pages = 0
+        self.restarts = 0
+
+    def get(self):
+        """Return a clean browser, starting or restarting Chrome when needed."""
+        if self.driver is not None and self._needs_restart():
+            self.quit()
+            self.restarts += 1
+        if self.driver is None:
+            self.driver = webdriver.Chrome(options=browser_options())
+            self.driver.set_page_load_timeout(self.page_load_timeout)
+            self.pages = 0
+        return self.driver
+
+    def _needs_restart(self):
+        if self.pages >= self.max_pages:
+            return True
+        memory_mb = process_tree_rss_mb(self.driver.service.process.pid)
+        return memory_mb is not None and memory_mb > self.max_memory_mb
+
+    def reset(self):
+        """Clear everything the last site left behind so it cannot affect the next one."""
+        self.pages += 1
+        driver = self.driver
+        if driver is None:
+            return
+        try:
+            # Close popups and extra tabs the page opened, noting the origins they stored data for
+            origins = set()
+            for handle in driver.window_handles[1:]:
+                driver.switch_to.window(handle)
+                origins.add(url_origin(driver.current_url))
+                driver.close()
+            driver.switch_to.window(driver.window_handles[0])
+            origins.add(url_origin(driver.current_url))
+            # Cleared before navigating away, while the visited origins are still known
+            driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+            for origin in origins - {None}:
+                driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+            driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+            driver.get('about:blank')
+        except WebDriverException:
+            # A browser that cannot even be reset is started afresh
+            self.quit()
+
+    def quit(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except WebDriverException:
+                pass
+            self.driver = None
+
+class BrowserPool:
+    """N headless browsers working through a queue of tasks in parallel.
+
+    visit(browser, task) is called for each task on one of the pool's threads with a freshly reset
+    Chrome; tasks are read from the iterator only as fast as the browsers get through them.
+    """
+
+    def __init__(self, num_browsers=NUM_BROWSERS, max_pages=MAX_PAGES_PER_BROWSER,
+                 max_memory_mb=MAX_BROWSER_MEMORY_MB, page_load_timeout=PAGE_LOAD_TIMEOUT):
+        self.num_browsers = num_browsers
+        self.browser_settings = {'max_pages': max_pages, 'max_memory_mb': max_memory_mb,
+                                 'page_load_timeout': page_load_timeout}
+        self.pages = 0
+        self.restarts = 0
+        self.lock = threading.Lock()
+
+    def _work(self, tasks, visit):
+        browser = PooledBrowser(**self.browser_settings)
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                try:
+                    visit(browser.get(), task)
+                except InvalidSessionIdException:
+                    browser.quit()  # Chrome crashed; the next task starts a new one
+                except Exception as e:
+                    print(f"Browser task {task} failed: {e}")
+                finally:
+                    browser.reset()
+                    with self.lock:
+                        self.pages += 1
+        finally:
+            with self.lock:
+                self.restarts += browser.restarts
+            browser.quit()
+
+    def run(self, tasks, visit):
+        """Call visit(browser, task) for every task; returns the number of tasks."""
+        task_queue = queue.Queue(maxsize=self.num_browsers * QUEUE_SIZE_PER_BROWSER)
+        workers = [threading.Thread(target=self._work, args=(task_queue, visit), daemon=True)
+                   for _ in range(self.num_browsers)]
+        for worker in workers:
+            worker.start()
+
+        start_time = time.time()
+        num_tasks = 0
+        for task in tasks:
+            task_queue.put(task)
+            num_tasks += 1
+        for _ in workers:
+            task_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+        elapsed = time.time() - start_time
+        print(f"Browser pool visited {self.pages} pages in {elapsed:.1f} s with {self.num_browsers} browsers "
+              f"({self.restarts} restarts)")
+        return num_tasks
@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+
+ROW_GROUP_SIZE = 1024 * 1024
+READ_BATCH_SIZE = 64 * 1024
+CONVERT_BLOCK_SIZE = 64 * 1024 * 1024  # Bytes of JSON Lines parsed at a time by convert_candidates
+
+# pyarrow is imported where Parquet is read or written, so JSON and JSON Lines candidate files work without it
+
+def candidate_schema():
+    """Parquet schema of a candidate file; trademark and match type repeat across millions of rows, so they are dictionary-encoded."""
+    import pyarrow as pa
+    return pa.schema([
+        ('trademark', pa.dictionary(pa.int32(), pa.string())),
+        ('domain', pa.string()),
+        ('match_type', pa.dictionary(pa.int8(), pa.string())),
+    ])
+
+class CandidateTable:
+    """Read-only access to a Parquet candidate file with filters pushed down to the Parquet reader.
+
+    trademarks and match_types arguments restrict the rows read; files written by find_candidates
+    with USE_PARQUET_OUTPUT are sorted by trademark, so trademark filters skip whole row groups.
+    """
+
+    def __init__(self, filepath):
+        import pyarrow.dataset as ds
+        self.filepath = filepath
+        file_format = ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=['trademark', 'match_type']))
+        self.dataset = ds.dataset(filepath, format=file_format)
+
+    def _filter(self, trademarks=None, match_types=None):
+        import pyarrow.dataset as ds
+        expression = None
+        for column, values in (('trademark', trademarks), ('match_type', match_types)):
+            if values is not None:
+                condition = ds.field(column).isin(list(values))
+                expression = condition if expression is None else expression & condition
+        return expression
+
+    def count(self, trademarks=None, match_types=None):
+        """Number of candidates, answered from the file metadata when there is no filter."""
+        return self.dataset.count_rows(filter=self._filter(trademarks, match_types))
+
+    def counts_by_trademark(self, match_types=None):
+        """Return {trademark: number of candidates}."""
+        import pyarrow.compute as pc
+        table = self.dataset.to_table(columns=['trademark'], filter=self._filter(match_types=match_types))
+        counts = pc.value_counts(table['trademark'].combine_chunks().dictionary_decode())
+        return {item['values'].as_py(): item['counts'].as_py() for item in counts}
+
+    def iter_batches(self, trademarks=None, match_types=None, columns=None, batch_size=READ_BATCH_SIZE):
+        """Yield pyarrow RecordBatches of at most batch_size candidates."""
+        yield from self.dataset.to_batches(columns=columns, filter=self._filter(trademarks, match_types),
+                                           batch_size=batch_size)
+
+    def iter_candidates(self, trademarks=None, match_types=None):
+        for batch in self.iter_batches(trademarks, match_types):
+            yield from batch.to_pylist()
+
+def find_candidate_file(basename):
+    """Return the candidate file for basename, preferring Parquet, then JSON Lines, then the older JSON."""
+    for extension in ('.parquet', '.jsonl'):
+        if os.path.exists(basename + extension):
+            return basename + extension
+    return basename + '.json'
+
+def iter_candidates(filepath):
+    """Yield candidate records ({'trademark', 'domain', 'match_type'}) from a candidate file.
+
+    Parquet (.parquet) and JSON Lines (.jsonl) files are read lazily; the older
+    {trademark: [domains]} JSON files still have to be loaded in full and only
+    ever hold exact substring matches.
+    """
+    if filepath.endswith('.parquet'):
+        yield from CandidateTable(filepath).iter_candidates()
+    elif filepath.endswith('.jsonl'):
+        with open(filepath, 'r') as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    record.setdefault('match_type', 'exact')
+                    yield record
+    else:
+        with open(filepath, 'r') as file:
+            data = json.load(file)
+        for trademark, domains in data.items():
+            for domain in domains:
+                yield {'trademark': trademark, 'domain': domain, 'match_type': 'exact'}
+
+def iter_candidate_pairs(filepath):
+    """Yield (trademark, domain) pairs from a candidate file."""
+    if filepath.endswith('.parquet'):
+        for batch in CandidateTable(filepath).iter_batches(columns=['trademark', 'domain']):
+            yield from zip(batch.column('trademark').to_pylist(), batch.column('domain').to_pylist())
+        return
+    for record in iter_candidates(filepath):
+        yield record['trademark'], record['domain']
+
+def merge_candidates(input_path, output_path, candidates):
+    """Write the exact matches of input_path and then candidates, a {(trademark, domain): match_type} dict, to output_path.
+
+    Matches of other types already in input_path are replaced, so merging again does not repeat them, and
+    candidates that are also exact matches are left out. output_path may be input_path, but not a .json file,
+    which cannot hold match types.
+    """
+    if not output_path.endswith(('.jsonl', '.parquet')):
+        raise ValueError(f"Can only merge into JSON Lines or Parquet candidate files, not {output_path}")
+    candidates = dict(candidates)
+    base, extension = os.path.splitext(output_path)
+    temporary_path = base + '.merging' + extension
+    num_exact = 0
+    with CandidateWriter(temporary_path) as writer:
+        if input_path.endswith('.parquet') and writer.format == 'parquet':
+            for batch in CandidateTable(input_path).iter_batches(match_types=['exact']):
+                for pair in zip(batch.column('trademark').to_pylist(), batch.column('domain').to_pylist()):
+                    candidates.pop(pair, None)
+                writer.write_batch(batch)
+                num_exact += batch.num_rows
+        else:
+            for candidate in iter_candidates(input_path):
+                if candidate['match_type'] == 'exact':
+                    candidates.pop((candidate['trademark'], candidate['domain']), None)
+                    writer.write(candidate['trademark'], candidate['domain'])
+                    num_exact += 1
+        for (trademark, domain), match_type in candidates.items():
+            writer.write(trademark, domain, match_type)
+    os.replace(temporary_path, output_path)
+    print(f"Merged {len(candidates)} candidates into the {num_exact} exact matches of {input_path} in {output_path}")
+
+def convert_candidates(input_path, output_path, block_size=CONVERT_BLOCK_SIZE):
+    """Convert a JSON Lines candidate file into a Parquet file, block_size bytes of it at a time.
+
+    Rows keep the order of the JSON Lines file; find_candidates can write Parquet sorted by trademark directly.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.json as pa_json
+    fields = [pa.field(name, pa.string()) for name in ('trademark', 'domain', 'match_type')]
+    reader = pa_json.open_json(input_path, read_options=pa_json.ReadOptions(block_size=block_size),
+                               parse_options=pa_json.ParseOptions(explicit_schema=pa.schema(fields),
+                                                                  unexpected_field_behavior='ignore'))
+    num_candidates = 0
+    with CandidateWriter(output_path) as writer:
+        for batch in reader:
+            # Lines without a match type are exact matches, as iter_candidates reads them
+            match_types = pc.fill_null(batch.column('match_type'), 'exact')
+            writer.write_batch(pa.RecordBatch.from_arrays([batch.column('trademark'), batch.column('domain'), match_types],
+                                                          names=['trademark', 'domain', 'match_type']))
+            num_candidates += batch.num_rows
+    print(f"Converted {num_candidates} candidates from {input_path} to {output_path}")
+
+class CandidateWriter:
+    """Write (trademark, domain) pairs to a candidate file in the format given by its extension."""
+
+    def __init__(self, filepath, append=False):
+        self.filepath = filepath
+        self.format = 'parquet' if filepath.endswith('.parquet') else 'jsonl' if filepath.endswith('.jsonl') else 'json'
+        if append and self.format != 'jsonl':
+            raise ValueError(f"Can only append to JSON Lines candidate files, not {filepath}")
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            self.schema = candidate_schema()
+            self.file = pq.ParquetWriter(filepath, self.schema)
+            self.batch = {'trademark': [], 'domain': [], 'match_type': []}
+        else:
+            self.file = open(filepath, 'a' if append else 'w')
+        self.matches = {}
+
+    def add_trademark(self, trademark):
+        """Make sure a trademark is listed even if it has no matches (JSON output only)."""
+        if self.format == 'json':
+            self.matches.setdefault(trademark, [])
+
+    def write(self, trademark, domain, match_type='exact'):
+        if self.format == 'jsonl':
+            record = {'trademark': trademark, 'domain': domain, 'match_type': match_type}
+            self.file.write(json.dumps(record) + '\n')
+        elif self.format == 'parquet':
+            self.batch['trademark'].append(trademark)
+            self.batch['domain'].append(domain)
+            self.batch['match_type'].append(match_type)
+            if len(self.batch['domain']) >= ROW_GROUP_SIZE:
+                self._flush_batch()
+        else:
+            self.matches.setdefault(trademark, []).append(domain)
+
+    def write_batch(self, batch):
+        """Write a pyarrow RecordBatch of candidates, such as one read from a CandidateTable (Parquet output only)."""
+        self._flush_batch()
+        self.file.write_batch(batch.select(self.schema.names).cast(self.schema))
+
+    def _flush_batch(self):
+        if self.batch['domain']:
+            import pyarrow as pa
+            self.file.write_table(pa.Table.from_pydict(self.batch).cast(self.schema))
+            self.batch = {'trademark': [], 'domain': [], 'match_type': []}
+
+    def close(self):
+        if self.format == 'json':
+            json.dump(self.matches, self.file, indent=4)
+        elif self.format == 'parquet':
+            self._flush_batch()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def main():
+    if len(sys.argv) != 3 or not sys.argv[2].endswith('.parquet'):
+        print("Usage: python candidate_io.py <candidates.jsonl> <candidates.parquet>")
+        sys.exit(1)
+    convert_candidates(sys.argv[1], sys.argv[2])
+
+if __name__ == "__main__":
+    main()
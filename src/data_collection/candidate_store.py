@@ -0,0 +1,175 @@
+import os
+import json
+import argparse
+
+from aho_corasick import AhoCorasick
+from aggregate_icann_domains import file_fingerprint
+from candidate_io import CandidateWriter, iter_candidates
+from domain_index import DomainIndex
+from find_candidates import (load_trademarks_from_csv, iter_domains_from_txt, find_matching_domains_parallel,
+                             write_summary_statistics)
+
+STORE_DIRECTORY = 'data/raw/candidate_store/'
+TRADEMARKS_CSV_PATH = 'data/raw/combined_trademarks_list_full.csv'
+DOMAINS_TXT_PATH = 'data/raw/unique_domains.txt'
+DOMAINS_DIFF_PATH = 'data/raw/domains_diff.json'  # Written by aggregate_icann_domains.py with USE_ZONE_DIFF
+SUMMARY_CSV_PATH = 'data/raw/summary_statistics.csv'
+
+def candidates_path(store_directory, generation):
+    """Candidates are rewritten to a new generation file whenever matches have to be dropped."""
+    return os.path.join(store_directory, f"candidates-{generation:06d}.jsonl")
+
+def load_manifest(store_directory):
+    with open(os.path.join(store_directory, 'manifest.json'), 'r') as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(store_directory, manifest):
+    """Write the manifest atomically; it is what marks a refresh as complete."""
+    manifest_path = os.path.join(store_directory, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def match_against_corpus(trademarks, domains_txt_path):
+    """Match trademarks against every domain, through the suffix array index when it is up to date."""
+    try:
+        index = DomainIndex(domains_txt_path=domains_txt_path)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Suffix index unavailable ({e}), scanning {domains_txt_path} instead")
+        return find_matching_domains_parallel(trademarks, domains_txt_path)
+
+    matches = {}
+    for trademark in trademarks:
+        matches[trademark] = index.find_domains(trademark)
+        print(f"Found {len(matches[trademark])} matching domains for trademark: {trademark}")
+    index.close()
+    return matches
+
+def match_against_domains(trademarks, domains):
+    """Yield (trademark, domain) for every trademark contained in a small set of domains."""
+    automaton = AhoCorasick(trademarks)
+    for domain in domains:
+        for index in sorted(automaton.find_all(domain)):
+            yield trademarks[index], domain
+
+def init_store(store_directory=STORE_DIRECTORY, trademarks_csv_path=TRADEMARKS_CSV_PATH,
+               domains_txt_path=DOMAINS_TXT_PATH, summary_csv_path=SUMMARY_CSV_PATH):
+    """Match every trademark against every domain and record which inputs produced the result."""
+    os.makedirs(store_directory, exist_ok=True)
+    trademarks = list(dict.fromkeys(load_trademarks_from_csv(trademarks_csv_path)))
+    matching_domains = match_against_corpus(trademarks, domains_txt_path)
+
+    summary_statistics = {}
+    with CandidateWriter(candidates_path(store_directory, 0)) as writer:
+        for trademark in trademarks:
+            for domain in matching_domains[trademark]:
+                writer.write(trademark, domain)
+            summary_statistics[trademark] = len(matching_domains[trademark])
+    write_summary_statistics(summary_statistics, summary_csv_path)
+
+    save_manifest(store_directory, {
+        'trademarks': trademarks,
+        'trademark_list': file_fingerprint(trademarks_csv_path),
+        'domains_snapshot': file_fingerprint(domains_txt_path),
+        'generation': 0,
+        'candidates_size': os.path.getsize(candidates_path(store_directory, 0)),
+        'summary_statistics': summary_statistics,
+    })
+    print(f"Candidate store initialized in {store_directory}")
+
+def refresh_store(store_directory=STORE_DIRECTORY, trademarks_csv_path=TRADEMARKS_CSV_PATH,
+                  domains_txt_path=DOMAINS_TXT_PATH, domains_diff_path=DOMAINS_DIFF_PATH,
+                  summary_csv_path=SUMMARY_CSV_PATH):
+    """Bring the store up to date with the current trademark list and domain snapshot.
+
+    Only new trademarks are matched against the whole corpus; trademarks already in the store are
+    matched against the domains added since the stored snapshot, and candidates for removed domains
+    or trademarks are dropped.
+    """
+    manifest = load_manifest(store_directory)
+    store_candidates_path = candidates_path(store_directory, manifest['generation'])
+
+    # Roll back anything appended by a refresh that crashed before saving its manifest
+    with open(store_candidates_path, 'r+') as candidates_file:
+        candidates_file.truncate(manifest['candidates_size'])
+
+    trademarks = list(dict.fromkeys(load_trademarks_from_csv(trademarks_csv_path)))
+    current_trademarks = set(trademarks)
+    known_trademarks = set(manifest['trademarks'])
+    stored_trademarks = [trademark for trademark in manifest['trademarks'] if trademark in current_trademarks]
+    new_trademarks = [trademark for trademark in trademarks if trademark not in known_trademarks]
+    dropped_trademarks = known_trademarks - current_trademarks
+
+    snapshot = file_fingerprint(domains_txt_path)
+    added_domains_path = None
+    removed_domains = set()
+    if snapshot != manifest['domains_snapshot']:
+        diff = {}
+        if os.path.exists(domains_diff_path):
+            with open(domains_diff_path, 'r') as diff_file:
+                diff = json.load(diff_file)
+        if diff.get('previous_snapshot') != manifest['domains_snapshot'] or diff.get('snapshot') != snapshot:
+            raise ValueError(f"{domains_diff_path} does not lead from the stored snapshot to {domains_txt_path}; "
+                             f"rebuild the store with 'candidate_store.py init'")
+        added_domains_path = diff['added']
+        removed_domains = set(iter_domains_from_txt(diff['removed']))
+
+    print(f"Refreshing candidates: {len(new_trademarks)} new trademarks, {len(dropped_trademarks)} dropped trademarks, "
+          f"{len(removed_domains)} removed domains, added domains from {added_domains_path}")
+
+    summary_statistics = dict(manifest['summary_statistics'])
+    manifest_generation = generation = manifest['generation']
+
+    if removed_domains or dropped_trademarks:
+        # Dropping matches means rewriting; the new generation only takes over once the manifest points at it
+        generation += 1
+        with CandidateWriter(candidates_path(store_directory, generation)) as writer:
+            for candidate in iter_candidates(store_candidates_path):
+                if candidate['trademark'] in dropped_trademarks:
+                    continue
+                if candidate['domain'] in removed_domains:
+                    summary_statistics[candidate['trademark']] -= 1
+                    continue
+                writer.write(candidate['trademark'], candidate['domain'], candidate['match_type'])
+
+    with CandidateWriter(candidates_path(store_directory, generation), append=True) as writer:
+        if new_trademarks:
+            matching_domains = match_against_corpus(new_trademarks, domains_txt_path)
+            for trademark in new_trademarks:
+                for domain in matching_domains[trademark]:
+                    writer.write(trademark, domain)
+                summary_statistics[trademark] = len(matching_domains[trademark])
+
+        if added_domains_path and stored_trademarks:
+            for trademark, domain in match_against_domains(stored_trademarks, iter_domains_from_txt(added_domains_path)):
+                writer.write(trademark, domain)
+                summary_statistics[trademark] += 1
+
+    summary_statistics = {trademark: summary_statistics[trademark] for trademark in trademarks}
+    manifest.update({
+        'trademarks': trademarks,
+        'trademark_list': file_fingerprint(trademarks_csv_path),
+        'domains_snapshot': snapshot,
+        'generation': generation,
+        'candidates_size': os.path.getsize(candidates_path(store_directory, generation)),
+        'summary_statistics': summary_statistics,
+    })
+    save_manifest(store_directory, manifest)
+    if generation != manifest_generation:
+        os.remove(store_candidates_path)
+
+    write_summary_statistics(summary_statistics, summary_csv_path)
+    print(f"Candidate store in {store_directory} is up to date")
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep candidate matches up to date as trademarks and zone snapshots change")
+    parser.add_argument('command', choices=['init', 'refresh'])
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        init_store()
+    else:
+        refresh_store()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import time
+import asyncio
+import threading
+import contextvars
+from collections import Counter, deque
+
+# (minimum, starting, maximum) candidates in flight in each stage
+STAGE_LIMITS = {
+    'dns': (16, 250, 1000),
+    'whois': (8, 100, 500),
+    'cert': (16, 250, 1000),
+}
+# Seconds the slowest tenth of a stage may take before the stage is considered overloaded
+LATENCY_TARGETS = {
+    'dns': 5,
+    'whois': 10,
+    'cert': 5,
+}
+ADJUST_INTERVAL = 5  # Seconds between decisions for a stage
+MIN_SAMPLES = 20  # Finished candidates a decision needs
+MAX_FAILURE_RATE = 0.05  # Share of timeouts and errors above which a stage backs off
+INCREASE_STEP = 10
+DECREASE_FACTOR = 0.7
+
+# [start time] of the stage call running in this thread or task, for restart_stage_clock
+stage_clock = contextvars.ContextVar('stage_clock', default=None)
+
+def restart_stage_clock():
+    """Measure the latency of the current stage call from now on.
+
+    Called once a rate limiter lets a call through, so waiting for a slow server's turn is not
+    taken as the stage being overloaded.
+    """
+    clock = stage_clock.get()
+    if clock is not None:
+        clock[0] = time.monotonic()
+
+def release_waiter(future):
+    if not future.done():
+        future.set_result(None)
+
+class AdaptiveLimit:
+    """How many candidates may be in one stage at once, adjusted by AIMD.
+
+    Every ADJUST_INTERVAL seconds the limit is cut by DECREASE_FACTOR if too many candidates timed
+    out or failed or the 90th percentile latency exceeds the target, and raised by INCREASE_STEP if
+    the stage was kept busy up to its limit without either. Work started before a cut is left out
+    of the next decision, so one overload is not punished twice. Threads and asyncio tasks can wait
+    for the same limit.
+    """
+
+    def __init__(self, stage, minimum, start, maximum, latency_target):
+        self.stage = stage
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = start
+        self.latency_target = latency_target
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.async_waiters = deque()
+        self.in_flight = 0
+        self.saturated = False  # Work had to wait for the limit since the last decision
+        self.latencies = []
+        self.outcomes = Counter()
+        self.completed = 0
+        self.last_adjust = self.last_decrease = time.monotonic()
+
+    def _enter(self):
+        self.in_flight += 1
+        if self.in_flight >= self.limit:
+            self.saturated = True
+        return time.monotonic()
+
+    def acquire(self):
+        """Wait for a slot on a thread; returns the start time to pass to release."""
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.saturated = True
+                self.condition.wait()
+            return self._enter()
+
+    async def acquire_async(self):
+        """Wait for a slot in the event loop; returns the start time to pass to release."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self.in_flight < self.limit:
+                    return self._enter()
+                self.saturated = True
+                future = loop.create_future()
+                self.async_waiters.append((loop, future))
+            await future
+
+    def release(self, started, outcome):
+        """Hand back a slot, outcome being 'ok', 'timeout' or 'error'."""
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight -= 1
+            self.completed += 1
+            if started >= self.last_decrease:
+                self.latencies.append(now - started)
+                self.outcomes[outcome] += 1
+            if now - self.last_adjust >= ADJUST_INTERVAL and len(self.latencies) >= MIN_SAMPLES:
+                self._adjust(now)
+            self._wake()
+
+    def _wake(self):
+        free = self.limit - self.in_flight
+        if free <= 0:
+            return
+        self.condition.notify(free)
+        while free > 0 and self.async_waiters:
+            loop, future = self.async_waiters.popleft()
+            if not future.done():
+                loop.call_soon_threadsafe(release_waiter, future)
+                free -= 1
+
+    def _adjust(self, now):
+        samples = len(self.latencies)
+        failure_rate = (self.outcomes['timeout'] + self.outcomes['error']) / samples
+        p90 = sorted(self.latencies)[int(samples * 0.9)]
+        limit = self.limit
+        if failure_rate > MAX_FAILURE_RATE:
+            limit = max(self.minimum, int(self.limit * DECREASE_FACTOR))
+            reason = f"{failure_rate:.0%} timed out or failed"
+        elif p90 > self.latency_target:
+            limit = max(self.minimum, int(self.limit * DECREASE_FACTOR))
+            reason = f"p90 latency {p90:.1f}s over {self.latency_target}s"
+        elif self.saturated:
+            limit = min(self.maximum, self.limit + INCREASE_STEP)
+            reason = "kept busy and keeping up"
+        if limit != self.limit:
+            print(f"Concurrency {self.stage}: {self.limit} -> {limit}, {reason} "
+                  f"({samples} done, {self.outcomes['timeout']} timeouts, {self.outcomes['error']} errors, "
+                  f"p90 {p90:.1f}s, {self.in_flight} in flight)")
+            if limit < self.limit:
+                self.last_decrease = now
+            self.limit = limit
+        self.latencies = []
+        self.outcomes = Counter()
+        self.saturated = False
+        self.last_adjust = now
+
+class ConcurrencyController:
+    """An AdaptiveLimit for each stage of a scrape.
+
+    outcome(stage, result) tells from what a stage returned whether it was 'ok', a 'timeout' or an
+    'error'; a stage that raises counts as an 'error'.
+    """
+
+    def __init__(self, outcome, limits=STAGE_LIMITS, latency_targets=LATENCY_TARGETS):
+        self.outcome = outcome
+        self.stages = {stage: AdaptiveLimit(stage, *bounds, latency_targets[stage]) for stage, bounds in limits.items()}
+
+    def call(self, stage, function, *args):
+        """Run function(*args) as one candidate of stage, waiting for a slot first."""
+        limit = self.stages[stage]
+        clock = [limit.acquire()]
+        token = stage_clock.set(clock)
+        outcome = 'error'
+        try:
+            result = function(*args)
+            outcome = self.outcome(stage, result)
+            return result
+        finally:
+            stage_clock.reset(token)
+            limit.release(clock[0], outcome)
+
+    async def call_async(self, stage, coroutine_function, *args):
+        """Await coroutine_function(*args) as one candidate of stage, waiting for a slot first."""
+        limit = self.stages[stage]
+        clock = [await limit.acquire_async()]
+        token = stage_clock.set(clock)
+        outcome = 'error'
+        try:
+            result = await coroutine_function(*args)
+            outcome = self.outcome(stage, result)
+            return result
+        finally:
+            stage_clock.reset(token)
+            limit.release(clock[0], outcome)
+
+    def summary(self):
+        return ', '.join(f"{stage} {limit.limit} (of {limit.minimum}-{limit.maximum}, {limit.completed} done)"
+                         for stage, limit in self.stages.items())
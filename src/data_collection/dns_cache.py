@@ -0,0 +1,90 @@
+import time
+import threading
+from collections import OrderedDict
+
+import dns.rdatatype
+
+MAX_ENTRIES = 500000  # Answers kept before the least recently used are evicted
+MAX_TTL = 24 * 3600  # Never trust a record for longer than a day, whatever its TTL says
+MAX_NEGATIVE_TTL = 3600  # Cap for NXDOMAIN and empty answers, which otherwise default to the day cap
+NEGATIVE_TTL = 300  # How long to remember failures that carry no SOA, such as SERVFAIL from every nameserver
+CACHED_STATUSES = {'ok', 'no_answer', 'nxdomain', 'no_nameservers'}  # Timeouts are always retried
+
+def negative_ttl(response):
+    """TTL for a negative answer: the SOA minimum from the authority section (RFC 2308), else NEGATIVE_TTL."""
+    if response is None:
+        return NEGATIVE_TTL
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return min(rrset.ttl, rrset[0].minimum)
+    return NEGATIVE_TTL
+
+class DnsCache:
+    """Process-wide LRU cache of DNS results keyed on (name, record type), shared between threads.
+
+    Values are the (status, records) pairs produced by AsyncDnsClient.query. An NXDOMAIN with an empty
+    answer is stored against the name as a whole, so it answers every other record type for that name
+    until it expires. One that came with a CNAME chain, passed as its records, is about the chain's
+    target and only stored for the record type asked.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_ttl=MAX_TTL, max_negative_ttl=MAX_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        status, records, expires_at = entry
+        if expires_at <= now:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return status, records
+
+    def get(self, name, record_type):
+        """Return the cached (status, records) for a question, or None on a miss."""
+        name = name.lower().rstrip('.')
+        now = time.monotonic()
+        with self.lock:
+            result = self._lookup((name, None), now) or self._lookup((name, record_type), now)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def put(self, name, record_type, status, records, ttl):
+        """Remember a result for ttl seconds (capped at max_ttl); timeouts and zero TTLs are not stored."""
+        if status not in CACHED_STATUSES or ttl <= 0:
+            return
+        ttl = min(ttl, self.max_ttl if status == 'ok' else self.max_negative_ttl)
+        name = name.lower().rstrip('.')
+        # NXDOMAIN without an answer means the name has no records of any type; behind a dangling CNAME it still has that CNAME
+        key = (name, None) if status == 'nxdomain' and not records else (name, record_type)
+        with self.lock:
+            self.entries[key] = (status, records, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# One cache per process, shared by the synchronous resolver in webscraper_helper and AsyncDnsClient
+dns_cache = DnsCache()
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import mmap
+import time
+import argparse
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from aggregate_icann_domains import find_chunk_boundaries
+from candidate_io import CandidateWriter
+
+INDEX_DIRECTORY = 'data/raw/suffix_index/'
+DOMAINS_TXT_PATH = 'data/raw/unique_domains.txt'
+SHARD_BYTES = 8 * 1024 * 1024  # Suffixes of one shard are sorted in memory
+BYTES_PER_SHARD_BYTE = 50  # Rough RAM a shard's suffix keys take per byte of shard
+MAX_MEMORY_MB = 4096  # Ceiling for suffix keys held across all build workers, which caps how many run at once
+NUM_WORKERS = os.cpu_count() or 1
+
+def build_shard(domains_txt_path, start, end, shard_path, typecode):
+    """Sort the suffixes of every domain in one line-aligned byte range and save their file offsets."""
+    with open(domains_txt_path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            keys = []
+            positions = array(typecode)
+            line_start = start
+            for line in mm[start:end].split(b'\n'):
+                # A query never holds a newline, so each suffix only needs sorting up to the end of its domain;
+                # suffixes sort case-insensitively, as queries are matched
+                line = line.lower()
+                for i in range(len(line)):
+                    keys.append(line[i:])
+                    positions.append(line_start + i)
+                line_start += len(line) + 1
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    suffix_array = array(typecode, (positions[i] for i in order))
+    with open(shard_path, 'wb') as shard_file:
+        suffix_array.tofile(shard_file)
+    return len(suffix_array)
+
+def max_build_workers(num_workers=NUM_WORKERS, max_memory_mb=MAX_MEMORY_MB):
+    """Number of shards that may be sorted at once without their keys taking more than max_memory_mb."""
+    return max(1, min(num_workers, max_memory_mb * 1024 * 1024 // (SHARD_BYTES * BYTES_PER_SHARD_BYTE)))
+
+def build_index(domains_txt_path=DOMAINS_TXT_PATH, index_directory=INDEX_DIRECTORY, num_workers=NUM_WORKERS,
+                max_memory_mb=MAX_MEMORY_MB):
+    """Build a sharded suffix array over domains_txt_path.
+
+    The domain file itself is the indexed text: each shard covers a line-aligned byte range and stores
+    the sorted file offsets of every suffix in it, so queries only need the two files mmap'd.
+    """
+    num_workers = max_build_workers(num_workers, max_memory_mb)
+    domains_size = os.path.getsize(domains_txt_path)
+    typecode = 'I' if domains_size < 2 ** 32 else 'Q'
+    ranges = find_chunk_boundaries(domains_txt_path, max(1, -(-domains_size // SHARD_BYTES)))
+    os.makedirs(index_directory, exist_ok=True)
+    print(f"Building suffix array over {domains_txt_path} in {len(ranges)} shards with {num_workers} workers...")
+
+    shards = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = []
+        for number, (start, end) in enumerate(ranges):
+            shard_name = f"shard_{number:05d}.bin"
+            futures.append(executor.submit(build_shard, domains_txt_path, start, end,
+                                           os.path.join(index_directory, shard_name), typecode))
+            shards.append({'file': shard_name, 'start': start, 'end': end})
+        for shard, future in zip(shards, futures):
+            shard['count'] = future.result()
+
+    meta = {'domains_txt_path': domains_txt_path, 'domains_size': domains_size,
+            'domains_mtime': os.stat(domains_txt_path).st_mtime_ns, 'typecode': typecode, 'shards': shards}
+    with open(os.path.join(index_directory, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=4)
+    print(f"Indexed {sum(shard['count'] for shard in shards)} suffixes in {index_directory}")
+
+class DomainIndex:
+    """Substring search over the domain corpus using the mmap'd suffix array shards written by build_index.
+
+    Given domains_txt_path, the index must have been built over that file.
+    """
+
+    def __init__(self, index_directory=INDEX_DIRECTORY, domains_txt_path=None):
+        with open(os.path.join(index_directory, 'meta.json'), 'r') as meta_file:
+            meta = json.load(meta_file)
+        if domains_txt_path and os.path.realpath(domains_txt_path) != os.path.realpath(meta['domains_txt_path']):
+            raise ValueError(f"the index in {index_directory} was built over {meta['domains_txt_path']}, not {domains_txt_path}")
+        domains_stat = os.stat(meta['domains_txt_path'])
+        if (domains_stat.st_size, domains_stat.st_mtime_ns) != (meta['domains_size'], meta['domains_mtime']):
+            raise ValueError(f"{meta['domains_txt_path']} changed since the index in {index_directory} was built; rebuild it")
+
+        self.files = []
+        self.maps = []
+        self.domains = self._map(meta['domains_txt_path'])
+        self.shards = []
+        for shard in meta['shards']:
+            if shard['count']:
+                self.shards.append(memoryview(self._map(os.path.join(index_directory, shard['file']))).cast(meta['typecode']))
+
+    def _map(self, path):
+        file = open(path, 'rb')
+        self.files.append(file)
+        self.maps.append(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        return self.maps[-1]
+
+    def _bound(self, suffix_array, query, upper):
+        """Binary search for the first suffix whose prefix is >= query (or > query when upper is set)."""
+        text = self.domains
+        length = len(query)
+        low, high = 0, len(suffix_array)
+        while low < high:
+            middle = (low + high) // 2
+            prefix = text[suffix_array[middle]:suffix_array[middle] + length].lower()
+            if prefix < query or (upper and prefix == query):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find_positions(self, substring):
+        """Yield the file offset of every occurrence of substring in the domain corpus, ignoring case."""
+        query = substring.lower().encode()
+        if not query or b'\n' in query:
+            raise ValueError("Query must be a non-empty single-line string")
+        for suffix_array in self.shards:
+            first = self._bound(suffix_array, query, upper=False)
+            last = self._bound(suffix_array, query, upper=True)
+            yield from suffix_array[first:last]
+
+    def find_domains(self, substring):
+        """Return every domain containing substring, lowercased like find_candidates, in the order they appear in the domain file."""
+        line_starts = {self.domains.rfind(b'\n', 0, position) + 1 for position in self.find_positions(substring.lower())}
+        domains = []
+        for line_start in sorted(line_starts):
+            line_end = self.domains.find(b'\n', line_start)
+            domains.append(self.domains[line_start:line_end if line_end != -1 else len(self.domains)].decode().strip().lower())
+        return domains
+
+    def close(self):
+        for suffix_array in self.shards:
+            suffix_array.release()
+        for mapped in self.maps:
+            mapped.close()
+        for file in self.files:
+            file.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the suffix array index over unique_domains.txt")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="Build the index")
+    build_parser.add_argument('--domains', default=DOMAINS_TXT_PATH)
+    build_parser.add_argument('--index', default=INDEX_DIRECTORY)
+
+    query_parser = subparsers.add_parser('query', help="Print every domain containing the given substrings")
+    query_parser.add_argument('substrings', nargs='+')
+    query_parser.add_argument('--index', default=INDEX_DIRECTORY)
+    query_parser.add_argument('--candidates', help="Append the matches to this .jsonl candidate file instead of printing them")
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_index(args.domains, args.index)
+        return
+
+    index = DomainIndex(args.index)
+    writer = CandidateWriter(args.candidates, append=True) if args.candidates else None
+    for substring in args.substrings:
+        start_time = time.time()
+        domains = index.find_domains(substring)
+        elapsed_ms = (time.time() - start_time) * 1000
+        if writer:
+            for domain in domains:
+                writer.write(substring.lower(), domain)
+        else:
+            for domain in domains:
+                print(domain)
+        print(f"Found {len(domains)} matching domains for trademark: {substring} in {elapsed_ms:.1f} ms", file=sys.stderr)
+    if writer:
+        writer.close()
+    index.close()
+
+if __name__ == "__main__":
+    main()
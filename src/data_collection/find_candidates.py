@@ -1,5 +1,22 @@
 import csv
 import json
+import os
+import mmap
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from aho_corasick import AhoCorasick
+from aggregate_icann_domains import find_chunk_boundaries
+from candidate_io import CandidateWriter
+
+USE_NAIVE_MATCHER = False  # Fall back to the nested substring loop, e.g. to verify the Aho-Corasick output
+USE_PARALLEL_MATCHER = True  # Shard the memory-mapped domain file across a process pool
+NUM_WORKERS = os.cpu_count() or 1
+CHUNKS_PER_WORKER = 8
+USE_STREAMING_OUTPUT = False  # Read domains lazily and write matches to a JSON Lines file as they are found
+USE_PARQUET_OUTPUT = False  # Write candidate_domains.parquet instead, sorted by trademark unless the output is streamed
+USE_ZONE_DELTA = False  # Only match the domains added since the last zone snapshot (see aggregate_icann_domains.USE_ZONE_DIFF)
+
 def load_trademarks_from_csv(filepath):
     trademarks = []
     print(f"Loading trademarks from {filepath}...")
@@ -18,6 +35,12 @@ def load_domains_from_txt(filepath):
     print(f"Loaded {len(domains)} domains.")
     return domains
 
+def iter_domains_from_txt(filepath):
+    """Lazily yield lowercased domains from a text file, one per line."""
+    with open(filepath, 'r') as file:
+        for line in file:
+            yield line.strip().lower()  # Using lowercase to ensure matching
+
 def find_matching_domains(trademarks, domains):
     matches = {trademark: [] for trademark in trademarks}
     for trademark in trademarks:
@@ -27,33 +50,152 @@ def find_matching_domains(trademarks, domains):
         print(f"Found {len(matches[trademark])} matching domains for trademark: {trademark}")
     return matches
 
+def find_matching_domains_aho_corasick(trademarks, domains):
+    """Find the domains containing each trademark by scanning every domain once with an Aho-Corasick automaton."""
+    unique_trademarks = list(dict.fromkeys(trademarks))
+    automaton = AhoCorasick(unique_trademarks)
+    matches = {trademark: [] for trademark in unique_trademarks}
+    for domain in domains:
+        for index in automaton.find_all(domain):
+            matches[unique_trademarks[index]].append(domain)
+    return repeat_duplicate_trademarks(matches, trademarks)
+
+def repeat_duplicate_trademarks(matches, trademarks):
+    """Repeat the lists of duplicated trademarks, since the nested loop appends a domain once per listing."""
+    for trademark, count in Counter(trademarks).items():
+        if count > 1:
+            matches[trademark] = matches[trademark] * count
+    for trademark in matches:
+        print(f"Found {len(matches[trademark])} matching domains for trademark: {trademark}")
+    return matches
+
+# Set in each worker process by init_matcher_worker so the automaton is built once per process
+worker_automaton = None
+
+def init_matcher_worker(trademarks):
+    global worker_automaton
+    worker_automaton = AhoCorasick(trademarks)
+
+def match_domain_range(domains_txt_path, start, end):
+    """Match the domains in one line-aligned byte range of the memory-mapped domain file."""
+    matches = {}
+    num_domains = 0
+    with open(domains_txt_path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Walk the range a line at a time rather than copying all of it out of the map
+            position = start
+            while position < end:
+                newline = mm.find(b'\n', position, end)
+                if newline == -1:
+                    newline = end
+                line_start, position = position, newline + 1
+                if line_start == newline:
+                    continue
+                domain = mm[line_start:newline].decode().strip().lower()  # Using lowercase to ensure matching
+                num_domains += 1
+                for index in worker_automaton.find_all(domain):
+                    matches.setdefault(index, []).append(domain)
+    return matches, num_domains
+
+def find_matching_domains_parallel(trademarks, domains_txt_path, num_workers=NUM_WORKERS):
+    """Match trademarks against the domain file in a process pool, each worker scanning one mmap'd shard."""
+    print(f"Matching domains from {domains_txt_path} with {num_workers} workers...")
+    unique_trademarks = list(dict.fromkeys(trademarks))
+    ranges = find_chunk_boundaries(domains_txt_path, num_workers * CHUNKS_PER_WORKER)
+
+    matches = {trademark: [] for trademark in unique_trademarks}
+    num_domains = 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_matcher_worker,
+                             initargs=(unique_trademarks,)) as executor:
+        futures = [executor.submit(match_domain_range, domains_txt_path, start, end) for start, end in ranges]
+        # Merge shards in file order so each trademark's domains keep the order of the domain file
+        for future in futures:
+            shard_matches, shard_domains = future.result()
+            num_domains += shard_domains
+            for index, domains in shard_matches.items():
+                matches[unique_trademarks[index]].extend(domains)
+    print(f"Matched {num_domains} domains.")
+    return repeat_duplicate_trademarks(matches, trademarks)
+
+def stream_matching_domains(trademarks, domains, output_path):
+    """Write each (trademark, domain) match to output_path as soon as it is found and return the per-trademark counts."""
+    unique_trademarks = list(dict.fromkeys(trademarks))
+    automaton = AhoCorasick(unique_trademarks)
+    summary_statistics = {trademark: 0 for trademark in unique_trademarks}
+    num_domains = 0
+    with CandidateWriter(output_path) as writer:
+        for trademark in unique_trademarks:
+            writer.add_trademark(trademark)
+        for domain in domains:
+            num_domains += 1
+            for index in sorted(automaton.find_all(domain)):
+                trademark = unique_trademarks[index]
+                writer.write(trademark, domain)
+                summary_statistics[trademark] += 1
+    print(f"Matched {num_domains} domains.")
+    return summary_statistics
+
+def write_candidates(matching_domains, output_path):
+    """Write {trademark: [domains]} to a candidate file, sorted by trademark and domain."""
+    with CandidateWriter(output_path) as writer:
+        for trademark in sorted(matching_domains):
+            writer.add_trademark(trademark)
+            for domain in sorted(matching_domains[trademark]):
+                writer.write(trademark, domain)
+
 def calculate_summary_statistics(matching_domains):
     summary_statistics = {}
     for trademark, matched_domains in matching_domains.items():
         summary_statistics[trademark] = len(matched_domains)
     return summary_statistics
 
+def write_summary_statistics(summary_statistics, summary_csv_path):
+    with open(summary_csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['Trademark', 'Matches'])
+        for trademark, matches in summary_statistics.items():
+            writer.writerow([trademark, matches])
+    print(f"Summary statistics saved to {summary_csv_path}")
+
 def main():
     trademarks_csv_path = 'data/raw/combined_trademarks_list_full.csv'
     domains_txt_path = 'data/raw/unique_domains.txt'
     output_path = 'data/raw/candidate_domains.json'
     summary_csv_path = 'data/raw/summary_statistics.csv'  # New CSV file for summary statistics
+    if USE_ZONE_DELTA:
+        domains_txt_path = 'data/raw/domains_added.txt'
+        output_path = 'data/raw/candidate_domains_added.json'
+        summary_csv_path = 'data/raw/summary_statistics_added.csv'
     
     trademarks = load_trademarks_from_csv(trademarks_csv_path)
-    domains = load_domains_from_txt(domains_txt_path)
-    matching_domains = find_matching_domains(trademarks, domains)
+    if USE_PARQUET_OUTPUT:
+        output_path = output_path.replace('.json', '.parquet')
+    elif USE_STREAMING_OUTPUT:
+        output_path = output_path.replace('.json', '.jsonl')
+    if USE_STREAMING_OUTPUT:
+        summary_statistics = stream_matching_domains(trademarks, iter_domains_from_txt(domains_txt_path), output_path)
+        print(f"Data saved to {output_path}")
+        write_summary_statistics(summary_statistics, summary_csv_path)
+        return
+
+    if USE_NAIVE_MATCHER:
+        domains = load_domains_from_txt(domains_txt_path)
+        matching_domains = find_matching_domains(trademarks, domains)
+    elif USE_PARALLEL_MATCHER:
+        matching_domains = find_matching_domains_parallel(trademarks, domains_txt_path)
+    else:
+        domains = load_domains_from_txt(domains_txt_path)
+        matching_domains = find_matching_domains_aho_corasick(trademarks, domains)
     summary_statistics = calculate_summary_statistics(matching_domains)
     
-    with open(output_path, 'w') as json_file:
-        json.dump(matching_domains, json_file, indent=4)
+    if USE_PARQUET_OUTPUT:
+        write_candidates(matching_domains, output_path)
+    else:
+        with open(output_path, 'w') as json_file:
+            json.dump(matching_domains, json_file, indent=4)
     print(f"Data saved to {output_path}")
     
-    with open(summary_csv_path, 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(['Trademark', 'Matches'])
-        for trademark, matches in summary_statistics.items():
-            writer.writerow([trademark, matches])
-    print(f"Summary statistics saved to {summary_csv_path}")
+    write_summary_statistics(summary_statistics, summary_csv_path)
 
 if __name__ == "__main__":
     main()
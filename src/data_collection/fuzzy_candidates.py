@@ -0,0 +1,214 @@
+import os
+import json
+import mmap
+import string
+from array import array
+from bisect import bisect_left
+
+from candidate_io import find_candidate_file, merge_candidates
+from find_candidates import load_trademarks_from_csv
+
+NGRAM_SIZE = 3
+MIN_TRADEMARK_LENGTH = 5  # Shorter trademarks are within one edit of far too many unrelated labels
+LONG_TRADEMARK_LENGTH = 9  # Trademarks at least this long may be two edits away instead of one
+INDEX_DIRECTORY = 'data/raw/ngram_index/'
+
+# Characters and pairs commonly swapped in for look-alike letters in squatted domains
+HOMOGLYPHS = {'0': 'o', '1': 'l', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b', 'rn': 'm', 'vv': 'w'}
+LABEL_CHARACTERS = string.ascii_lowercase + string.digits + '-'
+
+def normalize_homoglyphs(text):
+    """Map look-alike characters to the letters they imitate."""
+    for glyph, letter in HOMOGLYPHS.items():
+        if glyph in text:
+            text = text.replace(glyph, letter)
+    return text
+
+def domain_label(domain):
+    """Return the normalized part of a domain that trademarks are matched against (everything but the TLD)."""
+    return normalize_homoglyphs(domain.rsplit('.', 1)[0])
+
+def ngrams(text, n=NGRAM_SIZE):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def edit_variants(text, max_distance):
+    """Every string within max_distance insertions, deletions or substitutions of text, text included."""
+    variants = {text}
+    for _ in range(max_distance):
+        for variant in list(variants):
+            splits = [(variant[:i], variant[i:]) for i in range(len(variant) + 1)]
+            variants.update(left + right[1:] for left, right in splits if right)
+            variants.update(left + char + right[1:] for left, right in splits if right for char in LABEL_CHARACTERS)
+            variants.update(left + char + right for left, right in splits for char in LABEL_CHARACTERS)
+    return variants
+
+def max_edit_distance(trademark):
+    return 2 if len(trademark) >= LONG_TRADEMARK_LENGTH else 1
+
+def substring_edit_distance(pattern, text, max_distance):
+    """Smallest edit distance between pattern and any substring of text, or None if it is above max_distance."""
+    m = len(pattern)
+    previous = list(range(m + 1))
+    best = previous[m]
+    for char in text:
+        current = [0]  # A match may start anywhere in text for free
+        for i in range(1, m + 1):
+            cost = 0 if pattern[i - 1] == char else 1
+            current.append(min(previous[i - 1] + cost, previous[i] + 1, current[i - 1] + 1))
+        best = min(best, current[m])
+        previous = current
+    return best if best <= max_distance else None
+
+def build_ngram_index(domains_txt_path, index_directory=INDEX_DIRECTORY):
+    """Build a character n-gram inverted index over the normalized labels of every domain in domains_txt_path.
+
+    Domains are identified by their line number. The index directory holds the posting lists of all
+    n-grams back to back (postings.bin), where each n-gram's list starts (grams.json), and the byte
+    offset of each line of the domain file (offsets.bin) so matches can be read back with an mmap.
+    """
+    print(f"Building {NGRAM_SIZE}-gram index over {domains_txt_path}...")
+    postings = {}
+    offsets = array('Q')
+    with open(domains_txt_path, 'rb') as file:
+        offset = 0
+        for domain_id, line in enumerate(file):
+            offsets.append(offset)
+            offset += len(line)
+            for gram in ngrams(domain_label(line.decode().strip().lower())):
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array('I')
+                posting.append(domain_id)
+
+    os.makedirs(index_directory, exist_ok=True)
+    grams = {}
+    position = 0
+    with open(os.path.join(index_directory, 'postings.bin'), 'wb') as postings_file:
+        for gram, posting in postings.items():
+            posting.tofile(postings_file)
+            grams[gram] = (position, len(posting))
+            position += len(posting)
+    with open(os.path.join(index_directory, 'offsets.bin'), 'wb') as offsets_file:
+        offsets.tofile(offsets_file)
+    with open(os.path.join(index_directory, 'grams.json'), 'w') as grams_file:
+        json.dump({'domains_txt_path': domains_txt_path, 'ngram_size': NGRAM_SIZE, 'grams': grams}, grams_file)
+    print(f"Indexed {len(offsets)} domains under {len(grams)} {NGRAM_SIZE}-grams in {index_directory}")
+
+class NgramIndex:
+    """Read-only view of an index written by build_ngram_index, with posting lists read through mmap."""
+
+    def __init__(self, index_directory=INDEX_DIRECTORY):
+        with open(os.path.join(index_directory, 'grams.json'), 'r') as grams_file:
+            meta = json.load(grams_file)
+        self.grams = meta['grams']
+        self.ngram_size = meta['ngram_size']
+        paths = [os.path.join(index_directory, 'postings.bin'), os.path.join(index_directory, 'offsets.bin'),
+                 meta['domains_txt_path']]
+        self.files = [open(path, 'rb') for path in paths]
+        self.maps = [mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) for file in self.files]
+        self.postings = memoryview(self.maps[0]).cast('I')
+        self.offsets = memoryview(self.maps[1]).cast('Q')
+        self.domains = self.maps[2]
+
+    def posting(self, gram):
+        start, count = self.grams.get(gram, (0, 0))
+        return self.postings[start:start + count]
+
+    def contains(self, gram, domain_id):
+        posting = self.posting(gram)
+        position = bisect_left(posting, domain_id)
+        return position < len(posting) and posting[position] == domain_id
+
+    def intersect(self, grams):
+        """Domain ids in the posting list of every gram; the lists are sorted, so longer ones are binary searched."""
+        grams = sorted(grams, key=lambda gram: self.grams.get(gram, (0, 0))[1])
+        return [domain_id for domain_id in self.posting(grams[0])
+                if all(self.contains(gram, domain_id) for gram in grams[1:])]
+
+    def domain(self, domain_id):
+        start = self.offsets[domain_id]
+        end = self.domains.find(b'\n', start)
+        return self.domains[start:end if end != -1 else len(self.domains)].decode().strip().lower()
+
+    def candidate_ids(self, trademark, max_distance):
+        """Domain ids that may hold trademark within max_distance edits.
+
+        Split into k + 1 pieces, a trademark with k edits still has one piece intact, so a domain must
+        contain every n-gram of at least one piece. Trademarks too short for pieces of n characters are
+        looked up by their k-edit variants instead, one of which the domain must contain exactly.
+        """
+        n = self.ngram_size
+        num_pieces = max_distance + 1
+        if len(trademark) >= num_pieces * n:
+            bounds = [len(trademark) * i // num_pieces for i in range(num_pieces + 1)]
+            parts = [trademark[start:end] for start, end in zip(bounds, bounds[1:])]
+        else:
+            parts = edit_variants(trademark, max_distance)
+            if min(len(part) for part in parts) < n:
+                return None  # Too short for the index to rule anything out
+        candidate_ids = set()
+        for part in parts:
+            candidate_ids.update(self.intersect(ngrams(part, n)))
+        return candidate_ids
+
+    def close(self):
+        for view in (self.postings, self.offsets):
+            view.release()
+        for mapped in self.maps:
+            mapped.close()
+        for file in self.files:
+            file.close()
+
+def classify_match(trademark, domain, max_distance):
+    """Return 'homoglyph' or 'typo' for a fuzzy match of trademark in domain, or None if it isn't one."""
+    if trademark in domain:
+        return None  # Already reported by find_candidates as an exact match
+    distance = substring_edit_distance(normalize_homoglyphs(trademark), domain_label(domain), max_distance)
+    if distance is None:
+        return None
+    return 'homoglyph' if distance == 0 else 'typo'
+
+def find_fuzzy_matches(index, trademark):
+    """Yield (domain, match_type) for domains holding a look-alike or mistyped copy of trademark."""
+    max_distance = max_edit_distance(trademark)
+    candidate_ids = index.candidate_ids(normalize_homoglyphs(trademark), max_distance)
+    if candidate_ids is None:
+        return
+    for domain_id in sorted(candidate_ids):
+        domain = index.domain(domain_id)
+        match_type = classify_match(trademark, domain, max_distance)
+        if match_type:
+            yield domain, match_type
+
+def find_all_fuzzy_matches(index, trademarks):
+    """Return {(trademark, domain): match_type} for every fuzzy match of the trademarks."""
+    candidates = {}
+    for trademark in trademarks:
+        counts = {'homoglyph': 0, 'typo': 0}
+        for domain, match_type in find_fuzzy_matches(index, trademark):
+            candidates[(trademark, domain)] = match_type
+            counts[match_type] += 1
+        print(f"Found {counts['homoglyph']} homoglyph and {counts['typo']} typo domains for trademark: {trademark}")
+    return candidates
+
+def main():
+    trademarks_csv_path = 'data/raw/combined_trademarks_list_full.csv'
+    domains_txt_path = 'data/raw/unique_domains.txt'
+    # The candidates filter_domain_by_trademark_outlier.py passes on to the scrapers
+    candidates_path = find_candidate_file('data/raw/candidate_domains_all')
+    # The older JSON layout only holds exact matches, so they are carried over to JSON Lines next to it
+    output_path = candidates_path[:-len('.json')] + '.jsonl' if candidates_path.endswith('.json') else candidates_path
+
+    if not os.path.exists(os.path.join(INDEX_DIRECTORY, 'grams.json')):
+        build_ngram_index(domains_txt_path)
+
+    trademarks = [trademark for trademark in dict.fromkeys(load_trademarks_from_csv(trademarks_csv_path))
+                  if len(trademark) >= MIN_TRADEMARK_LENGTH]
+    index = NgramIndex()
+    candidates = find_all_fuzzy_matches(index, trademarks)
+    index.close()
+    merge_candidates(candidates_path, output_path, candidates)
+    print(f"Fuzzy candidates saved to {output_path}")
+
+if __name__ == "__main__":
+    main()
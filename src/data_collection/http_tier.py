@@ -0,0 +1,131 @@
+import re
+import time
+import asyncio
+from urllib.parse import urljoin
+
+import aiohttp
+from bs4 import BeautifulSoup
+
+from record_store import save_output
+from scrape_metrics import metrics, http_outcome
+
+MAX_CONNECTIONS = 500
+MAX_CONNECTIONS_PER_HOST = 4  # Parked domains share a handful of parking hosts
+HTTP_TIMEOUT = 20
+MAX_REDIRECTS = 10
+MAX_HTML_BYTES = 5 * 1024 * 1024
+MIN_VISIBLE_TEXT = 200  # Pages with less text than this and some script are treated as script-rendered
+USER_AGENT = ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+              'Chrome/120.0.0.0 Safari/537.36')
+
+# Markup that only makes sense once scripts run: SPA mount points, JS redirects and bot challenges
+SCRIPT_RENDERED_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE) for pattern in (
+        r'<div[^>]+id=["\'](root|app|__next|__nuxt)["\'][^>]*>\s*</div>',
+        r'<noscript>[^<]*(enable|requires?) javascript',
+        r'(window|document|top)\.location(\.href)?\s*=',
+        r'location\.replace\(',
+        r'<meta[^>]+http-equiv=["\']?refresh',
+        r'cf-browser-verification|challenge-platform|cf_chl_',
+    )
+]
+ESCALATE_STATUSES = {403, 429, 503}  # Often bot protection that a real browser gets past
+
+def needs_browser(status, html):
+    """Whether a page fetched over plain HTTP has to be rendered in a browser to see what a visitor sees."""
+    if status in ESCALATE_STATUSES:
+        return True
+    if not html.strip():
+        return True
+    if any(pattern.search(html) for pattern in SCRIPT_RENDERED_PATTERNS):
+        return True
+    soup = BeautifulSoup(html, 'html.parser')
+    has_script = soup.find('script') is not None
+    for tag in soup(['script', 'style', 'noscript', 'template']):
+        tag.decompose()
+    return has_script and len(soup.get_text(' ', strip=True)) < MIN_VISIBLE_TEXT
+
+def favicon_url(final_url, html):
+    """The icon the page links to, or /favicon.ico, as gather_and_save_favicon finds it."""
+    soup = BeautifulSoup(html, 'html.parser')
+    link = soup.find('link', rel='icon') or soup.find('link', rel='shortcut icon')
+    if link and link.has_attr('href'):
+        return urljoin(final_url, link['href'])
+    return urljoin(final_url, 'favicon.ico')
+
+class HttpTier:
+    """Fetches candidate pages over pooled keep-alive HTTP connections, without a browser.
+
+    Each page is saved in the layout webscraper.py writes (.html, .final_url.txt, .favicon.ico and
+    .loadtime.txt); fetch_and_save reports when the page needs the browser instead.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                 timeout=HTTP_TIMEOUT):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.session = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host,
+                                         ssl=False, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(connector=connector, headers={'User-Agent': USER_AGENT},
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @metrics.timed('http_page', http_outcome)
+    async def fetch_page(self, domain):
+        """Return (status, final_url, html, load_time) for http://domain after following redirects."""
+        start_time = time.time()
+        async with self.session.get(f"http://{domain}", max_redirects=MAX_REDIRECTS) as response:
+            body = await response.content.read(MAX_HTML_BYTES)
+            html = body.decode(response.get_encoding() if response.charset else 'utf-8', errors='replace')
+            return response.status, str(response.url), html, time.time() - start_time
+
+    @metrics.timed('favicon')
+    async def fetch_favicon(self, domain, domain_folder, final_url, html):
+        try:
+            async with self.session.get(favicon_url(final_url, html)) as response:
+                response.raise_for_status()
+                favicon = await response.read()
+        except asyncio.TimeoutError:
+            return f"Request timed out for {domain}."
+        except aiohttp.ClientResponseError as http_err:
+            return f"HTTP error occurred for {domain}: {http_err}"
+        except (aiohttp.ClientError, ValueError) as err:
+            return f"Error occurred for {domain}: {err}"
+
+        save_output(domain_folder, f"{domain}.favicon.ico", favicon)
+
+    async def fetch_and_save(self, domain, domain_folder):
+        """Fetch and save one page; returns (escalate, errors), escalate meaning it needs the browser."""
+        try:
+            status, final_url, html, load_time = await self.fetch_page(domain)
+        except aiohttp.TooManyRedirects as e:
+            return True, [f"Too many redirects for {domain}: {e}"]
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            # Nothing answers; a browser would not get any further
+            return False, [f"Failed to load {domain}. Error: {e or type(e).__name__}"]
+
+        if needs_browser(status, html):
+            return True, []
+
+        save_output(domain_folder, f"{domain}.html", html)
+        save_output(domain_folder, f"{domain}.final_url.txt", final_url)
+        save_output(domain_folder, f"{domain}.loadtime.txt", f"Load time for {domain}: {load_time:.2f} seconds\n")
+
+        errors = []
+        error_message = await self.fetch_favicon(domain, domain_folder, final_url, html)
+        if error_message:
+            errors.append(error_message)
+        return False, errors
@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import glob
+import asyncio
+import threading
+from collections import OrderedDict
+
+import geoip2.database
+import geoip2.errors
+
+from scrape_metrics import metrics
+
+GEOIP_ASN_PATH = 'GeoLite2-ASN.mmdb'
+GEOIP_COUNTRY_PATH = 'GeoLite2-Country.mmdb'  # Optional; country fields are left out without it
+IP_CACHE_SIZE = 200000
+ADDRESS_RECORD_TYPES = ['A', 'AAAA']
+
+def record_addresses(dns_records):
+    """Every A and AAAA address in a .dns.json record dict."""
+    return [ip_address for record_type in ADDRESS_RECORD_TYPES if isinstance(dns_records.get(record_type), list)
+            for ip_address in dns_records[record_type]]
+
+class IpEnricher:
+    """AS number, AS organization, announced prefix and country for IP addresses.
+
+    The GeoLite2 databases are opened once in MODE_MMAP and shared by every thread in the process,
+    and lookups are remembered per IP since candidate domains cluster on a small number of hosts.
+    """
+
+    def __init__(self, asn_path=GEOIP_ASN_PATH, country_path=GEOIP_COUNTRY_PATH, cache_size=IP_CACHE_SIZE):
+        self.asn_reader = geoip2.database.Reader(asn_path, mode=geoip2.database.MODE_MMAP)
+        self.country_reader = None
+        if country_path and os.path.exists(country_path):
+            self.country_reader = geoip2.database.Reader(country_path, mode=geoip2.database.MODE_MMAP)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, ip_address):
+        """Return {'asn', 'as_organization', 'prefix', 'country'} for an IP, or None if it is not in the database."""
+        with self.lock:
+            if ip_address in self.cache:
+                self.cache.move_to_end(ip_address)
+                return self.cache[ip_address]
+
+        try:
+            response = self.asn_reader.asn(ip_address)
+            info = {
+                'asn': response.autonomous_system_number,
+                'as_organization': response.autonomous_system_organization,
+                'prefix': str(response.network),
+            }
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            info = None
+        if info is not None and self.country_reader is not None:
+            try:
+                info['country'] = self.country_reader.country(ip_address).country.iso_code
+            except (geoip2.errors.AddressNotFoundError, ValueError):
+                info['country'] = None
+
+        with self.lock:
+            self.cache[ip_address] = info
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return info
+
+    def enrich(self, dns_records):
+        """Return {ip: info} for every A and AAAA record in a .dns.json record dict."""
+        return {ip_address: self.lookup(ip_address) for ip_address in record_addresses(dns_records)}
+
+    def enrich_batch(self, dns_records_by_domain):
+        """Enrich a batch of domains in one pass, looking each distinct IP up only once."""
+        addresses = {ip_address for dns_records in dns_records_by_domain.values() for ip_address in record_addresses(dns_records)}
+        info = {ip_address: self.lookup(ip_address) for ip_address in addresses}
+        return {domain: {ip_address: info[ip_address] for ip_address in record_addresses(dns_records)}
+                for domain, dns_records in dns_records_by_domain.items()}
+
+    def close(self):
+        self.asn_reader.close()
+        if self.country_reader is not None:
+            self.country_reader.close()
+
+class EnrichmentBatcher:
+    """Enriches the DNS records of all domains resolved in one event loop iteration with a single enrich_batch call."""
+
+    def __init__(self, enricher=None):
+        self.enricher = enricher  # The process-wide enricher, opened with the first batch, when None
+        self.pending = []
+
+    def enrich(self, dns_records):
+        """Future of {ip: info} for the records, resolved once the current batch has been looked up."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.pending:
+            loop.call_soon(self._run)
+        self.pending.append((dns_records, future))
+        return future
+
+    def _run(self):
+        batch, self.pending = self.pending, []
+        try:
+            enricher = self.enricher or get_enricher()
+            with metrics.stage('asn'):
+                results = enricher.enrich_batch({i: dns_records for i, (dns_records, _) in enumerate(batch)})
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(results[i])
+
+_enricher = None
+_enricher_lock = threading.Lock()
+
+def get_enricher():
+    """The IpEnricher for this process, opened on first use."""
+    global _enricher
+    with _enricher_lock:
+        if _enricher is None:
+            _enricher = IpEnricher()
+        return _enricher
+
+def enrich_scrape_directory(base_dir):
+    """Add IP_Info to every .dns.json file under a scrape directory, one trademark folder per batch."""
+    enricher = get_enricher()
+    num_files = 0
+    for trademark_folder in sorted(glob.glob(os.path.join(base_dir, '*', ''))):
+        paths = glob.glob(os.path.join(trademark_folder, '*', '*.dns.json'))
+        batch = {}
+        for path in paths:
+            with open(path, 'r') as file:
+                batch[path] = json.load(file)
+        for path, ip_info in enricher.enrich_batch(batch).items():
+            batch[path]['IP_Info'] = ip_info
+            with open(path, 'w') as file:
+                json.dump(batch[path], file, indent=4)
+        num_files += len(paths)
+    print(f"Enriched {num_files} DNS files in {base_dir}")
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python ip_enrichment.py <scrape directory>")
+        sys.exit(1)
+    enrich_scrape_directory(sys.argv[1])
+
+if __name__ == "__main__":
+    main()
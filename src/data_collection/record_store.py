@@ -0,0 +1,325 @@
+import os
+import re
+import csv
+import zlib
+import glob
+import struct
+import sqlite3
+import argparse
+import threading
+
+NUM_SHARDS = 16
+SEGMENT_BYTES = 256 * 1024 * 1024  # A shard moves on to a new segment file past this size
+INDEX_FLUSH_RECORDS = 1000  # Index rows buffered before they are committed
+COMPRESSION_LEVEL = 6
+INDEX_NAME = 'index.sqlite'
+TRADEMARK_DOMAINS_NAME = 'trademark_domains.csv'  # Written by webscraper_simple when it dedupes domains
+
+# Segment record: total length of what follows, key length, flags, then the key and the compressed content
+RECORD_HEADER = struct.Struct('<IHB')
+FLAG_BYTES = 1  # Content is binary rather than UTF-8 text
+FLAG_APPEND = 2  # Content continues the previous record of the same name instead of replacing it
+SEGMENT_PATTERN = re.compile(r'shard(\d+)-(\d+)\.seg$')
+
+class RecordStore:
+    """Scrape output for many candidates in a few large files instead of one directory per candidate.
+
+    Every file the scrapers would write to <base_dir>/<trademark>/<domain>/<domain>.<name> becomes a
+    compressed record appended to one of NUM_SHARDS segment files, picked by domain, and an SQLite
+    index maps (trademark, domain, name) to it. Rewriting a file appends a new record that supersedes
+    the old one. Segments are written first and indexed after, so records a crash left unindexed are
+    picked up again from the segments the next time the store is opened for writing.
+
+    Only one process may write to a store at a time; any number of threads in it can.
+    """
+
+    def __init__(self, directory, writable=False):
+        self.directory = directory
+        self.writable = writable
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+        elif not os.path.exists(os.path.join(directory, INDEX_NAME)):
+            raise FileNotFoundError(f"No record store in {directory}")
+        self.index = sqlite3.connect(os.path.join(directory, INDEX_NAME), check_same_thread=False)
+        self.index.execute('CREATE TABLE IF NOT EXISTS records (seq INTEGER PRIMARY KEY, trademark TEXT, domain TEXT, '
+                           'name TEXT, segment TEXT, offset INTEGER, length INTEGER, flags INTEGER)')
+        self.index.execute('CREATE INDEX IF NOT EXISTS records_by_domain ON records (trademark, domain)')
+        self.index.execute('CREATE INDEX IF NOT EXISTS records_by_segment ON records (segment, offset)')
+        self.index_lock = threading.Lock()  # Around every use of the SQLite connection
+        self.pending_lock = threading.Lock()
+        self.pending_rows = []
+        self.readers = {}
+        self.read_lock = threading.Lock()
+
+        self.shards = []
+        if writable:
+            self._recover()
+            for shard in range(NUM_SHARDS):
+                segments = sorted(glob.glob(os.path.join(directory, f'shard{shard:02d}-*.seg')))
+                sequence = int(SEGMENT_PATTERN.search(segments[-1]).group(2)) if segments else 0
+                self.shards.append({'lock': threading.Lock(), 'sequence': sequence, 'file': None})
+
+    def _recover(self):
+        """Index records a crash left behind in the segments and cut off any half-written record."""
+        for segment_path in sorted(glob.glob(os.path.join(self.directory, 'shard*-*.seg'))):
+            segment = os.path.basename(segment_path)
+            indexed_end = self.index.execute('SELECT MAX(offset + length) FROM records WHERE segment = ?',
+                                             (segment,)).fetchone()[0] or 0
+            rows = []
+            with open(segment_path, 'r+b') as file:
+                file.seek(indexed_end)
+                offset = indexed_end
+                while True:
+                    header = file.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, key_length, flags = RECORD_HEADER.unpack(header)
+                    body = file.read(length - 3)
+                    if len(body) < length - 3:
+                        break
+                    trademark, domain, name = body[:key_length].decode('utf-8').split('\t')
+                    rows.append((trademark, domain, name, segment, offset, 4 + length, flags))
+                    offset += 4 + length
+                file.truncate(offset)
+            if rows:
+                print(f"Recovered {len(rows)} unindexed records from {segment}")
+                self.index.executemany('INSERT INTO records (trademark, domain, name, segment, offset, length, flags) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                self.index.commit()
+
+    def write(self, trademark, domain, name, content, append=False):
+        """Store content (str or bytes) as the file name of a candidate, or add it to the end with append."""
+        flags = (FLAG_BYTES if isinstance(content, bytes) else 0) | (FLAG_APPEND if append else 0)
+        data = zlib.compress(content if isinstance(content, bytes) else content.encode('utf-8'), COMPRESSION_LEVEL)
+        key = f"{trademark}\t{domain}\t{name}".encode('utf-8')
+        record = RECORD_HEADER.pack(3 + len(key) + len(data), len(key), flags) + key + data
+
+        shard_number = zlib.crc32(domain.encode('utf-8')) % NUM_SHARDS
+        shard = self.shards[shard_number]
+        with shard['lock']:
+            if shard['file'] is None or shard['file'].tell() >= SEGMENT_BYTES:
+                if shard['file'] is not None:
+                    shard['file'].flush()
+                    os.fsync(shard['file'].fileno())
+                    shard['file'].close()
+                    shard['sequence'] += 1
+                shard['name'] = f"shard{shard_number:02d}-{shard['sequence']:05d}.seg"
+                shard['file'] = open(os.path.join(self.directory, shard['name']), 'ab')
+            offset = shard['file'].tell()
+            shard['file'].write(record)
+            # Queued before the shard's next record is written, so each segment is indexed up to some
+            # offset and never past a record that is not, which _recover relies on
+            with self.pending_lock:
+                self.pending_rows.append((trademark, domain, name, shard['name'], offset, len(record), flags))
+                flush = len(self.pending_rows) >= INDEX_FLUSH_RECORDS
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Commit the queued index rows once the records they point at are synced to disk."""
+        with self.index_lock:
+            with self.pending_lock:
+                rows, self.pending_rows = self.pending_rows, []
+            if not rows:
+                return
+            for shard in self.shards:
+                with shard['lock']:
+                    if shard['file'] is not None:
+                        shard['file'].flush()
+                        os.fsync(shard['file'].fileno())
+            self.index.executemany('INSERT INTO records (trademark, domain, name, segment, offset, length, flags) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.index.commit()
+
+    def _read(self, segment, offset, length):
+        with self.read_lock:
+            if segment not in self.readers:
+                self.readers[segment] = open(os.path.join(self.directory, segment), 'rb')
+            file = self.readers[segment]
+            file.seek(offset)
+            record = file.read(length)
+        _, key_length, flags = RECORD_HEADER.unpack_from(record)
+        content = zlib.decompress(record[RECORD_HEADER.size + key_length:])
+        return content if flags & FLAG_BYTES else content.decode('utf-8')
+
+    def _query(self, sql, parameters=()):
+        with self.index_lock:
+            return self.index.execute(sql, parameters).fetchall()
+
+    def trademarks(self):
+        return [row[0] for row in self._query('SELECT DISTINCT trademark FROM records')]
+
+    def candidate_domains(self, trademark):
+        return [row[0] for row in self._query('SELECT DISTINCT domain FROM records WHERE trademark = ?', (trademark,))]
+
+    def has_domain(self, trademark, domain):
+        return bool(self._query('SELECT 1 FROM records WHERE trademark = ? AND domain = ? LIMIT 1', (trademark, domain)))
+
+    def load(self, trademark, domain):
+        """Return {name: content} with the latest version of every file stored for a candidate."""
+        files = {}
+        for name, segment, offset, length, flags in self._query(
+                'SELECT name, segment, offset, length, flags FROM records WHERE trademark = ? AND domain = ? ORDER BY seq',
+                (trademark, domain)):
+            content = self._read(segment, offset, length)
+            files[name] = files[name] + content if flags & FLAG_APPEND and name in files else content
+        return files
+
+    def close(self):
+        if self.writable:
+            self.flush()
+            for shard in self.shards:
+                if shard['file'] is not None:
+                    shard['file'].close()
+        for file in self.readers.values():
+            file.close()
+        self.index.close()
+
+class ScrapeDirectory:
+    """The same reader interface as RecordStore over the original one-directory-per-candidate layout."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def trademarks(self):
+        return [name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name))]
+
+    def candidate_domains(self, trademark):
+        trademark_dir = os.path.join(self.directory, trademark)
+        if not os.path.isdir(trademark_dir):
+            return []
+        return [name for name in os.listdir(trademark_dir) if os.path.isdir(os.path.join(trademark_dir, name))]
+
+    def has_domain(self, trademark, domain):
+        return os.path.isdir(os.path.join(self.directory, trademark, domain))
+
+    def load(self, trademark, domain):
+        files = {}
+        domain_dir = os.path.join(self.directory, trademark, domain)
+        for file_name in os.listdir(domain_dir):
+            if not file_name.startswith(domain + '.'):
+                continue
+            binary = file_name.endswith('.ico')
+            with open(os.path.join(domain_dir, file_name), 'rb' if binary else 'r', encoding=None if binary else 'utf-8') as file:
+                files[file_name[len(domain) + 1:]] = file.read()
+        return files
+
+    def close(self):
+        pass
+
+class TrademarkFanOut:
+    """A scrape reader that also lists each domain under the other trademarks it was a candidate for.
+
+    A deduplicated scrape saves each domain once, under the first trademark it came up for, and
+    records in trademark_domains.csv which trademark every (trademark, domain) was saved under.
+    """
+
+    def __init__(self, scrape, path):
+        self.scrape = scrape
+        self.scraped_under = {}  # (trademark, domain) -> trademark the domain was saved under, for the other trademarks
+        self.fanned_out = {}  # trademark -> domains saved under another trademark
+        with open(path, newline='') as file:
+            for row in csv.DictReader(file):
+                if row['Trademark'] != row['Scraped Under']:
+                    self.scraped_under[(row['Trademark'], row['Domain'])] = row['Scraped Under']
+                    self.fanned_out.setdefault(row['Trademark'], []).append(row['Domain'])
+
+    def trademarks(self):
+        return sorted(set(self.scrape.trademarks()) | set(self.fanned_out))
+
+    def candidate_domains(self, trademark):
+        return self.scrape.candidate_domains(trademark) + self.fanned_out.get(trademark, [])
+
+    def has_domain(self, trademark, domain):
+        return self.scrape.has_domain(self.scraped_under.get((trademark, domain), trademark), domain)
+
+    def load(self, trademark, domain):
+        return self.scrape.load(self.scraped_under.get((trademark, domain), trademark), domain)
+
+    def close(self):
+        self.scrape.close()
+
+def open_scrape(directory):
+    """Read scrape output from directory, whichever layout it was written in."""
+    if os.path.exists(os.path.join(directory, INDEX_NAME)):
+        scrape = RecordStore(directory)
+    else:
+        scrape = ScrapeDirectory(directory)
+    trademark_domains_path = os.path.join(directory, TRADEMARK_DOMAINS_NAME)
+    if os.path.exists(trademark_domains_path):
+        return TrademarkFanOut(scrape, trademark_domains_path)
+    return scrape
+
+# Store that save_output writes to; None keeps writing one file per output
+active_store = None
+
+def use_record_store(directory):
+    """Send everything save_output writes under directory to a record store there."""
+    global active_store
+    active_store = RecordStore(directory, writable=True)
+    return active_store
+
+def flush_record_store():
+    """Make everything save_output has written to the record store durable and indexed."""
+    if active_store is not None:
+        active_store.flush()
+
+def close_record_store():
+    global active_store
+    if active_store is not None:
+        active_store.close()
+        active_store = None
+
+def make_domain_folder(domain_folder):
+    """Create a candidate's output directory, which the record store does without."""
+    if active_store is None:
+        os.makedirs(domain_folder, exist_ok=True)
+
+def save_output(domain_folder, filename, content, append=False):
+    """Write one scrape output file, or its record when a record store is in use."""
+    if active_store is not None:
+        domain = os.path.basename(domain_folder)
+        trademark = os.path.basename(os.path.dirname(domain_folder))
+        active_store.write(trademark, domain, filename[len(domain) + 1:], content, append)
+        return
+    mode = ('a' if append else 'w') + ('b' if isinstance(content, bytes) else '')
+    with open(os.path.join(domain_folder, filename), mode, encoding=None if isinstance(content, bytes) else 'utf-8') as file:
+        file.write(content)
+
+def import_directory(source_directory, store_directory):
+    """Copy a one-directory-per-candidate scrape into a record store."""
+    scrape = ScrapeDirectory(source_directory)
+    store = RecordStore(store_directory, writable=True)
+    num_domains = 0
+    for trademark in scrape.trademarks():
+        for domain in scrape.candidate_domains(trademark):
+            for name, content in scrape.load(trademark, domain).items():
+                store.write(trademark, domain, name, content)
+            num_domains += 1
+    store.close()
+    print(f"Imported {num_domains} candidates from {source_directory} into {store_directory}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Import scrape output into a record store or read it back")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="Copy a scrape directory into a record store")
+    import_parser.add_argument('source')
+    import_parser.add_argument('store')
+    show_parser = subparsers.add_parser('show', help="Print the files stored for one candidate")
+    show_parser.add_argument('store')
+    show_parser.add_argument('trademark')
+    show_parser.add_argument('domain')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        import_directory(args.source, args.store)
+        return
+    scrape = open_scrape(args.store)
+    for name, content in scrape.load(args.trademark, args.domain).items():
+        print(f"== {name} ({len(content)} {'bytes' if isinstance(content, bytes) else 'characters'})")
+        if not isinstance(content, bytes):
+            print(content)
+    scrape.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import os
+import csv
+import time
+import queue
+import threading
+
+QUEUE_SIZE = 10000  # Records waiting for the writer before workers are made to wait
+BATCH_SIZE = 500  # Records the writer takes off the queue at a time
+FLUSH_INTERVAL = 1  # Seconds a written record may sit in a file buffer
+FLUSHED = object()  # Marks calls from submit_after_flush
+
+class ResultSink:
+    """One writer thread for the outputs many workers share.
+
+    Workers hand records to write_row (a row of a CSV added with add_csv) or submit (any write,
+    such as save_output for a candidate's error file) and carry on; the writer takes them off a
+    bounded queue in batches, writes them through buffered files and flushes every FLUSH_INTERVAL
+    seconds. When the writer falls behind the queue fills up and workers block until it catches up.
+    submit_after_flush holds a call back until everything before it has been flushed.
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.records = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.outputs = {}  # name -> (file, csv writer)
+        self.flush_functions = []  # Called with every flush, after the CSV files
+        self.written = 0
+        self.errors = 0
+        self.blocked = 0  # Puts that had to wait for the writer
+        self.writer = threading.Thread(target=self._run, daemon=True)
+        self.writer.start()
+
+    def add_csv(self, name, path, header=None, resume=False):
+        """Open a CSV for write_row(name, ...); resume appends to an existing file instead of starting over."""
+        exists = resume and os.path.exists(path)
+        file = open(path, 'a' if exists else 'w', newline='', buffering=1024 * 1024)
+        writer = csv.writer(file)
+        if header and not exists:
+            writer.writerow(header)
+        self.outputs[name] = (file, writer)
+
+    def add_flush(self, function):
+        """Call function() whenever the outputs are flushed, for writes that go elsewhere such as a record store."""
+        self.flush_functions.append(function)
+
+    def _put(self, record):
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.blocked += 1
+            self.records.put(record)
+
+    def write_row(self, name, row):
+        self._put((name, row))
+
+    def submit(self, function, *args, **kwargs):
+        """Call function(*args, **kwargs) on the writer thread."""
+        self._put((function, (args, kwargs)))
+
+    def submit_after_flush(self, function, *args, **kwargs):
+        """Call function(*args, **kwargs) on the writer thread once what was handed in before it is flushed to the files."""
+        self._put((FLUSHED, (function, (args, kwargs))))
+
+    def _write(self, record):
+        target, payload = record
+        try:
+            if callable(target):
+                args, kwargs = payload
+                target(*args, **kwargs)
+            else:
+                self.outputs[target][1].writerow(payload)
+            self.written += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"Result sink could not write to {getattr(target, '__name__', target)}: {e}")
+
+    def _flush(self):
+        # Synced, so that nothing run after the flush, such as the journal, reaches disk ahead of these rows
+        for file, _ in self.outputs.values():
+            file.flush()
+            os.fsync(file.fileno())
+        for function in self.flush_functions:
+            try:
+                function()
+            except Exception as e:
+                self.errors += 1
+                print(f"Result sink could not flush {getattr(function, '__name__', function)}: {e}")
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                batch = [self.records.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while batch and batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            after_flush = []
+            for record in batch:
+                if record is None:
+                    self._flush()
+                    for call in after_flush:
+                        self._write(call)
+                    return
+                if record[0] is FLUSHED:
+                    after_flush.append(record[1])
+                else:
+                    self._write(record)
+            now = time.monotonic()
+            if after_flush or now - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = now
+            for call in after_flush:
+                self._write(call)
+
+    def close(self):
+        """Write everything still queued, then close the outputs."""
+        self.records.put(None)
+        self.writer.join()
+        for file, _ in self.outputs.values():
+            file.close()
+        print(f"Result sink wrote {self.written} records ({self.errors} failed); "
+              f"workers waited on a full queue {self.blocked} times")
@@ -0,0 +1,52 @@
+import ipaddress
+
+# Name server domains of domain parking and for-sale landing page services
+PARKING_NAMESERVERS = [
+    'sedoparking.com', 'parkingcrew.net', 'bodis.com', 'above.com', 'parklogic.com', 'dan.com',
+    'afternic.com', 'uniregistrymarket.link', 'fabulous.com', 'voodoo.com', 'rookdns.com',
+    'dsredirection.com', 'parkingspa.com', 'ztomy.com', 'smartname.com',
+]
+PARKING_ASNS = {47846}  # SEDO GmbH
+PARKING_NETWORKS = []  # CIDR ranges of parking servers, e.g. '192.0.2.0/24'
+
+# Later stages each verdict on the DNS records skips; the cheaper stages that decided it always run first.
+# 'http' is the plain HTTP fetch of webscraper.py and 'browser' rendering the page in Chrome.
+CASCADE_RULES = {
+    'nxdomain': ['whois', 'cert', 'http', 'browser'],
+    'no_address': ['cert', 'http', 'browser'],
+    'parked': ['browser'],
+}
+SKIP_REASONS = {
+    'nxdomain': "DNS says the domain does not exist",
+    'no_address': "no A record",
+    'parked': "name servers or address belong to a parking service",
+}
+SKIPPED_STAGES_HEADER = ['Trademark', 'Domain', 'Stage', 'Reason']
+
+def parking_nameserver(nameserver):
+    nameserver = nameserver.lower().rstrip('.')
+    return any(nameserver == parking or nameserver.endswith('.' + parking) for parking in PARKING_NAMESERVERS)
+
+def parking_address(ip_address, ip_info):
+    if ip_info and ip_info.get('asn') in PARKING_ASNS:
+        return True
+    try:
+        address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in PARKING_NETWORKS)
+
+def is_parked(dns_records):
+    """Whether a domain's .dns.json records point at a parking service, by name server or address."""
+    nameservers = dns_records.get('NS')
+    if isinstance(nameservers, list) and any(parking_nameserver(nameserver) for nameserver in nameservers):
+        return True
+    ip_info = dns_records.get('IP_Info') or {}
+    addresses = dns_records.get('A')
+    return isinstance(addresses, list) and any(parking_address(address, ip_info.get(address)) for address in addresses)
+
+def skip_reason(verdict, stage, rules=CASCADE_RULES):
+    """Why stage is skipped for a domain with this DNS verdict, or None when it runs."""
+    if verdict and stage in rules.get(verdict, ()):
+        return SKIP_REASONS[verdict]
+    return None
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import Counter
+
+STAGES = ['dns', 'whois', 'cert']
+MAX_ATTEMPTS = 3  # A stage that keeps failing is left alone after this many runs
+FSYNC_INTERVAL = 1  # Seconds of finished work a crash can lose
+PROGRESS_INTERVAL = 60
+
+class ScrapeJournal:
+    """Append-only journal of finished (trademark, domain, stage) work, so a scrape can be resumed.
+
+    Every stage a worker finishes is appended as one JSON line, successful or not; on start the
+    journal is replayed to find what is left. A stage is pending until it has succeeded or failed
+    MAX_ATTEMPTS times, and a candidate is skipped once none of its stages are pending. A stage the
+    scrape cascade skipped stays pending while a stage before it is, since that stage's next run may
+    decide differently.
+    """
+
+    def __init__(self, path, stages=STAGES, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.stages = stages
+        self.max_attempts = max_attempts
+        self.entries = {}  # (trademark, domain) -> {stage: (ok, flag, attempts, error, ip_address, verdict, skipped)}
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.started = time.time()
+        self.last_sync = self.last_report = time.monotonic()
+
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # The last line of a run that crashed mid-write
+                    self._apply(record)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a')
+
+    def _apply(self, record):
+        stages = self.entries.setdefault((record['trademark'], record['domain']), {})
+        attempts = stages[record['stage']][2] + 1 if record['stage'] in stages else 1
+        stages[record['stage']] = (record['ok'], record.get('flag', 0), attempts, record.get('error'),
+                                   record.get('ip_address'), record.get('verdict'), record.get('skipped'))
+
+    def pending_stages(self, trademark, domain):
+        """Stages still to run for a candidate, in order."""
+        with self.lock:
+            stages = self.entries.get((trademark, domain), {})
+            pending = []
+            for stage in self.stages:
+                if (stage not in stages or (not stages[stage][0] and stages[stage][2] < self.max_attempts)
+                        or (stages[stage][6] and pending)):
+                    pending.append(stage)
+            return pending
+
+    def result(self, trademark, domain, stage):
+        """(ok, flag, attempts, error, ip_address, verdict, skipped) from the last run of a stage, or None."""
+        with self.lock:
+            return self.entries.get((trademark, domain), {}).get(stage)
+
+    def record(self, trademark, domain, stage, ok, flag=0, error=None, ip_address=None, verdict=None, skipped=None):
+        """Append a finished stage; verdict is what the DNS records said and skipped why the cascade did not run it."""
+        record = {'trademark': trademark, 'domain': domain, 'stage': stage, 'ok': ok, 'flag': flag}
+        if error:
+            record['error'] = error
+        if ip_address:
+            record['ip_address'] = ip_address
+        if verdict:
+            record['verdict'] = verdict
+        if skipped:
+            record['skipped'] = skipped
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self._apply(record)
+            self.file.write(line)
+            self.recorded += 1
+            now = time.monotonic()
+            if now - self.last_sync >= FSYNC_INTERVAL:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.last_sync = now
+            report = now - self.last_report >= PROGRESS_INTERVAL
+            if report:
+                self.last_report = now
+        if report:
+            self.print_progress()
+
+    def progress(self):
+        """Counts of candidates and stages by state."""
+        with self.lock:
+            counts = Counter()
+            for stages in self.entries.values():
+                complete = True
+                for stage in self.stages:
+                    if stage not in stages:
+                        complete = False
+                    elif stages[stage][6]:
+                        counts[f'{stage}_skipped'] += 1
+                    elif stages[stage][0]:
+                        counts[f'{stage}_ok'] += 1
+                    elif stages[stage][2] >= self.max_attempts:
+                        counts[f'{stage}_gave_up'] += 1
+                    else:
+                        counts[f'{stage}_failed'] += 1
+                        complete = False
+                counts['complete' if complete else 'incomplete'] += 1
+            return dict(counts)
+
+    def print_progress(self):
+        elapsed = time.time() - self.started
+        progress = self.progress()
+        print(f"Journal: {progress.get('complete', 0)} candidates complete, {progress.get('incomplete', 0)} incomplete; "
+              f"{self.recorded} stages this run ({self.recorded / max(elapsed, 1):.1f}/s); "
+              + ', '.join(f"{key} {value}" for key, value in sorted(progress.items())
+                          if key not in ('complete', 'incomplete')))
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python scrape_journal.py <journal.jsonl>")
+        sys.exit(1)
+    journal = ScrapeJournal(sys.argv[1])
+    journal.print_progress()
+    journal.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import ssl
+import json
+import time
+import socket
+import asyncio
+import threading
+import functools
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = 8000
+# Upper bounds in seconds of the latency histogram buckets; slower calls only count towards +Inf
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120]
+
+class StageError(str):
+    """Error message a stage returns when it failed, with the outcome of the exception behind it.
+
+    Messages that are plain strings report an answer instead, such as a domain that does not exist.
+    """
+
+    def __new__(cls, message, outcome='error'):
+        error = super().__new__(cls, message)
+        error.outcome = outcome
+        return error
+
+    @classmethod
+    def from_exception(cls, message, exception):
+        return cls(message, exception_outcome(exception))
+
+def error_outcome(error_message):
+    """Outcome of a stage that returns an error message, empty when it succeeded."""
+    if not error_message:
+        return 'success'
+    return getattr(error_message, 'outcome', 'error')
+
+def status_outcome(result):
+    """Outcome of a DNS query returning (status, ...), e.g. nxdomain or timeout."""
+    return 'success' if result[0] == 'ok' else result[0]
+
+def http_outcome(result):
+    """Outcome of a page fetch returning (status, ...)."""
+    return 'success' if result[0] < 400 else 'http_error'
+
+def certificate_outcome(result):
+    """Outcome of a certificate stage returning (error_message, error_flag)."""
+    error_message, error_flag = result
+    if not error_message:
+        return 'success'
+    if error_flag == 1:
+        return 'ssl_error'  # Saved unverified
+    return 'timeout' if error_outcome(error_message) == 'timeout' else 'error'
+
+def exception_outcome(exception):
+    # Selenium and dnspython timeouts do not derive from TimeoutError
+    if isinstance(exception, (asyncio.TimeoutError, socket.timeout, TimeoutError)) or 'Timeout' in type(exception).__name__:
+        return 'timeout'
+    if isinstance(exception, (ssl.SSLError, ssl.CertificateError)):
+        return 'ssl_error'
+    return 'error'
+
+class StageObservation:
+    """What metrics.stage() yields; set outcome before the block ends to record something other than success."""
+
+    def __init__(self):
+        self.outcome = 'success'
+
+class ScrapeMetrics:
+    """Latency histograms, outcome counters and in-flight gauges for each stage of a scrape.
+
+    Stages are timed with the timed decorator or the stage context manager, from threads or the
+    event loop alike. serve() exposes everything in the Prometheus text format and write_summary()
+    saves it with estimated percentiles at the end of a run.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0,
+                                  'outcomes': Counter(), 'in_flight': 0}
+        return self.stages[stage]
+
+    def start(self, stage):
+        with self.lock:
+            self._stage(stage)['in_flight'] += 1
+        return time.monotonic()
+
+    def finish(self, stage, started, outcome):
+        seconds = time.monotonic() - started
+        bucket = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self.lock:
+            metrics = self._stage(stage)
+            metrics['in_flight'] -= 1
+            metrics['buckets'][bucket] += 1
+            metrics['sum'] += seconds
+            metrics['count'] += 1
+            metrics['max'] = max(metrics['max'], seconds)
+            metrics['outcomes'][outcome] += 1
+
+    def stage(self, stage):
+        """Context manager timing a block as one call of stage."""
+        return StageTimer(self, stage)
+
+    def timed(self, stage, outcome=error_outcome):
+        """Decorator timing every call of a function or coroutine function as stage.
+
+        outcome(result) names what a call that returned ended in; one that raised is classified by its exception.
+        """
+        def decorate(function):
+            if asyncio.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def timed_coroutine(*args, **kwargs):
+                    started = self.start(stage)
+                    try:
+                        result = await function(*args, **kwargs)
+                    except BaseException as e:
+                        self.finish(stage, started, exception_outcome(e))
+                        raise
+                    self.finish(stage, started, outcome(result))
+                    return result
+                return timed_coroutine
+
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                started = self.start(stage)
+                try:
+                    result = function(*args, **kwargs)
+                except BaseException as e:
+                    self.finish(stage, started, exception_outcome(e))
+                    raise
+                self.finish(stage, started, outcome(result))
+                return result
+            return timed_function
+        return decorate
+
+    def _percentile(self, metrics, fraction):
+        """Upper bound of the bucket the fraction-th call fell in."""
+        rank = fraction * metrics['count']
+        seen = 0
+        for bound, count in zip(self.buckets, metrics['buckets']):
+            seen += count
+            if seen >= rank:
+                return min(bound, round(metrics['max'], 3))
+        return metrics['max']
+
+    def summary(self):
+        with self.lock:
+            summary = {'elapsed_seconds': round(time.time() - self.started, 1), 'stages': {}}
+            for stage, metrics in sorted(self.stages.items()):
+                summary['stages'][stage] = {
+                    'count': metrics['count'],
+                    'in_flight': metrics['in_flight'],
+                    'outcomes': dict(metrics['outcomes']),
+                    'total_seconds': round(metrics['sum'], 1),
+                    'mean_seconds': round(metrics['sum'] / metrics['count'], 3) if metrics['count'] else None,
+                    'p50_seconds': self._percentile(metrics, 0.5) if metrics['count'] else None,
+                    'p90_seconds': self._percentile(metrics, 0.9) if metrics['count'] else None,
+                    'p99_seconds': self._percentile(metrics, 0.99) if metrics['count'] else None,
+                    'max_seconds': round(metrics['max'], 3),
+                    'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], metrics['buckets'])),
+                }
+            return summary
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = ['# HELP scrape_stage_seconds Time spent in each call of a scrape stage.',
+                 '# TYPE scrape_stage_seconds histogram']
+        with self.lock:
+            stages = sorted(self.stages.items())
+            for stage, metrics in stages:
+                cumulative = 0
+                for bound, count in zip(self.buckets + ['+Inf'], metrics['buckets']):
+                    cumulative += count
+                    lines.append(f'scrape_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'scrape_stage_seconds_sum{{stage="{stage}"}} {metrics["sum"]:.6f}')
+                lines.append(f'scrape_stage_seconds_count{{stage="{stage}"}} {metrics["count"]}')
+            lines += ['# HELP scrape_stage_outcomes_total Calls of a scrape stage by how they ended.',
+                      '# TYPE scrape_stage_outcomes_total counter']
+            for stage, metrics in stages:
+                for outcome, count in sorted(metrics['outcomes'].items()):
+                    lines.append(f'scrape_stage_outcomes_total{{stage="{stage}",outcome="{outcome}"}} {count}')
+            lines += ['# HELP scrape_stage_in_flight Calls of a scrape stage running now.',
+                      '# TYPE scrape_stage_in_flight gauge']
+            for stage, metrics in stages:
+                lines.append(f'scrape_stage_in_flight{{stage="{stage}"}} {metrics["in_flight"]}')
+        lines += ['# HELP scrape_uptime_seconds Seconds since the scrape started.',
+                  '# TYPE scrape_uptime_seconds gauge',
+                  f'scrape_uptime_seconds {time.time() - self.started:.1f}']
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=METRICS_PORT, host='127.0.0.1'):
+        """Serve render() at http://host:port/metrics from a background thread."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            print(f"Not serving scrape metrics on port {port}: {e}")
+            return None
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving scrape metrics at http://{host}:{port}/metrics")
+        return server
+
+    def write_summary(self, path):
+        summary = self.summary()
+        with open(path, 'w') as file:
+            json.dump(summary, file, indent=4)
+        for stage, metrics in summary['stages'].items():
+            print(f"{stage}: {metrics['count']} calls, {metrics['total_seconds']} s in total, "
+                  f"p50 {metrics['p50_seconds']} s, p90 {metrics['p90_seconds']} s, max {metrics['max_seconds']} s, "
+                  + ', '.join(f"{outcome} {count}" for outcome, count in sorted(metrics['outcomes'].items())))
+
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.observation = StageObservation()
+
+    def __enter__(self):
+        self.started = self.metrics.start(self.stage)
+        return self.observation
+
+    def __exit__(self, exc_type, exc, traceback):
+        outcome = exception_outcome(exc) if exc is not None else self.observation.outcome
+        self.metrics.finish(self.stage, self.started, outcome)
+        return False
+
+# Process-wide metrics every scraper module records into
+metrics = ScrapeMetrics()
@@ -0,0 +1,121 @@
+import os
+import ssl
+import _ssl
+import asyncio
+
+import OpenSSL.crypto
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+
+from record_store import save_output
+from scrape_metrics import metrics, certificate_outcome, StageError
+
+TLS_PORT = 443
+TLS_TIMEOUT = 10  # Seconds for the TCP connect and the TLS handshake together
+MAX_HANDSHAKES = 500  # Connections open at once
+
+def unverified_chain(ssl_object):
+    """DER certificates in the order the server sent them."""
+    if hasattr(ssl_object, 'get_unverified_chain'):
+        chain = ssl_object.get_unverified_chain()  # Python 3.13+
+    else:
+        chain = ssl_object._sslobj.get_unverified_chain()
+    return [certificate if isinstance(certificate, bytes) else certificate.public_bytes(_ssl.ENCODING_DER)
+            for certificate in chain or []]
+
+def load_trust_store():
+    """The CA certificates ssl.create_default_context() trusts, as a pyOpenSSL store."""
+    store = OpenSSL.crypto.X509Store()
+    paths = ssl.get_default_verify_paths()
+    store.load_locations(paths.cafile if paths.cafile and os.path.exists(paths.cafile) else None,
+                         paths.capath if paths.capath and os.path.isdir(paths.capath) else None)
+    return store
+
+def hostname_matches(pattern, hostname):
+    """RFC 6125 matching: a wildcard may only be the whole left-most label and covers exactly one label."""
+    pattern = pattern.lower().rstrip('.')
+    hostname = hostname.lower().rstrip('.')
+    if pattern == hostname:
+        return True
+    if not pattern.startswith('*.'):
+        return False
+    host_labels = hostname.split('.', 1)
+    return len(host_labels) == 2 and host_labels[0] != '' and host_labels[1] == pattern[2:] and '.' in pattern[2:]
+
+def check_hostname(certificate_der, hostname):
+    """Raise ValueError unless the certificate is valid for hostname, as the default context checks it."""
+    certificate = x509.load_der_x509_certificate(certificate_der)
+    try:
+        names = certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        # Without DNS names OpenSSL falls back to the subject common name
+        names = [attribute.value for attribute in certificate.subject.get_attributes_for_oid(NameOID.COMMON_NAME)]
+    hostname = hostname.encode('idna').decode('ascii')
+    if not any(hostname_matches(name, hostname) for name in names):
+        raise ValueError(f"Hostname mismatch, certificate is not valid for '{hostname}'.")
+
+class CertificateGrabber:
+    """Fetches a server's certificate chain with one non-verifying TLS handshake and verifies it offline.
+
+    The handshake sends SNI for the domain but accepts any certificate; the chain it returns is then
+    checked against the system trust store and the hostname, which gives the same verified/unverified
+    split as connecting once with ssl.create_default_context() and once more with CERT_NONE.
+    """
+
+    def __init__(self, max_handshakes=MAX_HANDSHAKES, timeout=TLS_TIMEOUT, port=TLS_PORT):
+        self.timeout = timeout
+        self.port = port
+        self.handshakes = asyncio.Semaphore(max_handshakes)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+        self.trust_store = load_trust_store()
+
+    async def fetch_chain(self, domain, ip_address):
+        """Return the DER chain the server at ip_address presents for domain."""
+        async with self.handshakes:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip_address, self.port, ssl=self.context, server_hostname=domain,
+                                        ssl_handshake_timeout=self.timeout),
+                self.timeout)
+            try:
+                return unverified_chain(writer.get_extra_info('ssl_object'))
+            finally:
+                writer.close()
+
+    def verify(self, chain, domain):
+        """Raise if the chain does not lead to a trusted root or the leaf does not cover domain."""
+        leaf, *intermediates = [OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, certificate)
+                                for certificate in chain]
+        OpenSSL.crypto.X509StoreContext(self.trust_store, leaf, chain=intermediates).verify_certificate()
+        check_hostname(chain[0], domain)
+
+    @metrics.timed('cert', certificate_outcome)
+    async def gather_and_save_certificate_info(self, domain, domain_folder, ip_address):
+        """Async counterpart of gather_and_save_certificate_info_simple, returning (error_message, error_flag).
+
+        error_flag is 0 for a verified certificate, 1 for one saved unverified and 2 when none was fetched.
+        The full chain is saved next to the certificate as {domain}.certificate-chain.
+        """
+        try:
+            chain = await self.fetch_chain(domain, ip_address)
+        except asyncio.TimeoutError:
+            return StageError(f"Socket operation timed out for {ip_address}.", 'timeout'), 2
+        except ssl.SSLError as e:
+            return StageError(f"Could not get SSL certificate for {ip_address}. Error: {e}", 'ssl_error'), 2
+        except OSError as e:
+            return StageError.from_exception(f"Socket error for {ip_address}: {e}", e), 2
+        if not chain:
+            return StageError(f"Could not get SSL certificate for {ip_address}. Error: no certificate presented", 'ssl_error'), 2
+
+        pem_chain = [ssl.DER_cert_to_PEM_cert(certificate) for certificate in chain]
+        save_output(domain_folder, f"{domain}.certificate-chain", ''.join(pem_chain))
+
+        try:
+            self.verify(chain, domain)
+        except (OpenSSL.crypto.X509StoreContextError, OpenSSL.crypto.Error, ValueError) as e:
+            save_output(domain_folder, f"{domain}.certificate-unverified", pem_chain[0])
+            return f"Could not verify SSL certificate for {ip_address}. Error: {e}. Saved it unverified.\n", 1
+
+        save_output(domain_folder, f"{domain}.certificate-verified", pem_chain[0])
+        return "", 0
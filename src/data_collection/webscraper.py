@@ -1,81 +1,227 @@
-import json
 import os
 import time
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
+import queue
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from selenium.common.exceptions import WebDriverException
 
 from webscraper_helper import (gather_and_save_dns_and_ip_info, gather_and_save_whois_info,
-                           gather_and_save_certificate_info, gather_and_save_html_content, 
+                           gather_and_save_certificate_info_simple, gather_and_save_html_content, 
                            gather_and_save_final_url, gather_and_save_favicon, 
                            save_load_time)
+from candidate_io import iter_candidate_pairs, find_candidate_file
+from browser_pool import BrowserPool, NUM_BROWSERS
+from http_tier import HttpTier
+from record_store import save_output, make_domain_folder, use_record_store, close_record_store
+from scrape_metrics import metrics, METRICS_PORT
+from result_sink import ResultSink
+from scrape_cascade import skip_reason, SKIPPED_STAGES_HEADER
 
 BASE_DIR = 'data/processed'
-CANDIDATE_DOMAIN_PATH = 'data/raw/candidate_domains_filtered.json'
+CANDIDATE_DOMAIN_PATH = find_candidate_file('data/raw/candidate_domains_filtered')
+USE_HTTP_TIER = True  # Fetch pages over plain HTTP first and only render the ones that need it in a browser
+NUM_INFO_THREADS = 64  # Threads collecting DNS, WHOIS and certificates alongside the HTTP tier
+MAX_HTTP_IN_FLIGHT = 500
+USE_RECORD_STORE = False  # Append output to segment files in BASE_DIR instead of one directory per candidate
+SERVE_METRICS = True  # Serve per-stage metrics at http://127.0.0.1:METRICS_PORT/metrics while scraping
+METRICS_SUMMARY_PATH = os.path.join(BASE_DIR, 'metrics_summary.json')
+# Skip the stages scrape_cascade.CASCADE_RULES rules out by what the DNS records say, e.g. the browser
+# for a parked domain, and list each skip in SKIPPED_STAGES_PATH
+USE_CASCADE = True
+SKIPPED_STAGES_PATH = os.path.join(BASE_DIR, 'skipped_stages.csv')
+
+sink = None  # ResultSink that writes skipped_stages.csv when USE_CASCADE is set
 
 def save_error(domain_folder, domain, errors):
-    error_file = os.path.join(domain_folder, f"{domain}.loadtime.txt")
-    with open(error_file, 'a') as file:
-        for error in errors:
-            file.write(error + '\n' + '-' * 50 + '\n')
-
-def main():
-    with open(CANDIDATE_DOMAIN_PATH, 'r') as file:
-        data = json.load(file)
-    
-    options = Options()
-    options.headless = True
-
-    counter = 0
-    
-    for trademark, domains in data.items():
-        for domain in domains:
-            if counter > 10:
-                return
-            counter += 1
-            domain_folder = os.path.join(BASE_DIR, trademark, domain)
-            os.makedirs(domain_folder, exist_ok=True)
-
-            errors = []
-
-            error_message = gather_and_save_dns_and_ip_info(domain, domain_folder)
-            if error_message:
-                errors.append(error_message)
-
-            error_message = gather_and_save_whois_info(domain, domain_folder)
-            if error_message:
-                errors.append(error_message)
-
-            try:
-                with webdriver.Chrome(options=options) as browser:
-                    start_time = time.time()
-                    browser.get(f"http://{domain}")
-                    end_time = time.time()
-
-                    error_message = gather_and_save_html_content(browser, domain, domain_folder)
-                    if error_message:
-                        errors.append(error_message)
-
-                    error_message = gather_and_save_certificate_info(browser, domain, domain_folder)
-                    if error_message:
-                        errors.append(error_message)
-
-                    error_message = gather_and_save_final_url(browser, domain, domain_folder)
-                    if error_message:
-                        errors.append(error_message)
-
-                    error_message = gather_and_save_favicon(domain, domain_folder, browser.current_url)
-                    if error_message:
-                        errors.append(error_message)
-
-                    error_message = save_load_time(end_time - start_time, domain, domain_folder)
-                    if error_message:
-                        errors.append(error_message)
-            except WebDriverException as e:
-                errors.append(f"Failed to load {domain}. Error: {e}")
-
+    save_output(domain_folder, f"{domain}.loadtime.txt", ''.join(error + '\n' + '-' * 50 + '\n' for error in errors),
+                append=True)
+
+def cascade_skip(verdict, stage):
+    """Why the cascade skips stage for a domain with this DNS verdict, or None when it runs."""
+    return skip_reason(verdict, stage) if USE_CASCADE else None
+
+def skip_stage(trademark, domain, stage, reason):
+    sink.write_row('skipped_stages', [trademark, domain, stage, reason])
+
+def gather_domain_info(trademark, domain, domain_folder, dns_result=None):
+    """Collect DNS, WHOIS and certificate information for one candidate and return (errors, DNS verdict).
+
+    dns_result is (ip_address, error_message, verdict) when the DNS stage already ran for this domain.
+    """
+    errors = []
+
+    if dns_result is None:
+        dns_result = gather_and_save_dns_and_ip_info(domain, domain_folder)
+    ip_address, error_message, verdict = dns_result
+    if error_message:
+        errors.append(error_message)
+
+    reason = cascade_skip(verdict, 'whois')
+    if reason:
+        skip_stage(trademark, domain, 'whois', reason)
+    else:
+        error_message = gather_and_save_whois_info(domain, domain_folder)
+        if error_message:
+            errors.append(error_message)
+
+    reason = cascade_skip(verdict, 'cert')
+    if reason:
+        skip_stage(trademark, domain, 'cert', reason)
+    elif ip_address:
+        error_message, _ = gather_and_save_certificate_info_simple(domain, domain_folder, ip_address)
+        if error_message:
+            errors.append(error_message)
+    return errors, verdict
+
+def scrape_page(browser, task):
+    """Render one candidate's page with a browser from the pool and save its content."""
+    trademark, domain = task[:2]
+    errors = list(task[2]) if len(task) > 2 else []
+    domain_folder = os.path.join(BASE_DIR, trademark, domain)
+    make_domain_folder(domain_folder)
+
+    try:
+        start_time = time.time()
+        with metrics.stage('page_load'):
+            browser.get(f"http://{domain}")
+        end_time = time.time()
+
+        error_message = gather_and_save_html_content(browser, domain, domain_folder)
+        if error_message:
+            errors.append(error_message)
+
+        error_message = gather_and_save_final_url(browser, domain, domain_folder)
+        if error_message:
+            errors.append(error_message)
+
+        error_message = gather_and_save_favicon(domain, domain_folder, browser.current_url, browser.page_source)
+        if error_message:
+            errors.append(error_message)
+
+        error_message = save_load_time(end_time - start_time, domain, domain_folder)
+        if error_message:
+            errors.append(error_message)
+    except WebDriverException as e:
+        errors.append(f"Failed to load {domain}. Error: {e}")
+
+    if errors:
+        save_error(domain_folder, domain, errors)
+
+@metrics.timed('domain')
+def scrape_domain(browser, task):
+    """Collect everything for one candidate with a browser from the pool."""
+    trademark, domain = task
+    domain_folder = os.path.join(BASE_DIR, trademark, domain)
+    make_domain_folder(domain_folder)
+    errors, verdict = gather_domain_info(trademark, domain, domain_folder)
+    reason = cascade_skip(verdict, 'browser')
+    if reason:
+        skip_stage(trademark, domain, 'browser', reason)
+        if errors:
+            save_error(domain_folder, domain, errors)
+        return
+    scrape_page(browser, (trademark, domain, errors))
+
+async def run_http_tier(candidates, escalate, max_in_flight=MAX_HTTP_IN_FLIGHT):
+    """Fetch every candidate over HTTP, passing (trademark, domain, errors) for pages that need a browser to escalate.
+
+    DNS comes first, so the cascade can skip the fetch or the browser; WHOIS and certificates run alongside the fetch.
+    """
+    loop = asyncio.get_running_loop()
+    info_executor = ThreadPoolExecutor(max_workers=NUM_INFO_THREADS)
+    counts = {'http': 0, 'browser': 0, 'skipped': 0}
+
+    async def handle(trademark, domain):
+        domain_folder = os.path.join(BASE_DIR, trademark, domain)
+        make_domain_folder(domain_folder)
+        dns_result = await loop.run_in_executor(info_executor, gather_and_save_dns_and_ip_info, domain, domain_folder)
+        verdict = dns_result[2]
+        info = loop.run_in_executor(info_executor, gather_domain_info, trademark, domain, domain_folder, dns_result)
+
+        if cascade_skip(verdict, 'http'):
+            counts['skipped'] += 1
+            for stage in ('http', 'browser'):
+                if cascade_skip(verdict, stage):
+                    skip_stage(trademark, domain, stage, cascade_skip(verdict, stage))
+            info_errors, _ = await info
+            if info_errors:
+                save_error(domain_folder, domain, info_errors)
+            return
+
+        (info_errors, _), (escalated, page_errors) = await asyncio.gather(info, http_tier.fetch_and_save(domain, domain_folder))
+        reason = cascade_skip(verdict, 'browser')
+        if escalated and reason:
+            skip_stage(trademark, domain, 'browser', reason)
+            escalated = False
+        if escalated:
+            counts['browser'] += 1
+            # Blocks while the browsers are behind, which holds this slot and so the HTTP tier back
+            await loop.run_in_executor(None, escalate, (trademark, domain, info_errors))
+        else:
+            counts['http'] += 1
+            errors = info_errors + page_errors
             if errors:
                 save_error(domain_folder, domain, errors)
 
+    slots = asyncio.Semaphore(max_in_flight)
+
+    async def bounded(trademark, domain):
+        try:
+            await handle(trademark, domain)
+        except Exception as e:
+            print(f"Error processing {domain}: {e}")
+        finally:
+            slots.release()
+
+    async with HttpTier() as http_tier:
+        tasks = set()
+        for trademark, domain in candidates:
+            await slots.acquire()
+            task = asyncio.create_task(bounded(trademark, domain))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    info_executor.shutdown()
+    print(f"HTTP tier handled {counts['http']} domains, escalated {counts['browser']} to the browser pool, "
+          f"skipped {counts['skipped']} without a page to fetch")
+
+def main(num_browsers=NUM_BROWSERS, use_http_tier=USE_HTTP_TIER):
+    global sink
+    t1 = time.time()
+    os.makedirs(BASE_DIR, exist_ok=True)
+    if USE_RECORD_STORE:
+        use_record_store(BASE_DIR)
+    if SERVE_METRICS:
+        metrics.serve(METRICS_PORT)
+    if USE_CASCADE:
+        sink = ResultSink()
+        sink.add_csv('skipped_stages', SKIPPED_STAGES_PATH, SKIPPED_STAGES_HEADER)
+    pool = BrowserPool(num_browsers=num_browsers)
+    candidates = iter_candidate_pairs(CANDIDATE_DOMAIN_PATH)
+
+    if use_http_tier:
+        escalated = queue.Queue(maxsize=num_browsers * 4)
+
+        def http_stage():
+            try:
+                asyncio.run(run_http_tier(candidates, escalated.put))
+            finally:
+                escalated.put(None)
+
+        http_thread = threading.Thread(target=http_stage)
+        http_thread.start()
+        pool.run(iter(escalated.get, None), scrape_page)
+        http_thread.join()
+    else:
+        num_tasks = pool.run(candidates, scrape_domain)
+        print("Number of domains:", num_tasks)
+
+    if sink:
+        sink.close()
+    close_record_store()
+    metrics.write_summary(METRICS_SUMMARY_PATH)
+    print(f"Total time: {round(time.time() - t1, 2)} seconds")
+
 if __name__ == "__main__":
     main()
@@ -1,5 +1,5 @@
 import json
-import os
+import time
 import dns.resolver
 import whois
 import socket
@@ -8,33 +8,69 @@ import ssl
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlsplit, urlunsplit
-import geoip2.database
-import geoip2.errors
 import OpenSSL.crypto
 
+from ip_enrichment import get_enricher, record_addresses
+from record_store import save_output
+from scrape_metrics import metrics, status_outcome, certificate_outcome, StageError
+from dns_cache import dns_cache, negative_ttl, NEGATIVE_TTL
+from scrape_cascade import is_parked
+
+RECORD_TYPES = ['A', 'NS', 'SOA', 'AAAA', 'CNAME', 'MX', 'TXT']
+
+# Message saved in .dns.json for each failed lookup status
+DNS_ERRORS = {
+    'no_answer': "ERROR: No answer",
+    'nxdomain': "ERROR: Domain does not exist",
+    'no_nameservers': "ERROR: No DNS servers found",
+    'timeout': "ERROR: DNS Lifetime Timeout",
+}
+
+@metrics.timed('dns', status_outcome)
+def query_record(resolver, domain, record_type):
+    """Ask the resolver for one record type and return (status, records, ttl)."""
+    try:
+        answers = resolver.resolve(domain, record_type, raise_on_no_answer=False)
+        # The answer expires with its lowest TTL, or the SOA minimum when it is empty
+        ttl = answers.expiration - time.time()
+        if answers.rrset is None:
+            return 'no_answer', None, ttl
+        return 'ok', [str(rdata) for rdata in answers], ttl
+    except dns.resolver.NXDOMAIN as e:
+        response = next(iter(e.responses().values()), None)
+        # Records of a CNAME chain whose target does not exist, which the cache keeps per record type
+        chain = [str(rdata) for rrset in response.answer for rdata in rrset] if response is not None else []
+        return 'nxdomain', chain or None, negative_ttl(response)
+    except dns.resolver.NoNameservers:
+        return 'no_nameservers', None, NEGATIVE_TTL
+    except dns.resolver.LifetimeTimeout:
+        return 'timeout', None, None
+
+def resolve_record(resolver, domain, record_type):
+    """Resolve one record type through the shared DNS cache and return (status, records)."""
+    cached = dns_cache.get(domain, record_type)
+    if cached is not None:
+        return cached
+
+    status, records, ttl = query_record(resolver, domain, record_type)
+    if status != 'timeout':
+        dns_cache.put(domain, record_type, status, records, ttl)
+    return status, records
+
 def gather_and_save_dns_and_ip_info(domain, domain_folder):
     """Fetch and save DNS information for a given domain."""
     dns_records = {}
-    record_types = ['A', 'NS', 'SOA', 'AAAA', 'CNAME', 'MX', 'TXT']
+    record_types = RECORD_TYPES
 
     resolver = dns.resolver.Resolver()
     resolver.timeout = 5
     resolver.lifetime = 15
 
-    error_message = ""
-
+    # A is asked first, so an NXDOMAIN answers the remaining types from the cache
     for record_type in record_types:
-        try:
-            answers = resolver.resolve(domain, record_type)
-            dns_records[record_type] = [str(rdata) for rdata in answers]
-        except dns.resolver.NoAnswer:
-            dns_records[record_type] = "ERROR: No answer"
-        except dns.resolver.NXDOMAIN:
-            dns_records[record_type] = "ERROR: Domain does not exist"
-        except dns.resolver.NoNameservers:
-            dns_records[record_type] = "ERROR: No DNS servers found"
-        except dns.resolver.LifetimeTimeout:
-            dns_records[record_type] = "ERROR: DNS Lifetime Timeout"
+        status, records = resolve_record(resolver, domain, record_type)
+        dns_records[record_type] = records if status == 'ok' else DNS_ERRORS[status]
+        if status == 'timeout':
             break
     
     # Fill in the remaining record types with "ERROR: DNS Lifetime Timeout"
@@ -42,47 +78,72 @@ def gather_and_save_dns_and_ip_info(domain, domain_folder):
     for remaining_record_type in remaining_record_types:
         dns_records[remaining_record_type] = "ERROR: DNS Lifetime Timeout"
 
+    return save_dns_and_ip_info(domain, domain_folder, dns_records)
+
+def dns_verdict(dns_records, ip_address):
+    """What the DNS records say about a domain for the scrape cascade: 'nxdomain', 'no_address', 'parked' or None."""
+    # Behind a dangling CNAME the domain itself exists; only the CNAME target does not
+    if dns_records.get('A') == DNS_ERRORS['nxdomain'] and not isinstance(dns_records.get('CNAME'), list):
+        return 'nxdomain'
+    if is_parked(dns_records):
+        return 'parked'
+    if ip_address is None and dns_records.get('A') != DNS_ERRORS['timeout']:
+        return 'no_address'
+    return None
+
+def save_dns_and_ip_info(domain, domain_folder, dns_records, ip_info=None):
+    """Pick an IP address from the A records, add AS numbers and save the DNS records for a domain.
+
+    ip_info is {ip: info} for the A and AAAA addresses when they were already enriched in a batch.
+    Returns (ip_address, error_message, verdict), verdict being what dns_verdict makes of the records.
+    """
+    error_message = ""
+
+    if record_addresses(dns_records):
+        # AS number, prefix and country for every A/AAAA address from the process-wide GeoLite2 reader
+        if ip_info is None:
+            with metrics.stage('asn') as observation:
+                ip_info = get_enricher().enrich(dns_records)
+                if None in ip_info.values():
+                    observation.outcome = 'not_found'
+        dns_records["IP_Info"] = ip_info
+
     if 'A' in dns_records and dns_records['A'] and isinstance(dns_records['A'], list):
         ip_address = random.choice(dns_records['A'])
-
-        # Get AS_Number to the DNS records using GeoLite2-ASN.mmdb and geoip2
-        try:
-            with geoip2.database.Reader('GeoLite2-ASN.mmdb') as reader:
-                response = reader.asn(ip_address)
-                dns_records["AS_Number"] = response.autonomous_system_number
-        except geoip2.errors.AddressNotFoundError:
+        if ip_info[ip_address] is not None:
+            dns_records["AS_Number"] = ip_info[ip_address]['asn']
+        else:
             error_message += f"Address not found in the GeoIP database for IP Address {ip_address}."
 
+    elif dns_records.get('A') == DNS_ERRORS['timeout']:
+        ip_address = None
+        error_message = StageError(f"DNS lookup timed out for: {domain}\n", 'timeout')
     else:
         ip_address = None
         error_message += f"IP Address not found for: {domain}\n"
     
-    filename = os.path.join(domain_folder, f"{domain}.dns.json")
-    with open(filename, 'w') as file:
-        json.dump(dns_records, file, indent=4)
+    save_output(domain_folder, f"{domain}.dns.json", json.dumps(dns_records, indent=4))
 
-    return ip_address, error_message
+    return ip_address, error_message, dns_verdict(dns_records, ip_address)
 
+@metrics.timed('whois')
 def gather_and_save_whois_info(domain, domain_folder):
     """Fetch and save WHOIS information for a given domain."""
     try:
         who_is_data = whois.whois(domain)
-        filename = os.path.join(domain_folder, f"{domain}.whois.json")
-        
-        with open(filename, 'w') as file:
-            json.dump(who_is_data, file, indent=4, default=str)
+        save_output(domain_folder, f"{domain}.whois.json", json.dumps(who_is_data, indent=4, default=str))
     except Exception as e:
-        return f"Failed to fetch or save WHOIS information for {domain}. Error: {e}"
+        return StageError.from_exception(f"Failed to fetch or save WHOIS information for {domain}. Error: {e!r}", e)
 
+@metrics.timed('cert', certificate_outcome)
 def gather_and_save_certificate_info_simple(domain, domain_folder, ip_address):
     """Fetch and save SSL certificate information for a domain."""
-    cert_file_verified = os.path.join(domain_folder, f"{domain}.certificate-verified")
-    cert_file_unverified = os.path.join(domain_folder, f"{domain}.certificate-unverified")
     base_url = ip_address
 
     exception = False
     error_message = ""
     error_flag = 0
+    outcome = 'error'  # Of a certificate that could not be fetched at all
 
     try:
         context = ssl.create_default_context()
@@ -97,8 +158,7 @@ def gather_and_save_certificate_info_simple(domain, domain_folder, ip_address):
                 x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, binary_cert)
                 pem_cert = OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, x509).decode('utf-8')
 
-                with open(cert_file_verified, "w") as f:
-                    f.write(pem_cert)
+                save_output(domain_folder, f"{domain}.certificate-verified", pem_cert)
 
     except ssl.SSLError as e:
         exception = True
@@ -107,6 +167,7 @@ def gather_and_save_certificate_info_simple(domain, domain_folder, ip_address):
     except socket.timeout:
         error_message +=  f"Socket operation timed out for {base_url} with default context. Will not try with no verify context."
         error_flag = 2
+        outcome = 'timeout'
     except socket.error as e:
         exception = True
         error_message +=  f"Socket error for {base_url} with default context: {e}. Trying no verify context.\n"
@@ -130,8 +191,7 @@ def gather_and_save_certificate_info_simple(domain, domain_folder, ip_address):
                     x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_ASN1, binary_cert)
                     pem_cert = OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, x509).decode('utf-8')
 
-                    with open(cert_file_unverified, "w") as f:
-                        f.write(pem_cert)
+                    save_output(domain_folder, f"{domain}.certificate-unverified", pem_cert)
 
         except ssl.SSLError as e:
             error_message +=  f"Could not get SSL certificate for {base_url} with no verify context. Error: {e}"
@@ -139,36 +199,38 @@ def gather_and_save_certificate_info_simple(domain, domain_folder, ip_address):
         except socket.timeout:
             error_message +=  f"Socket operation timed out for {base_url} with no verify context."
             error_flag = 2
+            outcome = 'timeout'
         except socket.error as e:
             error_message +=  f"Socket error for {base_url} with no verify context: {e}"
             error_flag = 2
 
+    if error_flag == 2:
+        error_message = StageError(error_message, outcome)
     return error_message, error_flag
 
+@metrics.timed('html')
 def gather_and_save_html_content(browser, domain, domain_folder):
     """Fetch and save the HTML content of a domain."""
     html_content = browser.page_source
     
     # Save the fetched HTML content
-    html_filename = os.path.join(domain_folder, f"{domain}.html")
-    with open(html_filename, 'w', encoding="utf-8") as file:
-        file.write(html_content)
+    save_output(domain_folder, f"{domain}.html", html_content)
 
 def gather_and_save_final_url(browser, domain, domain_folder):
     """Save the final URL after all redirects."""
     final_url = browser.current_url
-    filename = os.path.join(domain_folder, f"{domain}.final_url.txt")
-    
-    with open(filename, 'w') as file:
-        file.write(final_url)
+    save_output(domain_folder, f"{domain}.final_url.txt", final_url)
 
-def gather_and_save_favicon(domain, domain_folder, final_url):
-    """Fetch and save the favicon of a domain."""
+@metrics.timed('favicon')
+def gather_and_save_favicon(domain, domain_folder, final_url, html=None):
+    """Fetch and save the favicon of a domain, looking for its link in html when the page is already loaded."""
     try:
-        response = requests.get(final_url, timeout=10)
-        response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
+        if html is None:
+            response = requests.get(final_url, timeout=10)
+            response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
+            html = response.text
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = BeautifulSoup(html, 'html.parser')
         link = soup.find('link', rel='icon') or soup.find('link', rel='shortcut icon')
 
         # If a favicon link is found in the HTML, use it. Otherwise, use the default favicon location
@@ -180,9 +242,7 @@ def gather_and_save_favicon(domain, domain_folder, final_url):
         favicon = requests.get(favicon_url, timeout=10)
         favicon.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
 
-        filename = os.path.join(domain_folder, f"{domain}.favicon.ico")
-        with open(filename, 'wb') as file:
-            file.write(favicon.content)
+        save_output(domain_folder, f"{domain}.favicon.ico", favicon.content)
 
     except requests.Timeout:
         return f"Request timed out for {domain}."
@@ -193,6 +253,4 @@ def gather_and_save_favicon(domain, domain_folder, final_url):
 
 def save_load_time(load_time, domain, domain_folder):
     """Save the site load time."""
-    filename = os.path.join(domain_folder, f"{domain}.loadtime.txt")
-    with open(filename, 'w') as file:
-        file.write(f"Load time for {domain}: {load_time:.2f} seconds\n")
+    save_output(domain_folder, f"{domain}.loadtime.txt", f"Load time for {domain}: {load_time:.2f} seconds\n")
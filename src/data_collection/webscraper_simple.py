@@ -1,99 +1,424 @@
-import json
 import os
-import time
 import csv
+import time
+import socket
+import asyncio
+import threading
+from functools import partial
 from multiprocessing.pool import ThreadPool
 
 from webscraper_helper import (gather_and_save_dns_and_ip_info, gather_and_save_whois_info,
                            gather_and_save_certificate_info_simple)
+from candidate_io import iter_candidate_pairs, find_candidate_file
+from async_dns import collect_dns
+from dns_cache import dns_cache
+from whois_engine import WhoisEngine, gather_and_save_whois_info_async
+from tls_grabber import CertificateGrabber
+from scrape_journal import ScrapeJournal, STAGES
+from record_store import save_output, make_domain_folder, use_record_store, flush_record_store, close_record_store, TRADEMARK_DOMAINS_NAME
+from result_sink import ResultSink
+from concurrency_controller import ConcurrencyController
+from scrape_metrics import metrics, METRICS_PORT, StageError
+from work_queue import open_queue, LeaseKeeper, BATCH_SIZE
+from scrape_cascade import skip_reason, SKIPPED_STAGES_HEADER
 
 BASE_DIR = 'data/simple_scrape'
-CANDIDATE_DOMAIN_PATH = 'data/raw/candidate_domains_filtered.json'
+USE_ASYNC_DNS = True  # Resolve DNS for all candidates in the asyncio stage instead of inside each thread
+USE_WHOIS_ENGINE = True  # With USE_ASYNC_DNS, collect WHOIS through the per-server rate-limited engine
+USE_ASYNC_TLS = True  # With USE_ASYNC_DNS, fetch certificates with one handshake each in the event loop
+CANDIDATE_DOMAIN_PATH = find_candidate_file('data/raw/candidate_domains_filtered')
+USE_JOURNAL = True  # Record finished stages so a rerun resumes where the last run stopped
+JOURNAL_PATH = os.path.join(BASE_DIR, 'journal.jsonl')
+USE_RECORD_STORE = False  # Append output to segment files in BASE_DIR instead of one directory per candidate
+USE_ADAPTIVE_CONCURRENCY = True  # Let a controller set how many candidates are in each stage at once
+NUM_THREADS = 250
+MAX_THREADS = 1000  # Thread pool size when the controller sets the limits, so it is never the bottleneck
+SERVE_METRICS = True  # Serve per-stage metrics at http://127.0.0.1:METRICS_PORT/metrics while scraping
+METRICS_SUMMARY_PATH = os.path.join(BASE_DIR, 'metrics_summary.json')
+# Lease candidates from a work_queue.py queue (an SQLite path, or the http:// URL of its server) instead of
+# reading CANDIDATE_DOMAIN_PATH, so several hosts can share one scrape; a server token is read from $WORK_QUEUE_TOKEN
+WORK_QUEUE = None
+WORKER_SHARDS = None  # Domain shards this worker leases from; None takes any
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+QUEUE_POLL_INTERVAL = 30  # Seconds to wait for other workers' leases to finish or expire
+
+# Scrape each domain once, under the first trademark it is a candidate for, and list the trademarks
+# it belongs to in TRADEMARK_DOMAINS_PATH so analysis can still go through them per trademark.
+# With WORK_QUEUE this holds across hosts because a lease carries every trademark of its domains
+DEDUPE_DOMAINS = True
+TRADEMARK_DOMAINS_PATH = os.path.join(BASE_DIR, TRADEMARK_DOMAINS_NAME)
+TRADEMARK_DOMAINS_HEADER = ['Trademark', 'Domain', 'Scraped Under']
+# Certificate Error is 1 for an unverified certificate, 2 when none was fetched and 3 without an IP address
+ERROR_FLAGS_HEADER = ['Domain', 'DNS Error', 'IP Error', 'WHOIS Error', 'Certificate Error', 'Exception']
+# Skip the stages scrape_cascade.CASCADE_RULES rules out by what the DNS records say, e.g. WHOIS for a
+# domain that does not exist, and list each skip in SKIPPED_STAGES_PATH
+USE_CASCADE = True
+SKIPPED_STAGES_PATH = os.path.join(BASE_DIR, 'skipped_stages.csv')
+
+journal = None  # ScrapeJournal of the current run when USE_JOURNAL is set
+sink = None  # ResultSink that writes domain_errors.csv and the error files for the workers
+controller = None  # ConcurrencyController of the current run when USE_ADAPTIVE_CONCURRENCY is set
+scraped_under = {}  # domain -> trademark it is scraped under
+fanned_out = set()  # (trademark, domain) pairs recorded as scraped under another trademark
 
 def save_error(domain_folder, domain, errors):
-    error_file = os.path.join(domain_folder, f"{domain}.error.txt")
-    with open(error_file, 'w') as file:
-        for error in errors:
-            file.write(error + '\n' + '-' * 50 + '\n')
+    sink.submit(save_output, domain_folder, f"{domain}.error.txt", ''.join(error + '\n' + '-' * 50 + '\n' for error in errors))
 
 def save_error_flags(domain, error_flags):
-    csv_file_path = os.path.join(BASE_DIR, 'domain_errors.csv')
-    with open(csv_file_path, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([domain, error_flags['dns_error'], error_flags['ip_error'], error_flags['whois_error'], error_flags['cert_error'], error_flags['exception']])
+    sink.write_row('domain_errors', [domain, error_flags['dns_error'], error_flags['ip_error'], error_flags['whois_error'], error_flags['cert_error'], error_flags['exception']])
+
+def cascade_skip(verdict, stage):
+    """Why the cascade skips stage for a domain with this DNS verdict, or None when it runs."""
+    return skip_reason(verdict, stage) if USE_CASCADE else None
+
+def skip_stage(trademark, domain, stage, reason, journal_records, flag=0):
+    sink.write_row('skipped_stages', [trademark, domain, stage, reason])
+    if journal:
+        journal_records.append(partial(journal.record, trademark, domain, stage, True, flag, skipped=reason))
+
+def save_journal_records(journal_records):
+    """Journal a candidate's stages once the rows and error files saved for them are flushed, so a crash
+    cannot leave the journal saying a stage is done while its domain_errors.csv row is lost."""
+    if journal_records:
+        sink.submit_after_flush(run_all, journal_records)
+
+def run_all(functions):
+    for function in functions:
+        function()
+
+def stage_outcome(stage, result):
+    """'timeout' or 'error' when a stage failed, else 'ok'; a missing domain or an unverified certificate is an answer."""
+    if stage == 'dns':
+        error_message = result[1]
+    elif stage == 'cert':
+        error_message = result[0]
+    else:
+        error_message = result
+    if isinstance(error_message, StageError):
+        return 'timeout' if error_message.outcome == 'timeout' else 'error'
+    return 'ok'
+
+def run_stage(stage, function, *args):
+    """Run one stage of a candidate, within the controller's limit for the stage when there is one."""
+    if controller:
+        return controller.call(stage, function, *args)
+    return function(*args)
 
-def process_domain(trademark, domain, BASE_DIR):
+def pending_stages(trademark, domain):
+    return journal.pending_stages(trademark, domain) if journal else STAGES
+
+def finished_dns_result(trademark, domain):
+    """(ip_address, error_message, verdict) from the journal when the DNS stage needs no rerun, else None."""
+    if journal and 'dns' not in journal.pending_stages(trademark, domain):
+        _, _, _, error_message, ip_address, verdict, _ = journal.result(trademark, domain, 'dns')
+        return ip_address, error_message or "", verdict
+    return None
+
+@metrics.timed('domain')
+def process_domain(trademark, domain, BASE_DIR, dns_result=None, whois_result=None, cert_result=None):
+    stage = None
+    journal_records = []  # Written by save_journal_records after the candidate's output
     try:
         domain_folder = os.path.join(BASE_DIR, trademark, domain)
-        os.makedirs(domain_folder, exist_ok=True)
+        make_domain_folder(domain_folder)
 
         errors = []
         error_flags = {'dns_error': 0, 'ip_error': 0, 'whois_error': 0, 'cert_error': 0, 'exception': 0}
+        # Stages the journal has as finished are not run again; their earlier results are reported instead
+        stages = pending_stages(trademark, domain)
 
-        ip_address, error_message = gather_and_save_dns_and_ip_info(domain, domain_folder)
+        stage = 'dns'
+        if stage in stages:
+            # dns_result is (ip_address, error_message, verdict) when the DNS stage already ran for this domain
+            if dns_result is None:
+                dns_result = run_stage(stage, gather_and_save_dns_and_ip_info, domain, domain_folder)
+            ip_address, error_message, verdict = dns_result
+            # A domain that does not exist, has no address or is parked is an answer, which the stages
+            # the cascade skips depend on; only timeouts and failures are retried
+            dns_finished = verdict is not None or not isinstance(error_message, StageError)
+            if journal:
+                journal_records.append(partial(journal.record, trademark, domain, stage, dns_finished,
+                                               int(bool(error_message)), error_message, ip_address, verdict))
+        else:
+            ip_address, error_message, verdict = finished_dns_result(trademark, domain)
+            dns_finished = True
         if error_message:
             errors.append(error_message)
             error_flags['dns_error'] = 1
 
-        error_message = gather_and_save_whois_info(domain, domain_folder)
+        stage = 'whois'
+        reason = cascade_skip(verdict, stage)
+        if stage in stages and reason:
+            skip_stage(trademark, domain, stage, reason, journal_records)
+            error_message = None
+        elif stage in stages:
+            # whois_result is (error_message,) when the WHOIS engine already ran for this domain
+            if whois_result is None:
+                whois_result = (run_stage(stage, gather_and_save_whois_info, domain, domain_folder),)
+            error_message, = whois_result
+            if journal:
+                journal_records.append(partial(journal.record, trademark, domain, stage, not error_message,
+                                               int(bool(error_message)), error_message))
+        else:
+            error_message = journal.result(trademark, domain, stage)[3]
         if error_message:
             errors.append(error_message)
             error_flags['whois_error'] = 1
 
-        if ip_address:
-            error_message, error_flag = gather_and_save_certificate_info_simple(domain, domain_folder, ip_address)
-            if error_message:
-                errors.append(error_message)
-                error_flags['cert_error'] = error_flag
+        stage = 'cert'
+        reason = cascade_skip(verdict, stage)
+        if stage in stages and reason:
+            error_message, error_flag = "", 3
+            skip_stage(trademark, domain, stage, reason, journal_records, error_flag)
+        elif stage in stages:
+            if ip_address:
+                # cert_result is (error_message, error_flag) when the certificate grabber already ran for this domain
+                if cert_result is None:
+                    cert_result = run_stage(stage, gather_and_save_certificate_info_simple, domain, domain_folder, ip_address)
+                error_message, error_flag = cert_result
+                error_flag = error_flag if error_message else 0
+            else:
+                error_message, error_flag = "", 3
+            if journal:
+                # An unverified certificate is a result, and so is no IP address once DNS is finished;
+                # no certificate is tried again
+                journal_records.append(partial(journal.record, trademark, domain, stage,
+                                               error_flag in (0, 1) or (error_flag == 3 and dns_finished),
+                                               error_flag, error_message))
         else:
+            _, error_flag, _, error_message, _, _, _ = journal.result(trademark, domain, stage)
+        if error_message:
+            errors.append(error_message)
+        error_flags['cert_error'] = error_flag
+        if not ip_address:
             error_flags['ip_error'] = 1
-            error_flags['cert_error'] = 3
 
         if errors:
             save_error(domain_folder, domain, errors)
         
         save_error_flags(domain, error_flags)
+        save_journal_records(journal_records)
 
     except Exception as e:
+        if journal and stage:
+            journal_records.append(partial(journal.record, trademark, domain, stage, False, error=f"Exception: {e}"))
         error_flags['exception'] = str(e)
         save_error_flags(domain, error_flags)
+        save_journal_records(journal_records)
         print(f"Error processing {domain}: {str(e)}")
 
-def generate_tasks(data, BASE_DIR):
-    tasks = []
-    # counter = 0
-    for trademark, domains in data.items():
-        for domain in domains:
-            # counter += 1
-            # if counter < 600000:
-            #     continue
-            tasks.append((trademark, domain, BASE_DIR))
-            # if counter > 610000:
-            #     return tasks
-        
-    print("Number of domains:", len(tasks))
-    return tasks
+def generate_tasks(candidates, BASE_DIR):
+    """Lazily turn (trademark, domain) candidate pairs into process_domain tasks, skipping finished ones."""
+    for trademark, domain in unfinished_candidates(candidates):
+        yield (trademark, domain, BASE_DIR)
 
-def main():
-   # t1 = time.time()
-   # with open(CANDIDATE_DOMAIN_PATH, 'r') as file:
-   #     data = json.load(file)
+def unfinished_candidates(candidates):
+    """Candidates the journal still has pending stages for."""
+    for trademark, domain in candidates:
+        if pending_stages(trademark, domain):
+            yield trademark, domain
+
+def run_tasks(tasks, processes=NUM_THREADS):
+    """Run tasks on a thread pool, pulling from the task iterator only as fast as the pool works through it."""
+    pending = threading.BoundedSemaphore(processes * 4)
+
+    def release(_):
+        pending.release()
+
+    pool = ThreadPool(processes = processes)
+    num_tasks = 0
+    for task in tasks:
+        pending.acquire()
+        pool.apply_async(process_domain, task, callback=release, error_callback=release)
+        num_tasks += 1
+    pool.close()
+    pool.join()
+    return num_tasks
 
-   # BASE_DIR = 'data/simple_scrape'
+def run_tasks_with_async_dns(candidates, processes=NUM_THREADS, use_whois_engine=USE_WHOIS_ENGINE, use_async_tls=USE_ASYNC_TLS):
+    """Resolve every candidate in the asyncio DNS stage and hand each resolved domain to the thread pool.
 
-   # csv_file_path = os.path.join(BASE_DIR, 'domain_errors.csv')
-   # with open(csv_file_path, 'w', newline='') as csvfile:
-   #     writer = csv.writer(csvfile)
-   #     writer.writerow(['Domain', 'DNS Error', 'IP Error', 'WHOIS Error', 'Certificate Error', 'Exception'])
+    With use_whois_engine and use_async_tls, WHOIS and certificates are collected in the event loop as
+    well and the threads only do what is left.
+    """
+    pool = ThreadPool(processes = processes)
+    max_pending = processes * 4
+    num_tasks = 0
 
-   # tasks = generate_tasks(data, BASE_DIR)
+    async def dispatch(whois_engine, certificate_grabber):
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Semaphore(max_pending)
+        domain_tasks = set()
 
-   # pool = ThreadPool(processes = 250)
-   # pool.starmap(process_domain, tasks)
-   # pool.close()
-   # pool.join()
+        def release(_):
+            loop.call_soon_threadsafe(pending.release)
+
+        async def collect_domain(trademark, domain, dns_result):
+            try:
+                domain_folder = os.path.join(BASE_DIR, trademark, domain)
+                ip_address, _, verdict = dns_result
+
+                # Stages the cascade skips are left to the thread, which records why
+                stages = [stage for stage in pending_stages(trademark, domain) if not cascade_skip(verdict, stage)]
+
+                async def collect_whois():
+                    if whois_engine and 'whois' in stages and controller:
+                        return (await controller.call_async('whois', gather_and_save_whois_info_async,
+                                                            whois_engine, domain, domain_folder),)
+                    if whois_engine and 'whois' in stages:
+                        return (await gather_and_save_whois_info_async(whois_engine, domain, domain_folder),)
+
+                async def collect_certificate():
+                    if certificate_grabber and ip_address and 'cert' in stages and controller:
+                        return await controller.call_async('cert', certificate_grabber.gather_and_save_certificate_info,
+                                                           domain, domain_folder, ip_address)
+                    if certificate_grabber and ip_address and 'cert' in stages:
+                        return await certificate_grabber.gather_and_save_certificate_info(domain, domain_folder, ip_address)
+
+                # None leaves the stage to the thread
+                whois_result, cert_result = await asyncio.gather(collect_whois(), collect_certificate())
+                pool.apply_async(process_domain, (trademark, domain, BASE_DIR, dns_result, whois_result, cert_result),
+                                 callback=release, error_callback=release)
+            except BaseException:
+                pending.release()
+                raise
+
+        async def on_result(trademark, domain, ip_address, error_message, verdict):
+            nonlocal num_tasks
+            await pending.acquire()  # Hold DNS back while the thread pool is behind
+            num_tasks += 1
+            task = asyncio.create_task(collect_domain(trademark, domain, (ip_address, error_message, verdict)))
+            domain_tasks.add(task)
+            task.add_done_callback(domain_tasks.discard)
+
+        await collect_dns(unfinished_candidates(candidates), BASE_DIR, on_result, finished_result=finished_dns_result,
+                          controller=controller)
+        # Wait for the pool to hand back every slot so no callback targets a closed loop
+        for _ in range(max_pending):
+            await pending.acquire()
+
+    async def run():
+        certificate_grabber = CertificateGrabber() if use_async_tls else None
+        if use_whois_engine:
+            async with WhoisEngine() as whois_engine:
+                await dispatch(whois_engine, certificate_grabber)
+        else:
+            await dispatch(None, certificate_grabber)
+
+    asyncio.run(run())
+    pool.close()
+    pool.join()
+    return num_tasks
+
+def load_trademark_domains(path):
+    """Pick up which trademark each domain was scraped under in earlier runs."""
+    if not os.path.exists(path):
+        return
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            if row['Trademark'] == row['Scraped Under']:
+                scraped_under[row['Domain']] = row['Trademark']
+            else:
+                fanned_out.add((row['Trademark'], row['Domain']))
+
+def dedupe_domains(candidates):
+    """Pass on each domain once, under the first trademark it comes up for, and record every trademark it belongs to."""
+    for trademark, domain in candidates:
+        primary = scraped_under.get(domain)
+        if primary is None:
+            scraped_under[domain] = trademark
+            sink.write_row('trademark_domains', [trademark, domain, trademark])
+            yield trademark, domain
+        elif primary == trademark:
+            yield trademark, domain  # Seen in an earlier run; the journal knows whether it is finished
+        elif (trademark, domain) not in fanned_out:
+            fanned_out.add((trademark, domain))
+            sink.write_row('trademark_domains', [trademark, domain, primary])
+
+def run_candidates(candidates):
+    """Scrape (trademark, domain) pairs and return how many were handed to the workers."""
+    if DEDUPE_DOMAINS:
+        candidates = dedupe_domains(candidates)
+    if USE_ASYNC_DNS:
+        return run_tasks_with_async_dns(candidates)
+    tasks = generate_tasks(candidates, BASE_DIR)
+    return run_tasks(tasks, MAX_THREADS if controller else NUM_THREADS)
+
+def run_worker(work_queue):
+    """Lease batches of candidates from the work queue and scrape them until the queue is finished."""
+    num_tasks = 0
+    while True:
+        lease_id, candidates = work_queue.lease(WORKER_ID, BATCH_SIZE, shards=WORKER_SHARDS)
+        if not candidates:
+            stats = work_queue.stats()
+            if not stats['pending'] and not stats['leased']:
+                print(f"Work queue finished: {stats}")
+                return num_tasks
+            # Other workers' leases may still expire and come back
+            time.sleep(QUEUE_POLL_INTERVAL)
+            continue
+
+        keeper = LeaseKeeper(work_queue, lease_id)
+        try:
+            num_tasks += run_candidates(candidates)
+        except BaseException:
+            keeper.stop()
+            work_queue.release(lease_id)
+            raise
+        keeper.stop()
+        work_queue.ack(lease_id)
+        print(f"Finished lease of {len(candidates)} candidates; queue: {work_queue.stats()}")
+
+def main():
+    global journal, sink, controller
+    t1 = time.time()
+
+    csv_file_path = os.path.join(BASE_DIR, 'domain_errors.csv')
+    os.makedirs(BASE_DIR, exist_ok=True)
+    if USE_RECORD_STORE:
+        use_record_store(BASE_DIR)
+    if USE_JOURNAL:
+        journal = ScrapeJournal(JOURNAL_PATH)
+        journal.print_progress()
+    sink = ResultSink()
+    if USE_RECORD_STORE:
+        sink.add_flush(flush_record_store)
+    if SERVE_METRICS:
+        metrics.serve(METRICS_PORT)
+    if USE_ADAPTIVE_CONCURRENCY:
+        controller = ConcurrencyController(stage_outcome)
+    # A resumed run adds to the error flags of the runs before it
+    sink.add_csv('domain_errors', csv_file_path, ERROR_FLAGS_HEADER, resume=USE_JOURNAL)
+    if DEDUPE_DOMAINS:
+        if USE_JOURNAL:
+            load_trademark_domains(TRADEMARK_DOMAINS_PATH)
+        sink.add_csv('trademark_domains', TRADEMARK_DOMAINS_PATH, TRADEMARK_DOMAINS_HEADER, resume=USE_JOURNAL)
+    if USE_CASCADE:
+        sink.add_csv('skipped_stages', SKIPPED_STAGES_PATH, SKIPPED_STAGES_HEADER, resume=USE_JOURNAL)
+
+    try:
+        if WORK_QUEUE:
+            work_queue = open_queue(WORK_QUEUE)
+            num_tasks = run_worker(work_queue)
+            work_queue.close()
+        else:
+            num_tasks = run_candidates(iter_candidate_pairs(CANDIDATE_DOMAIN_PATH))
 
-   # print(f"Total time: {round(time.time() - t1, 2)} seconds")
+        print("Number of domains:", num_tasks)
+        if DEDUPE_DOMAINS:
+            print(f"Domains: {len(scraped_under)}, candidates sharing a domain scraped under another trademark: {len(fanned_out)}")
+        print("DNS cache:", dns_cache.stats())
+        if controller:
+            print("Concurrency limits:", controller.summary())
+    finally:
+        # Closing the sink flushes what was written and then journals the stages it holds back
+        sink.close()
+        close_record_store()
+        metrics.write_summary(METRICS_SUMMARY_PATH)
+        if journal:
+            journal.print_progress()
+            journal.close()
+    print(f"Total time: {round(time.time() - t1, 2)} seconds")
 
 if __name__ == "__main__":
     main()
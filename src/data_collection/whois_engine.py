@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import random
+import asyncio
+from urllib.parse import urlsplit
+
+import aiohttp
+from whois.parser import WhoisEntry
+from whois.whois import NICClient
+
+from record_store import save_output
+from scrape_metrics import metrics, StageError
+from concurrency_controller import restart_stage_clock
+
+WHOIS_PORT = 43
+WHOIS_TIMEOUT = 10
+MAX_RETRIES = 3
+BACKOFF_BASE = 2  # Seconds before the first retry, doubled on every further attempt
+BACKOFF_MAX = 120
+
+# Default limits for any WHOIS or RDAP server; SERVER_LIMITS overrides them for known servers
+SERVER_RATE = 1.0  # Queries per second once the burst is used up
+SERVER_BURST = 5
+SERVER_CONCURRENCY = 2
+SERVER_LIMITS = {
+    'whois.verisign-grs.com': {'rate': 10.0, 'burst': 20, 'concurrency': 10},
+    'rdap.verisign.com': {'rate': 10.0, 'burst': 20, 'concurrency': 10},
+}
+
+WHOIS_CACHE_PATH = 'data/whois_cache.jsonl'
+WHOIS_CACHE_TTL = 7 * 24 * 3600
+
+USE_RDAP = False  # Ask the TLD's RDAP server when IANA lists one, falling back to WHOIS otherwise
+RDAP_BOOTSTRAP_URL = 'https://data.iana.org/rdap/dns.json'
+
+# Phrases busy WHOIS servers answer with instead of closing the connection
+RATE_LIMIT_PHRASES = ('limit exceeded', 'quota exceeded', 'too many requests', 'try again later',
+                      'excessive querying', 'rate limit', 'access denied')
+
+class RateLimited(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """Allows burst queries at once and rate queries per second after that."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            elif self.tokens >= 1:
+                self.tokens -= 1
+                return
+            else:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for a while after the server pushed back."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class ServerLimiter:
+    """Token bucket plus a cap on open connections for one WHOIS or RDAP server."""
+
+    def __init__(self, rate=SERVER_RATE, burst=SERVER_BURST, concurrency=SERVER_CONCURRENCY):
+        self.bucket = TokenBucket(rate, burst)
+        self.connections = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self):
+        await self.connections.acquire()
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            self.connections.release()
+            raise
+        restart_stage_clock()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.connections.release()
+
+class WhoisCache:
+    """WHOIS results by domain, kept in an append-only JSON Lines file so reruns skip fresh lookups."""
+
+    def __init__(self, path=WHOIS_CACHE_PATH, ttl=WHOIS_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.file = None
+        if path is None:
+            return
+        if os.path.exists(path):
+            now = time.time()
+            with open(path, 'r') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash
+                    if now - entry['fetched_at'] < ttl:
+                        self.entries[entry['domain']] = entry
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'a')
+
+    def get(self, domain):
+        entry = self.entries.get(domain)
+        if entry is None or time.time() - entry['fetched_at'] >= self.ttl:
+            return None
+        return entry['whois']
+
+    def put(self, domain, whois_data):
+        entry = {'domain': domain, 'fetched_at': time.time(), 'whois': whois_data}
+        self.entries[domain] = entry
+        if self.file:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+def whois_query_string(server, domain):
+    """The query line python-whois sends, including its per-server quirks."""
+    if server == NICClient.DENICHOST:
+        return "-T dn,ace -C UTF-8 " + domain
+    if server == NICClient.DK_HOST:
+        return " --show-handles " + domain
+    if server.endswith(".jp"):
+        return domain + "/e"
+    return domain
+
+def check_rate_limited(text):
+    lowered = text[:2000].lower()
+    for phrase in RATE_LIMIT_PHRASES:
+        if phrase in lowered:
+            raise RateLimited(f"Server answered '{phrase}'")
+
+def vcard_fields(entity):
+    """Return {name: value} for the first value of every property in an RDAP entity's jCard."""
+    fields = {}
+    for name, _, _, value in entity.get('vcardArray', [None, []])[1]:
+        fields.setdefault(name, value)
+    return fields
+
+def rdap_to_whois(domain, rdap):
+    """Map an RDAP domain response onto the python-whois fields the classification step reads."""
+    whois_data = {'domain_name': rdap.get('ldhName', domain), 'source': 'rdap',
+                  'name_servers': [nameserver.get('ldhName') for nameserver in rdap.get('nameservers', [])],
+                  'status': rdap.get('status'), 'emails': []}
+    for event in rdap.get('events', []):
+        key = {'registration': 'creation_date', 'expiration': 'expiration_date',
+               'last changed': 'updated_date'}.get(event.get('eventAction'))
+        if key:
+            whois_data[key] = event.get('eventDate')
+
+    entities = list(rdap.get('entities', []))
+    while entities:
+        entity = entities.pop()
+        entities.extend(entity.get('entities', []))
+        fields = vcard_fields(entity)
+        if fields.get('email'):
+            whois_data['emails'].append(fields['email'])
+        roles = entity.get('roles', [])
+        if 'registrar' in roles:
+            whois_data['registrar'] = fields.get('fn')
+        if 'registrant' in roles:
+            whois_data['name'] = fields.get('fn')
+            whois_data['org'] = fields.get('org') or fields.get('fn')
+            address = fields.get('adr')
+            if isinstance(address, list):
+                whois_data['address'] = ', '.join(part for part in address if isinstance(part, str) and part)
+    whois_data['emails'] = sorted(set(whois_data['emails'])) or None
+    return whois_data
+
+class WhoisEngine:
+    """Collects WHOIS (or RDAP) records while keeping every server within its own rate limit.
+
+    Each query is scheduled against the server that answers it: the TLD's registry server first and,
+    for thin registries, the registrar server it refers to. A busy server only slows down its own
+    domains; connection failures and rate-limit answers back the server off exponentially.
+
+    servers maps TLDs to a WHOIS server, which with port lets the engine run against a local
+    stand-in server instead of the real registries.
+    """
+
+    def __init__(self, servers=None, port=WHOIS_PORT, timeout=WHOIS_TIMEOUT, max_retries=MAX_RETRIES,
+                 cache_path=WHOIS_CACHE_PATH, cache_ttl=WHOIS_CACHE_TTL, use_rdap=USE_RDAP,
+                 server_limits=SERVER_LIMITS, follow_referrals=True):
+        self.servers = dict(servers or {})
+        self.port = port
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.cache = WhoisCache(cache_path, cache_ttl)
+        self.use_rdap = use_rdap
+        self.server_limits = server_limits
+        self.follow_referrals = follow_referrals
+        self.limiters = {}
+        self.tld_servers = {}
+        self.rdap_servers = None
+        self.session = None
+
+    async def start(self):
+        if self.use_rdap:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+            try:
+                async with self.session.get(RDAP_BOOTSTRAP_URL) as response:
+                    bootstrap = await response.json(content_type=None)
+                self.rdap_servers = {tld: urls[0] for tlds, urls in bootstrap['services'] for tld in tlds}
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                print(f"RDAP bootstrap unavailable ({e}), using WHOIS only")
+                self.rdap_servers = {}
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+        self.cache.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def limiter(self, server):
+        if server not in self.limiters:
+            self.limiters[server] = ServerLimiter(**self.server_limits.get(server, {}))
+        return self.limiters[server]
+
+    async def registry_server(self, domain):
+        """WHOIS server for the domain's TLD, asked of IANA once per TLD."""
+        tld = domain.rsplit('.', 1)[-1].lower()
+        if tld in self.servers:
+            return self.servers[tld]
+        if tld not in self.tld_servers:
+            # Share one lookup between every domain of the TLD waiting on it
+            self.tld_servers[tld] = asyncio.ensure_future(asyncio.to_thread(NICClient().choose_server, domain))
+        try:
+            return await asyncio.shield(self.tld_servers[tld])
+        except Exception:
+            del self.tld_servers[tld]  # Ask again for the next domain
+            raise
+
+    async def with_backoff(self, server, request):
+        """Run request() under the server's limits, backing the whole server off after each failure."""
+        limiter = self.limiter(server)
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with limiter:
+                    return await request()
+            except (OSError, asyncio.TimeoutError, aiohttp.ClientError, RateLimited) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+                if isinstance(e, RateLimited) and e.retry_after:
+                    delay = max(delay, e.retry_after)
+                limiter.bucket.pause(delay)
+                await asyncio.sleep(delay)
+
+    async def whois_query(self, server, domain):
+        async def request():
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(server, self.port), self.timeout)
+            try:
+                writer.write(whois_query_string(server, domain).encode('utf-8') + b"\r\n")
+                await writer.drain()
+                response = await asyncio.wait_for(reader.read(), self.timeout)
+            finally:
+                writer.close()
+            text = response.decode('utf-8', 'replace')
+            check_rate_limited(text)
+            return text
+
+        return await self.with_backoff(server, request)
+
+    async def rdap_query(self, base_url, domain):
+        async def request():
+            async with self.session.get(base_url.rstrip('/') + '/domain/' + domain,
+                                        headers={'Accept': 'application/rdap+json'}) as response:
+                if response.status == 404:
+                    return None
+                if response.status == 429:
+                    retry_after = response.headers.get('Retry-After', '')
+                    raise RateLimited("HTTP 429", float(retry_after) if retry_after.isdigit() else None)
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+        return await self.with_backoff(urlsplit(base_url).hostname, request)
+
+    async def lookup(self, domain):
+        """Return the WHOIS record for a domain as the dict whois.whois would produce."""
+        cached = self.cache.get(domain)
+        if cached is not None:
+            return cached
+
+        tld = domain.rsplit('.', 1)[-1].lower()
+        if self.use_rdap and tld in self.rdap_servers:
+            rdap = await self.rdap_query(self.rdap_servers[tld], domain)
+            if rdap is None:
+                raise LookupError(f"RDAP has no record of {domain}")
+            whois_data = rdap_to_whois(domain, rdap)
+        else:
+            server = await self.registry_server(domain)
+            if not server:
+                raise LookupError(f"No WHOIS server known for {domain}")
+            text = await self.whois_query(server, domain)
+            referral = NICClient.findwhois_server(text, server, domain) if self.follow_referrals else None
+            if referral and referral.lower() != server.lower():
+                try:
+                    text += await self.whois_query(referral, domain)
+                except (OSError, asyncio.TimeoutError, RateLimited) as e:
+                    print(f"Registrar WHOIS server {referral} failed for {domain}, keeping the registry record: {e}")
+            # Round trip through JSON so cached and fresh records look the same
+            whois_data = json.loads(json.dumps(WhoisEntry.load(domain, text), default=str))
+
+        self.cache.put(domain, whois_data)
+        return whois_data
+
+@metrics.timed('whois')
+async def gather_and_save_whois_info_async(engine, domain, domain_folder):
+    """Async counterpart of gather_and_save_whois_info, returning an error message on failure."""
+    try:
+        whois_data = await engine.lookup(domain)
+        save_output(domain_folder, f"{domain}.whois.json", json.dumps(whois_data, indent=4, default=str))
+    except Exception as e:
+        return StageError.from_exception(f"Failed to fetch or save WHOIS information for {domain}. Error: {e!r}", e)
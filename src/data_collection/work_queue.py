@@ -0,0 +1,301 @@
+import os
+import hmac
+import json
+import time
+import uuid
+import zlib
+import sqlite3
+import argparse
+import ipaddress
+import threading
+import http.client
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from candidate_io import iter_candidate_pairs, find_candidate_file
+
+NUM_SHARDS = 64  # Candidates are sharded by domain so workers can be pinned to part of the domain space
+BATCH_SIZE = 2000  # Domains leased at a time, each with every trademark it is a candidate for
+LEASE_SECONDS = 600  # A lease not renewed for this long goes back to the queue
+MAX_ATTEMPTS = 3  # Leases a candidate may expire in before it is marked failed
+LOAD_BATCH_SIZE = 10000
+QUEUE_PORT = 8765
+QUEUE_HOST = '127.0.0.1'  # Serve to this host only unless another address is asked for explicitly
+QUEUE_TOKEN_ENV = 'WORK_QUEUE_TOKEN'  # Environment variable holding the token shared by the server and its workers
+
+def domain_shard(domain, num_shards=NUM_SHARDS):
+    return zlib.crc32(domain.encode('utf-8')) % num_shards
+
+class WorkQueue:
+    """Durable queue of (trademark, domain) candidates in an SQLite file, leased out in batches.
+
+    A worker leases a batch, renews the lease with heartbeat while it works and acks the batch
+    when it is done. Leases that are not renewed in time expire and their candidates become
+    available to the next lease; a candidate whose leases expire MAX_ATTEMPTS times is marked failed.
+    A lease holds every pending trademark of the domains in it, so a worker that scrapes each domain
+    once (webscraper_simple.DEDUPE_DOMAINS) also does so across hosts.
+    Workers on other hosts reach the queue through QueueServer and RemoteWorkQueue.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, trademark TEXT, domain TEXT, '
+                        "shard INTEGER, state TEXT DEFAULT 'pending', lease_id TEXT, worker TEXT, "
+                        'lease_expires REAL, attempts INTEGER DEFAULT 0, UNIQUE (trademark, domain))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, shard, domain)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_by_lease ON tasks (lease_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_by_domain ON tasks (domain, state)')
+
+    def load(self, candidates):
+        """Add (trademark, domain) pairs that are not queued yet; returns how many were added."""
+        added = 0
+        batch = []
+        with self.lock:
+            for trademark, domain in candidates:
+                batch.append((trademark, domain, domain_shard(domain)))
+                if len(batch) >= LOAD_BATCH_SIZE:
+                    added += self._insert(batch)
+                    batch = []
+            if batch:
+                added += self._insert(batch)
+        return added
+
+    def _insert(self, batch):
+        before = self.db.total_changes
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.executemany('INSERT OR IGNORE INTO tasks (trademark, domain, shard) VALUES (?, ?, ?)', batch)
+        self.db.execute('COMMIT')
+        return self.db.total_changes - before
+
+    def _requeue_expired(self, now):
+        self.db.execute("UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                        "lease_id = NULL WHERE state = 'leased' AND lease_expires < ?", (MAX_ATTEMPTS, now))
+
+    def lease(self, worker, batch_size=BATCH_SIZE, lease_seconds=LEASE_SECONDS, shards=None):
+        """Lease the pending candidates of up to batch_size domains; returns (lease_id, [(trademark, domain), ...])."""
+        now = time.time()
+        lease_id = uuid.uuid4().hex
+        shard_filter = f" AND shard IN ({','.join('?' * len(shards))})" if shards else ''
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self._requeue_expired(now)
+                # Whole domains, so all the trademarks of a domain go to one worker and it is scraped once
+                domains = [row[0] for row in self.db.execute(
+                    f"SELECT DISTINCT domain FROM tasks WHERE state = 'pending'{shard_filter} ORDER BY shard, domain LIMIT ?",
+                    (*(shards or ()), batch_size))]
+                rows = self.db.execute(f"SELECT id, trademark, domain FROM tasks INDEXED BY tasks_by_domain "
+                                       f"WHERE domain IN ({','.join('?' * len(domains))}) AND state = 'pending' "
+                                       'ORDER BY shard, domain, id', domains).fetchall() if domains else []
+                self.db.executemany("UPDATE tasks SET state = 'leased', lease_id = ?, worker = ?, lease_expires = ?, "
+                                    'attempts = attempts + 1 WHERE id = ?',
+                                    [(lease_id, worker, now + lease_seconds, row[0]) for row in rows])
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return lease_id, [(trademark, domain) for _, trademark, domain in rows]
+
+    def heartbeat(self, lease_id, lease_seconds=LEASE_SECONDS):
+        """Extend a lease; returns False once it has expired and its candidates may be leased by others."""
+        with self.lock:
+            cursor = self.db.execute("UPDATE tasks SET lease_expires = ? WHERE lease_id = ? AND state = 'leased'",
+                                     (time.time() + lease_seconds, lease_id))
+            return cursor.rowcount > 0
+
+    def ack(self, lease_id):
+        """Mark the candidates of a lease done; returns how many still belonged to it."""
+        with self.lock:
+            cursor = self.db.execute("UPDATE tasks SET state = 'done', lease_id = NULL WHERE lease_id = ? AND state = 'leased'",
+                                     (lease_id,))
+            return cursor.rowcount
+
+    def release(self, lease_id):
+        """Give the candidates of a lease back without finishing them, e.g. when a worker shuts down."""
+        with self.lock:
+            cursor = self.db.execute("UPDATE tasks SET state = 'pending', lease_id = NULL, attempts = attempts - 1 "
+                                     "WHERE lease_id = ? AND state = 'leased'", (lease_id,))
+            return cursor.rowcount
+
+    def stats(self):
+        """Number of candidates in each state."""
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            self._requeue_expired(time.time())
+            self.db.execute('COMMIT')
+            counts = dict(self.db.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall())
+        return {state: counts.get(state, 0) for state in ('pending', 'leased', 'done', 'failed')}
+
+    def close(self):
+        self.db.close()
+
+class RemoteWorkQueue:
+    """The WorkQueue interface for workers on other hosts, over the HTTP API of a QueueServer."""
+
+    def __init__(self, url, timeout=60, token=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.token = token or os.environ.get(QUEUE_TOKEN_ENV)
+
+    def _call(self, method, **arguments):
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        request = urllib.request.Request(f"{self.url}/{method}", data=json.dumps(arguments).encode('utf-8'), headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def lease(self, worker, batch_size=BATCH_SIZE, lease_seconds=LEASE_SECONDS, shards=None):
+        result = self._call('lease', worker=worker, batch_size=batch_size, lease_seconds=lease_seconds, shards=shards)
+        return result['lease_id'], [tuple(task) for task in result['tasks']]
+
+    def heartbeat(self, lease_id, lease_seconds=LEASE_SECONDS):
+        return self._call('heartbeat', lease_id=lease_id, lease_seconds=lease_seconds)
+
+    def ack(self, lease_id):
+        return self._call('ack', lease_id=lease_id)
+
+    def release(self, lease_id):
+        return self._call('release', lease_id=lease_id)
+
+    def stats(self):
+        return self._call('stats')
+
+    def close(self):
+        pass
+
+def open_queue(location, token=None):
+    """A WorkQueue for an SQLite path, or a RemoteWorkQueue for an http:// URL of a QueueServer."""
+    if location.startswith(('http://', 'https://')):
+        return RemoteWorkQueue(location, token=token)
+    return WorkQueue(location)
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class QueueServer:
+    """Serves a WorkQueue to workers on other hosts as a small JSON-over-HTTP API.
+
+    Run it on the coordinator next to the queue file rather than sharing the file over a network
+    filesystem, where SQLite locking cannot be relied on. It listens on localhost unless given
+    another host, and with a token it only answers requests that carry it as a bearer token.
+    """
+
+    METHODS = ('lease', 'heartbeat', 'ack', 'release', 'stats')
+
+    def __init__(self, queue, host=QUEUE_HOST, port=QUEUE_PORT, token=None):
+        work_queue = queue
+        expected = f"Bearer {token}".encode('utf-8') if token else None
+
+        class QueueHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if expected and not hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'), expected):
+                    self.send_error(401)
+                    return
+                method = self.path.strip('/')
+                if method not in QueueServer.METHODS:
+                    self.send_error(404)
+                    return
+                try:
+                    arguments = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    result = getattr(work_queue, method)(**arguments)
+                except (TypeError, ValueError) as e:
+                    self.send_error(400, str(e))
+                    return
+                if method == 'lease':
+                    result = {'lease_id': result[0], 'tasks': result[1]}
+                body = json.dumps(result).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), QueueHandler)
+        self.server.daemon_threads = True
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class LeaseKeeper:
+    """Renews a lease from a background thread while its batch is being worked on."""
+
+    def __init__(self, queue, lease_id, lease_seconds=LEASE_SECONDS):
+        self.queue = queue
+        self.lease_id = lease_id
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                if not self.queue.heartbeat(self.lease_id, self.lease_seconds):
+                    self.lost = True
+                    print(f"Lease {self.lease_id} expired; its candidates may be scraped again elsewhere")
+                    return
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                print(f"Heartbeat for lease {self.lease_id} failed: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Coordinate a scrape across hosts with a leased work queue")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    load_parser = subparsers.add_parser('load', help="Queue the candidates of a candidate file")
+    load_parser.add_argument('queue')
+    load_parser.add_argument('candidates', nargs='?', default=find_candidate_file('data/raw/candidate_domains_filtered'))
+    serve_parser = subparsers.add_parser('serve', help="Serve the queue to workers on other hosts")
+    serve_parser.add_argument('queue')
+    serve_parser.add_argument('--host', default=QUEUE_HOST, help="Address to listen on; anything but localhost needs a token")
+    serve_parser.add_argument('--port', type=int, default=QUEUE_PORT)
+    serve_parser.add_argument('--token', default=os.environ.get(QUEUE_TOKEN_ENV),
+                              help=f"Token workers must send, shared through {QUEUE_TOKEN_ENV} (default: ${QUEUE_TOKEN_ENV})")
+    status_parser = subparsers.add_parser('status', help="Print how many candidates are in each state")
+    status_parser.add_argument('queue')
+    args = parser.parse_args()
+    if args.command == 'serve' and not args.token and not is_loopback(args.host):
+        parser.error(f"serving on {args.host} needs a token: pass --token or set {QUEUE_TOKEN_ENV} for the server and its workers")
+
+    if args.command == 'status':
+        work_queue = open_queue(args.queue)
+        print(work_queue.stats())
+        work_queue.close()
+        return
+
+    if os.path.dirname(args.queue):
+        os.makedirs(os.path.dirname(args.queue), exist_ok=True)
+    work_queue = WorkQueue(args.queue)
+    if args.command == 'load':
+        added = work_queue.load(iter_candidate_pairs(args.candidates))
+        print(f"Queued {added} new candidates from {args.candidates}: {work_queue.stats()}")
+    else:
+        server = QueueServer(work_queue, args.host, args.port, args.token)
+        print(f"Serving {args.queue} at http://{args.host}:{args.port}: {work_queue.stats()}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
+    work_queue.close()
+
+if __name__ == "__main__":
+    main()
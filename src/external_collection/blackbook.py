@@ -1,7 +1,11 @@
 import os
+import sys
 import csv
 from time import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_collection'))
+from record_store import open_scrape
+
 def load_trademarks(csv_path):
     trademarks = {}
     with open(csv_path, newline='') as csvfile:
@@ -31,6 +35,7 @@ def main():
     blackbook_data = load_blackbook_data('blackbook/blackbook.csv')
 
     base_dir = 'data/simple_scrape'
+    scrape = open_scrape(base_dir)
     output_dir = 'data/simple_scrape_preprocess'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -38,10 +43,9 @@ def main():
     domains_to_check = []
 
     for trademark, domain in trademarks.items():
-        trademark_dir = os.path.join(base_dir, trademark)
-        if os.path.isdir(trademark_dir):
-            for candidate_domain in os.listdir(trademark_dir):
-                domains_to_check.append((domain, candidate_domain))
+        for candidate_domain in scrape.candidate_domains(trademark):
+            domains_to_check.append((domain, candidate_domain))
+    scrape.close()
 
     start_time = time()
     print("Checking {} domains".format(len(domains_to_check)))
@@ -1,4 +1,5 @@
 import os
+import sys
 import csv
 import requests
 import json
@@ -6,6 +7,9 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from time import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_collection'))
+from record_store import open_scrape
+
 def load_trademarks(csv_path):
     trademarks = {}
     with open(csv_path, newline='') as csvfile:
@@ -48,6 +52,7 @@ def main():
     trademarks = load_trademarks(csv_path)
 
     base_dir = 'data/simple_scrape'
+    scrape = open_scrape(base_dir)
     output_dir = 'data/simple_scrape_preprocess'
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -60,10 +65,9 @@ def main():
     counter = 0
 
     for trademark, domain in trademarks.items():
-        trademark_dir = os.path.join(base_dir, trademark)
-        if os.path.isdir(trademark_dir):
-            for candidate_domain in os.listdir(trademark_dir):
-                domains_to_check.append((domain, candidate_domain))
+        for candidate_domain in scrape.candidate_domains(trademark):
+            domains_to_check.append((domain, candidate_domain))
+    scrape.close()
 
     print("Checking {} domains".format(len(domains_to_check)))
     print("Load time: {}".format(time() - start_time))
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'data_collection'))
+from fuzzy_candidates import build_ngram_index, NgramIndex, find_fuzzy_matches, find_all_fuzzy_matches
+from candidate_io import CandidateWriter, find_candidate_file, iter_candidate_pairs, iter_candidates, merge_candidates
+
+DOMAINS = ['app1e-store.com', 'apple.com', 'aple-support.net', 'appxle.org', 'banana.com', 'amaz0n-pay.net',
+           'amazon.com', 'microsoftt-login.com', 'micr0s0ft.com', 'mcrosoft-help.org', 'orange.com']
+
+class FuzzyCandidatesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        domains_txt_path = os.path.join(self.directory.name, 'unique_domains.txt')
+        with open(domains_txt_path, 'w') as file:
+            file.write('\n'.join(DOMAINS) + '\n')
+        build_ngram_index(domains_txt_path, os.path.join(self.directory.name, 'index'))
+        self.index = NgramIndex(os.path.join(self.directory.name, 'index'))
+
+    def tearDown(self):
+        self.index.close()
+        self.directory.cleanup()
+
+    def matches(self, trademark):
+        return dict(find_fuzzy_matches(self.index, trademark))
+
+    def test_five_character_trademark(self):
+        self.assertEqual(self.matches('apple'), {'app1e-store.com': 'homoglyph', 'aple-support.net': 'typo',
+                                                 'appxle.org': 'typo'})
+
+    def test_longer_trademarks(self):
+        self.assertEqual(self.matches('amazon'), {'amaz0n-pay.net': 'homoglyph'})
+        self.assertEqual(self.matches('microsoft'), {'micr0s0ft.com': 'homoglyph', 'mcrosoft-help.org': 'typo'})
+
+    def test_fuzzy_candidates_reach_the_scraper(self):
+        basename = os.path.join(self.directory.name, 'candidate_domains_all')
+        with CandidateWriter(basename + '.jsonl') as writer:
+            writer.write('apple', 'apple.com')
+            writer.write('apple', 'aple-support.net')  # Also found as a typo below
+        candidates_path = find_candidate_file(basename)
+        for _ in range(2):  # Merging again replaces the fuzzy candidates instead of repeating them
+            merge_candidates(candidates_path, candidates_path, find_all_fuzzy_matches(self.index, ['apple']))
+
+        pairs = list(iter_candidate_pairs(find_candidate_file(basename)))
+        self.assertEqual(pairs, [('apple', 'apple.com'), ('apple', 'aple-support.net'),
+                                 ('apple', 'app1e-store.com'), ('apple', 'appxle.org')])
+        match_types = {candidate['domain']: candidate['match_type'] for candidate in iter_candidates(candidates_path)}
+        self.assertEqual(match_types['aple-support.net'], 'exact')
+        self.assertEqual(match_types['app1e-store.com'], 'homoglyph')
+
+if __name__ == '__main__':
+    unittest.main()